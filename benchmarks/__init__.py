@@ -0,0 +1,5 @@
+"""
+Offline benchmarks for the grading pipeline.
+
+Run from the project root, e.g. ``python -m benchmarks.bench_pipeline``.
+"""
@@ -0,0 +1,273 @@
+"""
+End-to-end throughput benchmark for the grading pipeline.
+
+Grades a generated fixture repository through the real clone, file loading,
+prompt building, routing, retry and parsing code, with FakeLLM in place of
+Azure OpenAI. Every combination of batch count and concurrency level is run
+as one scenario, and each reports latency percentiles, requests per second
+and memory.
+
+Examples:
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --target app --batches 1 8 --concurrency 1 8 32
+    python -m benchmarks.bench_pipeline --json results.json
+    python -m benchmarks.bench_pipeline --compare results.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import logging
+import asyncio
+import argparse
+import resource
+import contextlib
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fixtures import (
+    FakeLLM,
+    configure_environment,
+    create_bench_service,
+    fixture_directory,
+    make_fixture_repo,
+    make_rubric
+)
+
+
+TARGETS = ("async", "sync", "app")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, or None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), math.ceil(fraction * len(ordered))))
+    return ordered[rank - 1]
+
+
+def _failed(result):
+    if isinstance(result, dict):
+        return not result.get("success", True)
+    return any(
+        isinstance(batch, dict) and ("error" in batch or "analysis_result" in batch)
+        for batch in result
+    )
+
+
+async def _run_async(target, agent, github_link, rubric, requests, concurrency):
+    """Send requests through agent_service_function_async or /grade, concurrency at a time."""
+    from services.agent_service import agent_service_function_async
+
+    client = None
+    if target == "app":
+        import httpx
+        import main
+        main.grading_service = agent
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one():
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            if client is not None:
+                response = await client.post(
+                    "/grade", json={"github_link": github_link, "rubric": rubric}, timeout=None
+                )
+                body = response.json()
+                failed = response.status_code != 200 or not body.get("success") or _failed(body["analysis"])
+            else:
+                failed = _failed(await agent_service_function_async(github_link, rubric, agent=agent))
+            latencies.append(time.perf_counter() - started)
+            failures += failed
+
+    try:
+        await asyncio.gather(*(one() for _ in range(requests)))
+    finally:
+        if client is not None:
+            await client.aclose()
+    return latencies, failures
+
+
+def _run_sync(agent, github_link, rubric, requests, concurrency):
+    """Send requests through agent_service_function on a thread pool."""
+    from services.agent_service import agent_service_function
+
+    def one(_):
+        started = time.perf_counter()
+        failed = _failed(agent_service_function(github_link, rubric, agent=agent))
+        return time.perf_counter() - started, failed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(requests)))
+    return [latency for latency, _ in outcomes], sum(failed for _, failed in outcomes)
+
+
+def run_scenario(target, github_link, file_names, batches, concurrency, requests, llm_options,
+                 trace_memory=False):
+    """
+    Run one scenario on a fresh service and return its measurements.
+
+    Args:
+        target (str): "async" (agent_service_function_async), "sync"
+            (agent_service_function) or "app" (POST /grade in process)
+        github_link (str): URL of the fixture repository
+        file_names (list): Files in the fixture repository
+        batches (int): Batches per request, one file each
+        concurrency (int): Requests in flight at once
+        requests (int): Requests to send
+        llm_options (dict): Keyword arguments for FakeLLM
+        trace_memory (bool): Record the Python heap peak with tracemalloc,
+            which slows the run down
+
+    Returns:
+        dict: Scenario settings with latency, throughput and memory results
+    """
+    if target not in TARGETS:
+        raise ValueError(f"Unknown target: {target}")
+
+    llm = FakeLLM(**llm_options)
+    agent = create_bench_service(lambda: llm)
+    rubric = make_rubric(file_names, batches)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        if target == "sync":
+            latencies, failures = _run_sync(agent, github_link, rubric, requests, concurrency)
+        else:
+            latencies, failures = asyncio.run(
+                _run_async(target, agent, github_link, rubric, requests, concurrency)
+            )
+        elapsed = time.perf_counter() - started
+    finally:
+        heap_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        agent.close()
+
+    return {
+        "target": target,
+        "batches": batches,
+        "concurrency": concurrency,
+        "requests": requests,
+        "failures": failures,
+        "llm_calls": llm.calls,
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(requests / elapsed, 3) if elapsed else None,
+        "p50_seconds": round(percentile(latencies, 0.5), 4),
+        "p95_seconds": round(percentile(latencies, 0.95), 4),
+        "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "heap_peak_mib": round(heap_peak / 2 ** 20, 2) if heap_peak is not None else None
+    }
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Find scenarios whose p95 latency or throughput regressed against a baseline.
+
+    Returns:
+        list: One message per regression
+    """
+    previous = {(r["target"], r["batches"], r["concurrency"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["target"], result["batches"], result["concurrency"]))
+        if before is None:
+            continue
+        name = f"{result['target']} batches={result['batches']} concurrency={result['concurrency']}"
+        if result["p95_seconds"] > before["p95_seconds"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_seconds']}s -> {result['p95_seconds']}s")
+        if result["requests_per_second"] < before["requests_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {before['requests_per_second']} -> {result['requests_per_second']} req/s"
+            )
+    return regressions
+
+
+def _print_table(results):
+    columns = ("target", "batches", "concurrency", "requests", "failures", "p50_seconds",
+               "p95_seconds", "requests_per_second", "max_rss_mib", "heap_peak_mib")
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the grading pipeline offline.")
+    parser.add_argument("--target", choices=TARGETS, default="async")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 4, 16],
+                        help="Batch counts per request to benchmark")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8],
+                        help="Concurrent request levels to benchmark")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="Requests per scenario (default: 4 x concurrency)")
+    parser.add_argument("--lines-per-file", type=int, default=200)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Mean fake LLM latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.05)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+    parser.add_argument("--trace-memory", action="store_true", help="Report the Python heap peak (slower)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Baseline results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative slowdown against the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Grade through the full pipeline every time, not from the result cache or regrade store
+    configure_environment({"GRADING_CACHE_BACKEND": "none", "GRADING_REGRADE_DB": "none"})
+
+    llm_options = {
+        "latency": args.llm_latency,
+        "jitter": args.llm_jitter,
+        "error_rate": args.llm_error_rate,
+        "seed": args.seed
+    }
+
+    results = []
+    with fixture_directory() as directory, contextlib.ExitStack() as stack:
+        if not args.verbose:
+            # The pipeline prints per clone and batch, which would bury the table
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            logging.disable(logging.INFO)
+        github_link, file_names = make_fixture_repo(
+            directory, files=max(args.batches), lines_per_file=args.lines_per_file, seed=args.seed
+        )
+        for batches in args.batches:
+            for concurrency in args.concurrency:
+                results.append(run_scenario(
+                    args.target, github_link, file_names, batches, concurrency,
+                    args.requests or 4 * concurrency, llm_options, trace_memory=args.trace_memory
+                ))
+
+    _print_table(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
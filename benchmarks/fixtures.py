@@ -0,0 +1,250 @@
+"""
+Local stand-ins for GitHub and Azure OpenAI used by the benchmarks.
+
+make_fixture_repo() generates a bare git repository of configurable size
+that is cloned over file://, which goes through git-upload-pack like a
+remote would and supports the same blobless, sparse and shallow clones.
+FakeLLM answers grading prompts after a configurable latency, with jitter
+and an error rate, and BenchAgentService wires both into the real pipeline.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import subprocess
+import tempfile
+
+import httpx
+import openai
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+
+# Placeholder Azure settings so AgentService can be built without credentials;
+# no request ever reaches them
+BENCH_ENVIRONMENT = {
+    "AZURE_OPENAI_API_KEY": "benchmark",
+    "AZURE_OPENAI_ENDPOINT": "https://benchmark.invalid",
+    "AZURE_OPENAI_DEPLOYMENT_NAME": "benchmark",
+    # Keep injected failures from turning into multi-second backoffs
+    "GRADING_LLM_RETRY_BASE_SECONDS": "0.05",
+    "GRADING_LLM_RETRY_MAX_SECONDS": "0.5",
+}
+
+_FUNCTION_TEMPLATE = '''
+
+def function_{index}(values: list[int], threshold: int = {threshold}) -> int:
+    """Return how many values exceed the threshold."""
+    count = 0
+    for value in values:
+        if value > threshold:
+            count += 1
+    return count
+'''
+
+
+def configure_environment(overrides=None):
+    """Set placeholder credentials and fast retries, keeping any values already set."""
+    for name, value in {**BENCH_ENVIRONMENT, **(overrides or {})}.items():
+        os.environ.setdefault(name, value)
+
+
+def _git(args, cwd):
+    subprocess.run(
+        ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@example.com", *args],
+        cwd=cwd, check=True, capture_output=True
+    )
+
+
+def _source_file(index, lines, rng):
+    parts = [f'"""Generated benchmark module {index}."""\n']
+    length = len(parts[0].splitlines())
+    function = 0
+    while length < lines:
+        block = _FUNCTION_TEMPLATE.format(index=function, threshold=rng.randint(0, 100))
+        parts.append(block)
+        length += len(block.splitlines())
+        function += 1
+    return "".join(parts)
+
+
+def write_fixture_tree(work_tree, files=10, lines_per_file=200, seed=0):
+    """
+    Write generated Python files to grade into work_tree.
+
+    Files are spread over a few packages so file matching has work to do.
+
+    Returns:
+        list: The generated paths, relative to work_tree
+    """
+    rng = random.Random(seed)
+    file_names = []
+    for index in range(files):
+        path = f"pkg{index % 4}/module_{index}.py"
+        os.makedirs(os.path.join(work_tree, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(work_tree, path), "w", encoding="utf-8") as f:
+            f.write(_source_file(index, lines_per_file, rng))
+        file_names.append(path)
+    return file_names
+
+
+def make_fixture_repo(directory, files=10, lines_per_file=200, seed=0):
+    """
+    Generate a bare repository of Python files to grade.
+
+    Args:
+        directory (str): Where the working copy and bare repository are created
+        files (int): Number of source files
+        lines_per_file (int): Approximate length of each file
+        seed (int): Seed for the generated contents
+
+    Returns:
+        tuple: (url, file_names) where url is a file:// URL of the bare
+            repository and file_names are the generated paths
+    """
+    work_tree = os.path.join(directory, "work")
+    bare = os.path.join(directory, "student.git")
+    os.makedirs(work_tree)
+    file_names = write_fixture_tree(work_tree, files, lines_per_file, seed)
+
+    _git(["init", "-q"], work_tree)
+    _git(["add", "-A"], work_tree)
+    _git(["commit", "-q", "-m", "Benchmark fixture"], work_tree)
+    _git(["clone", "-q", "--bare", work_tree, bare], directory)
+    # Allow the blobless and sparse clones the pipeline asks for
+    _git(["config", "uploadpack.allowFilter", "true"], bare)
+    _git(["config", "uploadpack.allowAnySHA1InWant", "true"], bare)
+
+    return "file://" + bare, file_names
+
+
+def make_rubric(file_names, batches, files_per_batch=1):
+    """Build a rubric with the given number of batches over the fixture files."""
+    if batches * files_per_batch > len(file_names):
+        raise ValueError("Not enough fixture files for the requested batches")
+    return {
+        "batches": [
+            file_names[index * files_per_batch:(index + 1) * files_per_batch]
+            for index in range(batches)
+        ],
+        "totalPoints": 6,
+        "rubric": "RUBRIC: Total possible points: 6. _/3: Functions have type hints and docstrings. "
+                  "_/3: Logic is correct and not duplicated."
+    }
+
+
+class FakeLLM:
+    """
+    Stand-in for AzureChatOpenAI that returns a valid grade after a delay.
+
+    Failures are raised as openai.APITimeoutError, so they go through the
+    same retry and failover path as real transient errors.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.0, error_rate=0.0, tokens_per_second=None, seed=None):
+        """
+        Args:
+            latency (float): Mean seconds per call
+            jitter (float): Maximum seconds added or removed at random
+            error_rate (float): Fraction of calls that fail
+            tokens_per_second (float, optional): Streaming speed; astream sends
+                the whole response in one chunk when unset
+            seed (int, optional): Seed for jitter and errors
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens_per_second = tokens_per_second
+        self.calls = 0
+        self._rng = random.Random(seed)
+
+    def _delay(self):
+        return max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+
+    def _maybe_fail(self):
+        self.calls += 1
+        if self._rng.random() < self.error_rate:
+            raise openai.APITimeoutError(request=httpx.Request("POST", "https://benchmark.invalid"))
+
+    def _response(self, prompt):
+        prompt_chars = sum(len(getattr(message, "content", message)) for message in prompt)
+        content = json.dumps({
+            "rubric_score": "5/6",
+            "hundred_point_score": 83,
+            "review": "Functions are typed and documented; some logic is repeated."
+        })
+        usage = {
+            "input_tokens": prompt_chars // 4,
+            "output_tokens": len(content) // 4,
+            "total_tokens": prompt_chars // 4 + len(content) // 4
+        }
+        return content, usage
+
+    def invoke(self, prompt, **kwargs):
+        time.sleep(self._delay())
+        self._maybe_fail()
+        content, usage = self._response(prompt)
+        return AIMessage(content=content, usage_metadata=usage)
+
+    async def ainvoke(self, prompt, **kwargs):
+        await asyncio.sleep(self._delay())
+        self._maybe_fail()
+        content, usage = self._response(prompt)
+        return AIMessage(content=content, usage_metadata=usage)
+
+    async def astream(self, prompt, **kwargs):
+        await asyncio.sleep(self._delay())
+        self._maybe_fail()
+        content, usage = self._response(prompt)
+        if not self.tokens_per_second:
+            yield AIMessageChunk(content=content, usage_metadata=usage)
+            return
+        # Roughly four characters per token
+        for start in range(0, len(content), 4):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield AIMessageChunk(content=content[start:start + 4])
+        yield AIMessageChunk(content="", usage_metadata=usage)
+
+
+def create_bench_service(llm_factory, repo_dir=None):
+    """
+    Build an AgentService that clones file:// fixtures and grades with llm_factory().
+
+    With repo_dir, every request grades that directory in place and nothing
+    is cloned, which isolates the app and LLM path from git.
+
+    Imported lazily so configure_environment() runs before the service
+    module loads its .env file.
+    """
+    from services.agent_service import AgentService
+
+    class BenchAgentService(AgentService):
+        def _validate_github_url(self, github_url):
+            if isinstance(github_url, str) and github_url.startswith("file://"):
+                return
+            super()._validate_github_url(github_url)
+
+        def _initialize_llm(self, deployment=None):
+            return llm_factory()
+
+        def acquire_repo(self, github_url, commit=None, paths=None):
+            if repo_dir is None:
+                return super().acquire_repo(github_url, commit, paths)
+            return repo_dir
+
+        async def aacquire_repo(self, github_url, commit=None, paths=None):
+            if repo_dir is None:
+                return await super().aacquire_repo(github_url, commit, paths)
+            return repo_dir
+
+        def release_repo(self, repo_path):
+            if repo_dir is None:
+                super().release_repo(repo_path)
+
+    return BenchAgentService()
+
+
+def fixture_directory():
+    """Temporary directory for one benchmark run's fixture repositories."""
+    return tempfile.TemporaryDirectory(prefix="grading-bench-")
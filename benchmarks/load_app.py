@@ -0,0 +1,97 @@
+"""
+The FastAPI app with a mocked grading backend, for load tests.
+
+Serve it with uvicorn, e.g.
+``uvicorn benchmarks.load_app:create_app --factory --workers 4``.
+Each worker grades the working tree in BENCH_REPO_DIR in place, without
+cloning, and answers LLM calls with a FakeLLM configured by
+BENCH_LLM_LATENCY, BENCH_LLM_JITTER and BENCH_LLM_ERROR_RATE, so the load
+test measures the app itself.
+
+Every response carries the worker's pid and its event-loop lag so far in
+the X-Bench-Worker and X-Bench-Loop-Lag headers.
+"""
+
+import os
+import json
+import time
+import asyncio
+
+from benchmarks.fixtures import FakeLLM, configure_environment, create_bench_service
+
+
+# How often the loop-lag monitor wakes up
+LAG_INTERVAL_SECONDS = 0.05
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a task scheduled at a fixed interval."""
+
+    def __init__(self, interval=LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        """Start sampling on the running loop; later calls do nothing."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def summary(self):
+        """p50, p99 and maximum lag in seconds over every sample so far."""
+        if not self.samples:
+            return {"samples": 0, "p50_seconds": 0.0, "p99_seconds": 0.0, "max_seconds": 0.0}
+        ordered = sorted(self.samples)
+        return {
+            "samples": len(ordered),
+            "p50_seconds": round(ordered[len(ordered) // 2], 4),
+            "p99_seconds": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 4),
+            "max_seconds": round(ordered[-1], 4)
+        }
+
+
+class LoopLagMiddleware:
+    """ASGI middleware that starts a LoopLagMonitor and reports it on every response."""
+
+    def __init__(self, app, monitor=None):
+        self.app = app
+        self.monitor = monitor or LoopLagMonitor()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        self.monitor.start()
+
+        async def send_with_lag(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-bench-worker", str(os.getpid()).encode()),
+                    (b"x-bench-loop-lag", json.dumps(self.monitor.summary()).encode())
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_lag)
+
+
+def create_app():
+    """Build the app around a mocked grading service; used as a uvicorn factory."""
+    # Grade through the full pipeline every time, not from the result cache or regrade store
+    configure_environment({"GRADING_CACHE_BACKEND": "none", "GRADING_REGRADE_DB": "none"})
+    import main
+
+    llm = FakeLLM(
+        latency=float(os.getenv("BENCH_LLM_LATENCY", "0.2")),
+        jitter=float(os.getenv("BENCH_LLM_JITTER", "0.05")),
+        error_rate=float(os.getenv("BENCH_LLM_ERROR_RATE", "0"))
+    )
+    main.grading_service = create_bench_service(lambda: llm, repo_dir=os.environ["BENCH_REPO_DIR"])
+    return LoopLagMiddleware(main.app)
@@ -0,0 +1,215 @@
+"""
+Load test for the FastAPI app under many concurrent clients.
+
+Starts uvicorn on benchmarks.load_app (the real app with a mocked grading
+backend) once per worker count, drives POST /grade from concurrent clients
+for a fixed duration, and reports throughput, tail latency and the server's
+event-loop lag, so single- and multi-worker settings can be compared.
+
+Examples:
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --workers 1 2 4 --clients 50 --duration 30
+    python -m benchmarks.load_test --llm-latency 2 --batches 8 --json load.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+from benchmarks.bench_pipeline import percentile
+from benchmarks.fixtures import BENCH_ENVIRONMENT, fixture_directory, make_rubric, write_fixture_tree
+
+
+# Seconds to wait for the server to start answering requests
+STARTUP_TIMEOUT_SECONDS = 30
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, port, environment, verbose=False):
+    """Start uvicorn on the load-test app and wait until its grading service answers."""
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.load_app:create_app", "--factory",
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=PROJECT_ROOT,
+        env={**os.environ, **environment},
+        # The app logs every request, which would bury the results
+        stdout=output,
+        stderr=output
+    )
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/llm/deployments", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+
+    stop_server(process)
+    raise RuntimeError("Server did not start in time")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def drive_load(base_url, payload, clients, duration, warmup=1.0):
+    """
+    Send POST /grade from clients concurrent clients for duration seconds.
+
+    Each client sends its next request as soon as the previous one finishes.
+    Requests that finish during the first warmup seconds are not measured.
+
+    Returns:
+        dict: Latencies, failure count, measured seconds and the last
+            loop-lag report seen from each worker
+    """
+    latencies = []
+    failures = 0
+    loop_lag = {}
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=None) as client:
+
+        async def run_client():
+            nonlocal failures
+            while time.perf_counter() < stop_at:
+                request_started = time.perf_counter()
+                try:
+                    response = await client.post("/grade", json=payload)
+                    failed = response.status_code != 200 or not response.json().get("success")
+                    worker = response.headers.get("x-bench-worker")
+                    if worker:
+                        loop_lag[worker] = json.loads(response.headers["x-bench-loop-lag"])
+                except httpx.HTTPError:
+                    failed = True
+                if request_started >= measure_from:
+                    latencies.append(time.perf_counter() - request_started)
+                    failures += failed
+
+        await asyncio.gather(*(run_client() for _ in range(clients)))
+
+    return {
+        "latencies": latencies,
+        "failures": failures,
+        "seconds": time.perf_counter() - measure_from,
+        "loop_lag": loop_lag
+    }
+
+
+def summarize(workers, clients, outcome):
+    """Reduce one load run to throughput, latency percentiles and worst worker loop lag."""
+    latencies = outcome["latencies"]
+    lags = outcome["loop_lag"].values()
+    return {
+        "workers": workers,
+        "clients": clients,
+        "requests": len(latencies),
+        "failures": outcome["failures"],
+        "requests_per_second": round(len(latencies) / outcome["seconds"], 2) if outcome["seconds"] > 0 else None,
+        "p50_seconds": round(percentile(latencies, 0.5), 4) if latencies else None,
+        "p95_seconds": round(percentile(latencies, 0.95), 4) if latencies else None,
+        "p99_seconds": round(percentile(latencies, 0.99), 4) if latencies else None,
+        "workers_seen": len(outcome["loop_lag"]),
+        "loop_lag_p99_seconds": max((lag["p99_seconds"] for lag in lags), default=None),
+        "loop_lag_max_seconds": max((lag["max_seconds"] for lag in lags), default=None)
+    }
+
+
+def _print_table(results):
+    columns = ("workers", "clients", "requests", "failures", "requests_per_second", "p50_seconds",
+               "p95_seconds", "p99_seconds", "loop_lag_p99_seconds", "loop_lag_max_seconds")
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test POST /grade with a mocked grading backend.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4],
+                        help="uvicorn worker counts to compare")
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds per worker count")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before each run")
+    parser.add_argument("--batches", type=int, default=4, help="Batches per grading request")
+    parser.add_argument("--lines-per-file", type=int, default=200)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Mean fake LLM latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.05)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="Show the server's output")
+    parser.add_argument("--json", help="Write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+
+    with fixture_directory() as directory:
+        repo_dir = os.path.join(directory, "repo")
+        file_names = write_fixture_tree(repo_dir, files=args.batches, lines_per_file=args.lines_per_file)
+        payload = {
+            # Never cloned; the mocked backend grades repo_dir in place
+            "github_link": "https://github.com/benchmark/load-test.git",
+            "rubric": make_rubric(file_names, args.batches)
+        }
+        environment = {
+            **BENCH_ENVIRONMENT,
+            "GRADING_CACHE_BACKEND": "none",
+        "GRADING_REGRADE_DB": "none",
+            "GRADING_JOB_DB": os.path.join(directory, "jobs.db"),
+            "BENCH_REPO_DIR": repo_dir,
+            "BENCH_LLM_LATENCY": str(args.llm_latency),
+            "BENCH_LLM_JITTER": str(args.llm_jitter),
+            "BENCH_LLM_ERROR_RATE": str(args.llm_error_rate)
+        }
+
+        for workers in args.workers:
+            port = _free_port()
+            process = start_server(workers, port, environment, verbose=args.verbose)
+            try:
+                outcome = asyncio.run(drive_load(
+                    f"http://127.0.0.1:{port}", payload, args.clients, args.duration, warmup=args.warmup
+                ))
+            finally:
+                stop_server(process)
+            results.append(summarize(workers, args.clients, outcome))
+
+    _print_table(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -38,3 +38,79 @@ export async function gradeSubmission(payload) {
 
   return data; // This should match GradeResponse from your backend.
 }
+
+/**
+ * Call the FastAPI /grade/stream endpoint and report server-sent events
+ * as they arrive.
+ * onEvent is called as onEvent(eventName, data) for each event:
+ *   clone_complete, batch, token (only when streamTokens is true), done, error
+ * Resolves with the list of batch results, in batch order, once grading ends.
+ */
+export async function gradeSubmissionStream(payload, { onEvent, streamTokens = false } = {}) {
+  const query = streamTokens ? "?stream_tokens=true" : "";
+  const res = await fetch(`${API_BASE_URL}/grade/stream${query}`, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      Accept: "text/event-stream",
+    },
+    body: JSON.stringify(payload),
+  });
+
+  if (!res.ok) {
+    let data = null;
+    try {
+      data = await res.json();
+    } catch {
+      data = null;
+    }
+    const message =
+      (data && typeof data.detail === "string" && data.detail) ||
+      res.statusText ||
+      "Request failed";
+    throw new Error(message);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  const results = [];
+  let buffer = "";
+
+  const handleEvent = (raw) => {
+    let eventName = "message";
+    const dataLines = [];
+    for (const line of raw.split("\n")) {
+      if (line.startsWith("event:")) {
+        eventName = line.slice(6).trim();
+      } else if (line.startsWith("data:")) {
+        dataLines.push(line.slice(5).trim());
+      }
+    }
+    if (!dataLines.length) return;
+
+    const data = JSON.parse(dataLines.join("\n"));
+    if (eventName === "batch") {
+      results[data.batch_number - 1] = data.result;
+    }
+    if (onEvent) onEvent(eventName, data);
+    if (eventName === "error") {
+      throw new Error(data.error || "Grading failed");
+    }
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary = buffer.indexOf("\n\n");
+    while (boundary !== -1) {
+      handleEvent(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf("\n\n");
+    }
+  }
+
+  if (buffer.trim()) handleEvent(buffer);
+  return results;
+}
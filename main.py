@@ -3,13 +3,34 @@ FastAPI Application for AI Code Grading Service
 Main API server that accepts code submissions and returns AI-generated grades
 """
 
-from fastapi import FastAPI, HTTPException, status
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import os
+import json
 import logging
+import argparse
 import uvicorn
-from models.models import GradeRequest, GradeResponse
-from services.agent_service import agent_service_function, AgentService
+from models.models import (
+    GradeRequest,
+    GradeResponse,
+    BulkGradeRequest,
+    BulkGradeResponse,
+    StudentGradeResult,
+    JobSubmitResponse,
+    JobStatusResponse
+)
+from services.agent_service import (
+    agent_service_function,
+    agent_service_function_async,
+    agent_service_stream_async,
+    grade_many_async,
+    AgentService
+)
+from services.job_queue import create_job_queue
+from services.zip_source import ArchiveError, ArchiveTooLarge, read_grading_upload
+from services.metrics import metrics, request_timings, timed
 
 # Configure logging
 logging.basicConfig(
@@ -18,13 +39,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the job workers, and release them and the LLM pool on shutdown."""
+    if grading_service is not None:
+        if os.getenv("GRADING_PRELOAD", "").lower() in ("1", "true", "yes"):
+            # Pay tokenizer and client setup before the worker takes traffic
+            grading_service.warm_up()
+        # Resumes jobs left queued or running by a previous process
+        _get_job_queue().start()
+    yield
+    if job_queue is not None:
+        job_queue.stop(timeout=5)
+    if grading_service is not None:
+        await grading_service.aclose()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="AI Code Grading API",
     description="API for grading code submissions using Azure OpenAI",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # Configure CORS - adjust origins based on your frontend deployment
@@ -41,7 +79,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize grading service
+# Initialize grading service; this instance owns the pooled LLM client
+# shared by every batch and request
 try:
     grading_service = AgentService()
     logger.info("Grading service initialized successfully")
@@ -49,6 +88,51 @@ except Exception as e:
     logger.error(f"Failed to initialize grading service: {str(e)}")
     grading_service = None
 
+# Background job queue, created and started at startup so jobs left queued
+# or running by a previous process resume
+job_queue = None
+
+
+def _get_job_queue():
+    """Return the background job queue, creating it if it does not exist yet."""
+    global job_queue
+    if job_queue is None:
+        job_queue = create_job_queue(_run_grading_job)
+    return job_queue
+
+def _require_grading_service():
+    """Raise 503 if the grading service failed to initialize."""
+    if grading_service is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Grading service is not initialized. Check environment variables."
+        )
+
+
+def _build_grade_response(result):
+    """Convert the grading service's return value into a GradeResponse."""
+    if isinstance(result, list):
+        logger.info(f"Grading completed successfully for {len(result)} batches")
+        return GradeResponse(
+            success=True,
+            analysis=result,
+            error=None
+        )
+    elif isinstance(result, dict) and not result.get("success", True):
+        logger.warning(f"Grading failed: {result.get('error', 'Unknown error')}")
+        return GradeResponse(
+            success=False,
+            analysis=result.get("analysis", result.get("batch_results", [])),
+            error=result.get("error")
+        )
+    else:
+        return GradeResponse(
+            success=True,
+            analysis=result,
+            error=None
+        )
+
+
 @app.post("/grade", response_model=GradeResponse, status_code=status.HTTP_200_OK)
 async def grade_submission(request: GradeRequest):
     """
@@ -64,44 +148,321 @@ async def grade_submission(request: GradeRequest):
         HTTPException: If grading service is unavailable or validation fails
     """
     # Check if grading service is available
-    if grading_service is None:
+    _require_grading_service()
+    
+    try:
+        # Call the grading service without blocking the event loop
+        tests = []
+        with request_timings("grade") as timings:
+            result = await agent_service_function_async(
+                github_link=request.github_link,
+                rubric_json=request.rubric,
+                agent=grading_service,
+                commit=request.commit_sha,
+                test_results=request.test_results,
+                tests_callback=tests.append
+            )
+        
+        response = _build_grade_response(result)
+        response.tests = tests[0] if tests else None
+        if request.include_timings:
+            response.timings = timings.as_dict()
+        return response
+        
+    except Exception as e:
+        logger.error(f"Unexpected error during grading: {str(e)}")
         raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Grading service is not initialized. Check environment variables."
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
         )
+
+
+@app.post("/grade/upload", response_model=GradeResponse, status_code=status.HTTP_200_OK)
+async def grade_upload(request: Request):
+    """
+    Grade a zip archive uploaded as multipart/form-data.
     
+    The form sends a "rubric" field holding the rubric JSON, followed by an
+    "archive" file field. The archive is read as it streams in: only the
+    files named in the batches are inflated, in memory, and nothing is
+    written to disk.
+    
+    Raises:
+        HTTPException: 400 for a malformed form or archive, 413 when the
+            archive exceeds the upload limits, 503 if the service is unavailable
+    """
+    _require_grading_service()
     
     try:
-        # Call the grading service
-        result = agent_service_function(
+        with request_timings("grade_upload"):
+            with timed("upload"):
+                rubric_json, archive = await read_grading_upload(
+                    request.headers.get("content-type", ""), request.stream()
+                )
+            logger.info(f"Read {len(archive.files)} of {len(archive)} archive files named in the batches")
+            result = await agent_service_function_async(
+                github_link=None,
+                rubric_json=rubric_json,
+                agent=grading_service,
+                archive=archive
+            )
+        return _build_grade_response(result)
+        
+    except ArchiveTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ArchiveError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        logger.error(f"Unexpected error during upload grading: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+
+def _format_sse(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/grade/stream")
+async def grade_submission_stream(request: GradeRequest, stream_tokens: bool = False):
+    """
+    Grade a code submission, streaming progress as server-sent events.
+    
+    Emits clone_complete when the repository is ready, batch as each batch
+    result completes, token for each LLM token when stream_tokens is true,
+    tests with the sandboxed test run's summary when test runs are enabled,
+    and finally done or error.
+    
+    Raises:
+        HTTPException: If grading service is unavailable
+    """
+    _require_grading_service()
+    
+    async def stream_events():
+        async for event, data in agent_service_stream_async(
             github_link=request.github_link,
             rubric_json=request.rubric,
-        )
-        
-        # Log the result
-        if isinstance(result, list):
-            logger.info(f"Grading completed successfully for {len(result)} batches")
-            return GradeResponse(
-                success=True,
-                analysis=result,
-                error=None
-            )
-        elif isinstance(result, dict) and not result.get("success", True):
-            logger.warning(f"Grading failed: {result.get('error', 'Unknown error')}")
-            return GradeResponse(**result)
-        else:
-            return GradeResponse(
-                success=True,
-                analysis=result,
-                error=None
-            )
+            agent=grading_service,
+            commit=request.commit_sha,
+            stream_tokens=stream_tokens,
+            test_results=request.test_results
+        ):
+            yield _format_sse(event, data)
+    
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Stop reverse proxies from buffering the stream
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+def _build_student_result(index, github_link, result):
+    """Convert one student's grading result into a StudentGradeResult."""
+    try:
+        response = _build_grade_response(result)
+    except Exception as e:
+        response = GradeResponse(success=False, analysis=[], error=str(e))
+    return StudentGradeResult(index=index, github_link=github_link, **response.model_dump())
+
+
+@app.post("/grade/bulk", response_model=BulkGradeResponse, status_code=status.HTTP_200_OK)
+async def grade_bulk(request: BulkGradeRequest):
+    """
+    Grade every repository in a class roster against one shared rubric.
+    
+    Clones and LLM calls run through the service's global git and LLM limits.
+    With stream=true the response is newline-delimited JSON, one
+    StudentGradeResult per line in completion order; otherwise all results
+    are collected into one BulkGradeResponse in request order.
+    
+    Raises:
+        HTTPException: If grading service is unavailable
+    """
+    _require_grading_service()
+    
+    students = grade_many_async(request.github_links, request.rubric, agent=grading_service)
+    
+    if request.stream:
+        async def stream_results():
+            async for index, github_link, result in students:
+                student = _build_student_result(index, github_link, result)
+                yield json.dumps(student.model_dump()) + "\n"
         
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+    
+    try:
+        results = [
+            _build_student_result(index, github_link, result)
+            async for index, github_link, result in students
+        ]
     except Exception as e:
-        logger.error(f"Unexpected error during grading: {str(e)}")
+        logger.error(f"Unexpected error during bulk grading: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An unexpected error occurred: {str(e)}"
         )
+    
+    results.sort(key=lambda student: student.index)
+    logger.info(f"Bulk grading completed for {len(results)} students")
+    return BulkGradeResponse(
+        success=all(student.success for student in results),
+        results=results
+    )
+
+
+def _run_grading_job(request, report_progress):
+    """Grade a queued GradeRequest on a job worker thread."""
+    grade_request = GradeRequest(**request)
+    progress = {
+        "total_batches": len(grade_request.rubric.get("batches", [])),
+        "completed_batches": 0,
+        "batch_results": []
+    }
+    report_progress(progress)
+    
+    def on_batch(batch_number, total_batches, batch_result):
+        progress["total_batches"] = total_batches
+        progress["completed_batches"] += 1
+        progress["batch_results"].append({
+            "batch_number": batch_number,
+            "success": batch_result.get("success", True),
+            "result": batch_result
+        })
+        report_progress(progress)
+    
+    tests = []
+    with request_timings("job") as timings:
+        result = agent_service_function(
+            github_link=grade_request.github_link,
+            rubric_json=grade_request.rubric,
+            agent=grading_service,
+            commit=grade_request.commit_sha,
+            progress_callback=on_batch,
+            test_results=grade_request.test_results,
+            tests_callback=tests.append
+        )
+    
+    response = _build_grade_response(result)
+    response.tests = tests[0] if tests else None
+    if grade_request.include_timings:
+        response.timings = timings.as_dict()
+    return response.model_dump()
+
+
+@app.post("/jobs", response_model=JobSubmitResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_grading_job(request: GradeRequest):
+    """
+    Queue a grading job and return its id immediately.
+    
+    Poll GET /jobs/{job_id} for progress and the final GradeResponse. Queued
+    jobs are stored in SQLite and survive a server restart.
+    
+    Raises:
+        HTTPException: If grading service is unavailable
+    """
+    _require_grading_service()
+    job_id = _get_job_queue().submit(request.model_dump())
+    logger.info(f"Queued grading job {job_id}")
+    return JobSubmitResponse(job_id=job_id, status="queued")
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_grading_job(job_id: str):
+    """
+    Return the status, per-batch progress and result of a grading job.
+    
+    Raises:
+        HTTPException: If the job does not exist
+    """
+    job = _get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    
+    return JobStatusResponse(
+        job_id=job["job_id"],
+        status=job["status"],
+        progress=job["progress"],
+        result=job["result"],
+        error=job["error"],
+        created_at=job["created_at"],
+        updated_at=job["updated_at"]
+    )
+
+
+def _service_metric_lines():
+    """Prometheus lines for the grading service's caches and LLM deployments."""
+    lines = []
+    
+    if grading_service.result_cache is not None:
+        stats = grading_service.result_cache.stats()
+        lines += [
+            "# HELP grading_result_cache_requests_total Result cache lookups, by outcome",
+            "# TYPE grading_result_cache_requests_total counter",
+            f'grading_result_cache_requests_total{{outcome="hit"}} {stats["hits"]}',
+            f'grading_result_cache_requests_total{{outcome="miss"}} {stats["misses"]}'
+        ]
+    
+    if grading_service.regrade_store is not None:
+        stats = grading_service.regrade_store.stats()
+        lines += [
+            "# HELP grading_regrade_batches_total Batches checked against their last grade, by outcome",
+            "# TYPE grading_regrade_batches_total counter",
+            f'grading_regrade_batches_total{{outcome="reused"}} {stats["reused"]}',
+            f'grading_regrade_batches_total{{outcome="regraded"}} {stats["regraded"]}'
+        ]
+    
+    deployments = grading_service.router.stats()
+    for name, help_text, key in (
+        ("grading_llm_in_flight", "LLM calls currently in flight", "in_flight"),
+        ("grading_llm_latency_seconds", "Moving average LLM call latency", "latency_seconds"),
+        ("grading_llm_cooldown_seconds", "Seconds until a throttled or failing deployment is used again", "cooldown_seconds")
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [
+            f'{name}{{deployment="{deployment["name"]}"}} {deployment[key]}'
+            for deployment in deployments if deployment[key] is not None
+        ]
+    
+    return lines
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Expose pipeline stage latencies, token counts and deployment state in Prometheus format."""
+    extra_lines = _service_metric_lines() if grading_service is not None else []
+    return PlainTextResponse(
+        metrics.render(extra_lines),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/llm/deployments")
+async def llm_deployments():
+    """Report routing state, rate limits and cooldowns for each LLM deployment."""
+    _require_grading_service()
+    
+    return {"deployments": grading_service.router.stats()}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Report result cache hit and miss counts and provider prompt cache usage."""
+    _require_grading_service()
+    
+    prompt_cache = grading_service.usage_stats()
+    if grading_service.result_cache is None:
+        return {"enabled": False, "prompt_cache": prompt_cache}
+    
+    return {"enabled": True, **grading_service.result_cache.stats(), "prompt_cache": prompt_cache}
 
 
 @app.exception_handler(Exception)
@@ -118,13 +479,54 @@ async def global_exception_handler(request, exc):
     )
 
 
-if __name__ == "__main__":
+# State that must be shared once several worker processes serve the app:
+# result cache, LLM rate limits, regrade store and first-request setup
+PRODUCTION_ENVIRONMENT = {
+    "GRADING_CACHE_BACKEND": "sqlite",
+    "GRADING_SHARED_STATE_DB": "grading_state.db",
+    "GRADING_REGRADE_DB": "grading_regrade.db",
+    "GRADING_PRELOAD": "1"
+}
+
+
+def _parse_server_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the AI Code Grading API server.")
+    parser.add_argument(
+        "--prod", action="store_true",
+        default=os.getenv("GRADING_SERVER_MODE", "").lower() == "production",
+        help="Production mode: several workers, no reloader, shared state (or GRADING_SERVER_MODE=production)"
+    )
+    parser.add_argument("--workers", type=int, default=int(os.getenv("GRADING_SERVER_WORKERS", os.cpu_count() or 1)),
+                        help="Worker processes in production mode (default GRADING_SERVER_WORKERS or CPU count)")
+    parser.add_argument("--host", default=os.getenv("GRADING_SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("GRADING_SERVER_PORT", 8000)))
+    return parser.parse_args(argv)
+
+
+def run_server(argv=None):
+    """Start uvicorn with the reloader for development, or with worker processes in production."""
+    args = _parse_server_args(argv)
+    
+    if not args.prod:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True, log_level="info")
+        return
     
-    # Run the server
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+    
+    # Workers inherit this environment, so they all point at the same SQLite files
+    for name, value in PRODUCTION_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+    logger.info(f"Starting production server with {args.workers} worker(s)")
     uvicorn.run(
         "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        log_level="info",
+        proxy_headers=True
     )
+
+
+if __name__ == "__main__":
+    run_server()
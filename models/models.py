@@ -2,7 +2,7 @@
 Pydantic models for API request/response validation
 """
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, Union, List, Any
 
 
@@ -10,7 +10,9 @@ class GradeRequest(BaseModel):
     """Request model for grading submission."""
     github_link: str = Field(..., description="The github link of the students code", min_length=1)
     rubric: dict = Field(..., description="The grading rubric text", min_length=1)
-    test_results: Optional[str] = Field(None, description="Optional test results to include in grading")
+    test_results: Optional[str] = Field(None, description="Optional test output, included in every batch's grading prompt")
+    commit_sha: Optional[str] = Field(None, description="Optional commit SHA to grade instead of the latest commit", pattern=r"^[0-9a-fA-F]{7,40}$")
+    include_timings: bool = Field(False, description="Return per-stage timings and token counts in the response")
     
     model_config = {
         "json_schema_extra": {
@@ -34,6 +36,8 @@ class GradeResponse(BaseModel):
     success: bool = Field(..., description="Whether the grading was successful")
     analysis: list[Any] = Field(..., description="The detailed grading analysis from AI (string or list of batch results)")
     error: Optional[str] = Field(None, description="Error message if grading failed")
+    timings: Optional[dict] = Field(None, description="Per-stage seconds and token counts, when include_timings was set")
+    tests: Optional[dict] = Field(None, description="Summary of the sandboxed run of the repository's tests, when test runs are enabled")
     
     model_config = {
         "json_schema_extra": {
@@ -45,4 +49,92 @@ class GradeResponse(BaseModel):
                 }
             ]
         }
-    }
\ No newline at end of file
+    }
+
+
+class BulkGradeRequest(BaseModel):
+    """Request model for grading a class roster against one rubric."""
+    github_links: List[str] = Field(..., description="The github links of every student's code", min_length=1)
+    rubric: dict = Field(..., description="The grading rubric shared by every student", min_length=1)
+    stream: bool = Field(False, description="Stream one JSON line per student as each finishes")
+    
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "github_links": [
+                        "https://github.com/student1/assignment.git",
+                        "https://github.com/student2/assignment.git"
+                    ],
+                    "rubric": {
+                        "batches" : [["code1.py"], ["code2.py"]],
+                        "rubric" : "grade this like you mean it",
+                        "total_points" : 100
+                    },
+                    "stream": False
+                }
+            ]
+        }
+    }
+
+
+class StudentGradeResult(BaseModel):
+    """Grading result for one student in a bulk request."""
+    index: int = Field(..., description="Position of the link in the request's github_links")
+    github_link: str = Field(..., description="The github link that was graded")
+    success: bool = Field(..., description="Whether the grading was successful")
+    analysis: list[Any] = Field(..., description="The per-batch grading results")
+    error: Optional[str] = Field(None, description="Error message if grading failed")
+
+
+class BulkGradeResponse(BaseModel):
+    """Response model for bulk grading results."""
+    success: bool = Field(..., description="Whether every student was graded successfully")
+    results: List[StudentGradeResult] = Field(..., description="One result per link, in request order")
+
+
+class JobSubmitResponse(BaseModel):
+    """Response model returned when a grading job is queued."""
+    job_id: str = Field(..., description="Identifier to poll at /jobs/{job_id}")
+    status: str = Field(..., description="Job status: queued, running, completed or failed")
+
+
+class JobStatusResponse(BaseModel):
+    """Response model for polling a grading job."""
+    job_id: str = Field(..., description="Identifier of the job")
+    status: str = Field(..., description="Job status: queued, running, completed or failed")
+    progress: dict = Field(default_factory=dict, description="Per-batch progress: total_batches, completed_batches and batch_results")
+    result: Optional[GradeResponse] = Field(None, description="The grading result once the job has completed")
+    error: Optional[str] = Field(None, description="Error message if the job failed")
+    created_at: float = Field(..., description="Unix time the job was queued")
+    updated_at: float = Field(..., description="Unix time the job last changed")
+
+
+class BatchGrade(BaseModel):
+    """Grade the LLM returns for one batch of files."""
+    rubric_score: str = Field(..., description="Points awarded out of total points, e.g. \"5/6\"")
+    hundred_point_score: int = Field(..., description="Score scaled to 0-100")
+    review: str = Field(..., description="One paragraph of feedback stating the points for each criterion")
+    
+    model_config = {"extra": "forbid"}
+    
+    @field_validator("rubric_score", mode="before")
+    @classmethod
+    def _rubric_score_text(cls, value):
+        # Models occasionally return a bare number instead of "points/total"
+        return str(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+    
+    @field_validator("hundred_point_score", mode="before")
+    @classmethod
+    def _round_hundred_point_score(cls, value):
+        if isinstance(value, str):
+            value = value.strip().rstrip("%").strip()
+            try:
+                value = float(value)
+            except ValueError:
+                return value
+        if isinstance(value, float):
+            value = round(value)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return min(100, max(0, value))
+        return value
@@ -0,0 +1,316 @@
+"""
+Token-aware packing of code files into LLM calls.
+
+A user-defined batch is packed into as few prompts as fit a token budget:
+small files share one prompt, while batches or single files that are too
+large are split into chunks. Scores from the chunks are merged back into
+one result for the batch.
+
+Tokens are counted with a tiktoken encoding read from a local directory,
+filled at build time with `python -m services.batch_packer`; the server never
+downloads it. Without it, counts are estimated from the text length.
+"""
+
+import os
+import re
+import json
+import base64
+import threading
+
+
+DEFAULT_TOKEN_BUDGET = 96000
+DEFAULT_TOKENIZER_ENCODING = "o200k_base"
+DEFAULT_TOKENIZER_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           "tokenizer_cache")
+
+# Rough characters-per-token ratio used when tiktoken is unavailable
+_CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_RUBRIC_SCORE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)\s*$")
+
+
+def get_tokenizer_cache_dir():
+    """Directory holding tiktoken encoding files, from GRADING_TOKENIZER_CACHE_DIR."""
+    return os.getenv("GRADING_TOKENIZER_CACHE_DIR", DEFAULT_TOKENIZER_CACHE_DIR)
+
+
+def _encoding_paths(cache_dir, name):
+    """The encoding's BPE ranks file and its parameters file, written last."""
+    return os.path.join(cache_dir, f"{name}.tiktoken"), os.path.join(cache_dir, f"{name}.json")
+
+
+def _write_atomically(path, data):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _load_encoding(name, cache_dir):
+    """Build the encoding from the files in cache_dir, without tiktoken's own download cache."""
+    import tiktoken
+    ranks_path, params_path = _encoding_paths(cache_dir, name)
+    with open(params_path, encoding="utf-8") as f:
+        params = json.load(f)
+
+    # Same "<base64 token> <rank>" format tiktoken downloads
+    mergeable_ranks = {}
+    with open(ranks_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                token, rank = line.split()
+                mergeable_ranks[base64.b64decode(token)] = int(rank)
+
+    return tiktoken.Encoding(
+        name=name,
+        pat_str=params["pat_str"],
+        mergeable_ranks=mergeable_ranks,
+        special_tokens=params["special_tokens"],
+        explicit_n_vocab=params.get("explicit_n_vocab")
+    )
+
+
+def _get_encoding():
+    """Load the local tiktoken encoding once, or return None if unavailable."""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                name = os.getenv("GRADING_TOKENIZER_ENCODING", DEFAULT_TOKENIZER_ENCODING)
+                cache_dir = get_tokenizer_cache_dir()
+                try:
+                    if not os.path.exists(_encoding_paths(cache_dir, name)[1]):
+                        raise FileNotFoundError(
+                            f"{name} is not in {cache_dir}; run `python -m services.batch_packer`"
+                        )
+                    _encoding = _load_encoding(name, cache_dir)
+                except Exception as e:
+                    print(f"Warning: tiktoken unavailable ({e}), estimating token counts")
+                    _encoding = False
+    return _encoding or None
+
+
+def download_encoding(name=None, cache_dir=None):
+    """
+    Download a tiktoken encoding into the tokenizer cache, for build time.
+
+    Returns:
+        str: The cache directory
+    """
+    from tiktoken_ext.openai_public import ENCODING_CONSTRUCTORS
+
+    name = name or os.getenv("GRADING_TOKENIZER_ENCODING", DEFAULT_TOKENIZER_ENCODING)
+    cache_dir = cache_dir or get_tokenizer_cache_dir()
+    if name not in ENCODING_CONSTRUCTORS:
+        raise ValueError(f"Unknown tokenizer encoding '{name}'")
+    params = ENCODING_CONSTRUCTORS[name]()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    ranks_path, params_path = _encoding_paths(cache_dir, name)
+    ranks = sorted(params["mergeable_ranks"].items(), key=lambda item: item[1])
+    _write_atomically(ranks_path, b"".join(
+        base64.b64encode(token) + f" {rank}\n".encode("ascii") for token, rank in ranks
+    ))
+    # The parameters file marks the encoding as complete, so it is written last
+    _write_atomically(params_path, json.dumps({
+        "pat_str": params["pat_str"],
+        "special_tokens": params["special_tokens"],
+        "explicit_n_vocab": params.get("explicit_n_vocab")
+    }).encode("utf-8"))
+    return cache_dir
+
+
+def count_tokens(text):
+    """Count the tokens in text with the local tokenizer."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def get_token_budget():
+    """Prompt token budget from GRADING_TOKEN_BUDGET."""
+    budget = int(os.getenv("GRADING_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+    if budget < 1:
+        raise ValueError("GRADING_TOKEN_BUDGET must be at least 1")
+    return budget
+
+
+def _split_text(text, max_tokens):
+    """Split text into pieces of at most max_tokens, on line boundaries when possible."""
+    pieces = []
+    current = []
+    current_tokens = 0
+
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+
+        if line_tokens > max_tokens:
+            # A single huge line (e.g. minified code) is cut by characters
+            if current:
+                pieces.append("".join(current))
+                current, current_tokens = [], 0
+            step = max(1, max_tokens * _CHARS_PER_TOKEN // 2)
+            for start in range(0, len(line), step):
+                pieces.extend(_split_text_by_chars(line[start:start + step], max_tokens))
+            continue
+
+        if current and current_tokens + line_tokens > max_tokens:
+            pieces.append("".join(current))
+            current, current_tokens = [], 0
+
+        current.append(line)
+        current_tokens += line_tokens
+
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+
+def _split_text_by_chars(text, max_tokens):
+    """Halve text until every piece fits max_tokens."""
+    if count_tokens(text) <= max_tokens or len(text) <= 1:
+        return [text]
+    middle = len(text) // 2
+    return _split_text_by_chars(text[:middle], max_tokens) + _split_text_by_chars(text[middle:], max_tokens)
+
+
+def pack_code_files(code_files, format_code, render_prompt, token_budget):
+    """
+    Pack loaded code files into chunks whose rendered prompts fit token_budget.
+
+    Args:
+        code_files (dict): Filename to content, in batch order
+        format_code (callable): Formats a {filename: content} dict as prompt code
+        render_prompt (callable): Renders the full prompt for formatted code
+        token_budget (int): Maximum prompt tokens per chunk
+
+    Returns:
+        list: Chunks as {filename: content} dicts. Files split across chunks
+            are named "filename (part i/n)".
+    """
+    overhead = count_tokens(render_prompt(""))
+    available = token_budget - overhead
+    if available < 1:
+        raise Exception(
+            f"Token budget of {token_budget} is smaller than the prompt without code ({overhead} tokens)"
+        )
+
+    # Split files that cannot fit in a prompt on their own
+    pieces = []
+    for filename, content in code_files.items():
+        if count_tokens(format_code({filename: content})) <= available:
+            pieces.append((filename, content))
+            continue
+
+        # Leave room for the per-file header added by format_code
+        header_tokens = count_tokens(format_code({f"{filename} (part 1/1)": ""}))
+        parts = _split_text(content, max(1, available - header_tokens))
+        print(f"Splitting '{filename}' into {len(parts)} parts to fit the token budget")
+        for index, part in enumerate(parts, 1):
+            pieces.append((f"{filename} (part {index}/{len(parts)})", part))
+
+    # Greedily merge pieces into as few prompts as fit. Sections are counted
+    # separately, plus a token for the separator between them
+    chunks = []
+    current = {}
+    current_tokens = 0
+    for name, content in pieces:
+        piece_tokens = count_tokens(format_code({name: content})) + 1
+        if current and current_tokens + piece_tokens > available:
+            chunks.append(current)
+            current, current_tokens = {}, 0
+        current[name] = content
+        current_tokens += piece_tokens
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _parse_rubric_score(rubric_score):
+    if not isinstance(rubric_score, str):
+        return None
+    match = _RUBRIC_SCORE_PATTERN.match(rubric_score)
+    if not match:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def _format_number(value):
+    value = round(value, 1)
+    return str(int(value)) if value == int(value) else str(value)
+
+
+def merge_chunk_results(chunk_results, weights, chunk_files, file_batch):
+    """
+    Merge per-chunk grades into one result for a user-defined batch.
+
+    Scores are averaged weighted by each chunk's token count, and the reviews
+    are joined into one paragraph labelled by part.
+
+    Args:
+        chunk_results (list): Result dict for each chunk
+        weights (list): Token count of each chunk's code
+        chunk_files (list): File names graded in each chunk
+        file_batch (list): The batch's original file entries
+
+    Returns:
+        dict: Merged batch result
+    """
+    graded = [
+        (result, weight, files)
+        for result, weight, files in zip(chunk_results, weights, chunk_files)
+        if isinstance(result.get("hundred_point_score"), (int, float))
+    ]
+    failed = [
+        {"files": files, "error": result.get("analysis_result") or result.get("overall_score")}
+        for result, files in zip(chunk_results, chunk_files)
+        if not isinstance(result.get("hundred_point_score"), (int, float))
+    ]
+
+    if not graded:
+        merged = dict(chunk_results[0])
+        merged["file_name"] = file_batch
+        merged["chunk_errors"] = failed
+        return merged
+
+    total_weight = sum(max(weight, 1) for _, weight, _ in graded)
+    hundred_point_score = round(
+        sum(result["hundred_point_score"] * max(weight, 1) for result, weight, _ in graded) / total_weight
+    )
+
+    rubric_scores = [_parse_rubric_score(result.get("rubric_score")) for result, _, _ in graded]
+    if all(rubric_scores) and len({total for _, total in rubric_scores}) == 1:
+        points = sum(
+            score[0] * max(weight, 1) for score, (_, weight, _) in zip(rubric_scores, graded)
+        ) / total_weight
+        rubric_score = f"{_format_number(points)}/{_format_number(rubric_scores[0][1])}"
+    else:
+        rubric_score = graded[0][0].get("rubric_score")
+
+    review = " ".join(
+        f"Part {index} ({', '.join(files)}): {result.get('review', '')}"
+        for index, (result, _, files) in enumerate(graded, 1)
+    )
+
+    usages = [result["usage"] for result in chunk_results if isinstance(result.get("usage"), dict)]
+
+    merged = {
+        "rubric_score": rubric_score,
+        "hundred_point_score": hundred_point_score,
+        "review": review,
+        "file_name": file_batch,
+        "chunks": len(chunk_results)
+    }
+    if usages:
+        merged["usage"] = {key: sum(usage.get(key, 0) for usage in usages) for key in usages[0]}
+    if failed:
+        merged["chunk_errors"] = failed
+    return merged
+
+
+if __name__ == "__main__":
+    print(f"Tokenizer cached in {download_encoding()}")
@@ -0,0 +1,112 @@
+"""
+One-pass index of the files in a cloned repository.
+
+The index is built once per grading request and shared by every batch, so
+resolving a rubric's file names costs a dictionary lookup instead of a walk
+of the whole tree. Vendored and generated directories are left out of the
+index, and a name that matches several files is reported instead of
+silently resolving to whichever the walk happened to find first.
+"""
+
+import os
+import posixpath
+
+
+# Directories that hold dependencies, tooling or build output rather than
+# student code. Files inside them can still be named by their full path.
+IGNORED_DIRS = frozenset({
+    ".git", ".hg", ".svn",
+    "node_modules", "bower_components",
+    ".venv", "venv", "env", ".env", "virtualenv",
+    "__pycache__", ".pytest_cache", ".mypy_cache", ".ruff_cache", ".tox", ".nox",
+    "site-packages", ".eggs",
+    ".idea", ".vscode",
+    "dist", "build", "target", ".gradle", ".next", ".nuxt"
+})
+
+
+def _normalize_entry(entry):
+    """Normalize a rubric file entry to a relative POSIX path, or "" if empty."""
+    entry = posixpath.normpath(entry.strip().replace("\\", "/")).lstrip("/")
+    return "" if entry == "." else entry
+
+
+def _is_ignored(path):
+    return any(part in IGNORED_DIRS or part.endswith(".egg-info") for part in path.split("/")[:-1])
+
+
+class RepoFileIndex:
+    """Lookup of repository files by exact path, path suffix and basename."""
+
+    def __init__(self, paths, root=None):
+        """
+        Args:
+            paths (iterable): Relative POSIX paths of every file in the tree
+            root (str, optional): Directory the paths are relative to. When set,
+                exact paths are also checked on disk.
+        """
+        self.root = root
+        self._paths = set()
+        self._by_basename = {}
+        for path in paths:
+            self._paths.add(path)
+            if not _is_ignored(path):
+                self._by_basename.setdefault(posixpath.basename(path), []).append(path)
+
+        for candidates in self._by_basename.values():
+            # Shallowest first, so an ambiguous name prefers the top-level file
+            candidates.sort(key=lambda path: (path.count("/"), path))
+
+    @classmethod
+    def build(cls, root):
+        """Index the files under root in a single walk, skipping ignored directories."""
+        paths = []
+        for current, dirs, files in os.walk(root):
+            dirs[:] = [name for name in dirs if name not in IGNORED_DIRS and not name.endswith(".egg-info")]
+            relative_dir = os.path.relpath(current, root)
+            for name in files:
+                path = name if relative_dir == "." else os.path.join(relative_dir, name)
+                paths.append(path.replace(os.sep, "/"))
+        return cls(paths, root=root)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def candidates(self, entry):
+        """
+        Return every indexed path an entry could refer to.
+
+        A full path matches exactly. Otherwise the entry matches paths ending in
+        it, and a bare name with no suffix match falls back to its basename.
+        """
+        entry = _normalize_entry(entry)
+        if not entry:
+            return []
+        if entry in self._paths:
+            return [entry]
+        if self.root is not None and os.path.isfile(os.path.join(self.root, entry)):
+            return [entry]
+
+        by_basename = self._by_basename.get(posixpath.basename(entry), [])
+        suffix = "/" + entry
+        matches = [path for path in by_basename if path.endswith(suffix)]
+        return matches or list(by_basename)
+
+    def resolve(self, entry):
+        """
+        Resolve an entry to a single path.
+
+        Returns:
+            tuple: (path, warning). path is None when nothing matches. warning
+                describes a missing or ambiguous match and is None otherwise;
+                ambiguous entries resolve to the shallowest candidate.
+        """
+        matches = self.candidates(entry)
+        if not matches:
+            return None, f"File '{entry}' not found in repository"
+        if len(matches) > 1:
+            return matches[0], (
+                f"File '{entry}' is ambiguous, it matches {len(matches)} files "
+                f"({', '.join(matches)}); using '{matches[0]}'. List the full path to choose another."
+            )
+        return matches[0], None
@@ -0,0 +1,121 @@
+"""
+Memory-bounded loading of student files for grading prompts.
+
+A file's size is checked before anything is read. A small sniff from its
+start decides whether it is binary or minified, and those files are skipped
+without being read further. Files over the size cap are memory-mapped and
+only a head and a tail window are copied out, so a 200 MB file committed
+under a requested name costs no more memory, or prompt, than the cap.
+"""
+
+import os
+import mmap
+
+
+DEFAULT_MAX_FILE_BYTES = 256 * 1024
+
+# Bytes from the start of a file used to detect binary or minified content
+SNIFF_BYTES = 8192
+
+# Share of a truncated file's budget kept from its end; the rest is its start
+TAIL_FRACTION = 0.25
+
+# A sniff that is mostly bytes outside this set is binary
+_TEXT_BYTES = bytes(sorted({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f}))
+MAX_NON_TEXT_RATIO = 0.3
+
+# Average characters per line above which source is treated as minified
+MINIFIED_LINE_LENGTH = 500
+
+
+def get_max_file_bytes():
+    """Largest number of bytes read from one file, from GRADING_MAX_FILE_BYTES."""
+    return int(os.getenv("GRADING_MAX_FILE_BYTES", DEFAULT_MAX_FILE_BYTES))
+
+
+def sniff_content(sample):
+    """
+    Classify the first bytes of a file.
+
+    Returns:
+        str or None: "binary" or "minified" when the file should not be
+            graded, else None
+    """
+    if not sample:
+        return None
+    if b"\0" in sample:
+        return "binary"
+    if len(sample.translate(None, _TEXT_BYTES)) / len(sample) > MAX_NON_TEXT_RATIO:
+        return "binary"
+    if len(sample) >= 1024 and len(sample) / (sample.count(b"\n") + 1) > MINIFIED_LINE_LENGTH:
+        return "minified"
+    return None
+
+
+def _decode(data):
+    return data.decode("utf-8", errors="ignore")
+
+
+def _head_and_tail(data, size, max_bytes):
+    """Keep the start and end of an oversized file, cut at line boundaries."""
+    tail_bytes = int(max_bytes * TAIL_FRACTION)
+    head = data[:max_bytes - tail_bytes]
+    tail = data[size - tail_bytes:] if tail_bytes else b""
+
+    # Drop the partial lines at the cut so no line is shown half-finished
+    if b"\n" in head:
+        head = head[:head.rindex(b"\n") + 1]
+    if b"\n" in tail:
+        tail = tail[tail.index(b"\n") + 1:]
+
+    omitted = size - len(head) - len(tail)
+    return f"{_decode(head)}\n... [{omitted} bytes omitted] ...\n{_decode(tail)}", len(head) + len(tail)
+
+
+def load_code_bytes(data, max_bytes=None):
+    """
+    Decode a file already in memory, applying the same checks as read_code_file.
+
+    Returns:
+        tuple: See read_code_file
+    """
+    max_bytes = max_bytes or get_max_file_bytes()
+    size = len(data)
+    reason = sniff_content(data[:SNIFF_BYTES])
+    if reason:
+        return None, {"status": "skipped", "reason": reason, "size_bytes": size}
+    if size <= max_bytes:
+        return _decode(data), None
+
+    content, kept = _head_and_tail(data, size, max_bytes)
+    return content, {"status": "truncated", "size_bytes": size, "kept_bytes": kept}
+
+
+def read_code_file(path, max_bytes=None):
+    """
+    Read a source file for grading without ever holding more than max_bytes of it.
+
+    Args:
+        path (str): File to read
+        max_bytes (int, optional): Defaults to GRADING_MAX_FILE_BYTES
+
+    Returns:
+        tuple: (content, note). content is the text to grade, or None when the
+            file was skipped. note is None for a file read in full, or a dict
+            with "status" ("skipped" or "truncated"), "size_bytes" and either
+            "reason" or "kept_bytes".
+    """
+    max_bytes = max_bytes or get_max_file_bytes()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= max_bytes:
+            # Bounded even if the file grew since it was sized
+            return load_code_bytes(f.read(max_bytes + 1), max_bytes)
+
+        # Only the sniffed and kept pages of the mapping are ever read
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            reason = sniff_content(mapped[:SNIFF_BYTES])
+            if reason:
+                return None, {"status": "skipped", "reason": reason, "size_bytes": size}
+            content, kept = _head_and_tail(mapped, size, max_bytes)
+    return content, {"status": "truncated", "size_bytes": size, "kept_bytes": kept}
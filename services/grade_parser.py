@@ -0,0 +1,188 @@
+"""
+Parsing of LLM grading responses into BatchGrade models.
+
+Responses are requested in structured-output mode, so the fast path is a
+single pydantic-core validation of the raw text. Responses that still come
+back malformed (code fences, trailing commas, literal newlines in strings,
+truncated output) are repaired locally instead of being sent for another
+LLM call.
+"""
+
+import os
+import re
+import json
+
+from pydantic import ValidationError
+
+from models.models import BatchGrade
+
+
+_FENCE_PATTERN = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+_TRAILING_COMMA_PATTERN = re.compile(r",(\s*[}\]])")
+_RUBRIC_SCORE_PATTERN = re.compile(
+    r"[\"']?rubric_score[\"']?\s*:\s*[\"']?\s*(\d+(?:\.\d+)?\s*/\s*\d+(?:\.\d+)?)"
+)
+_HUNDRED_POINT_PATTERN = re.compile(r"[\"']?hundred_point_score[\"']?\s*:\s*[\"']?\s*(\d+(?:\.\d+)?)")
+_REVIEW_PATTERN = re.compile(r"[\"']?review[\"']?\s*:\s*\"((?:[^\"\\]|\\.)*)(?:\"|$)", re.DOTALL)
+_POINTS_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)\s*$")
+
+
+class GradeParseError(ValueError):
+    """Raised when a response cannot be turned into a BatchGrade."""
+
+
+def response_format():
+    """
+    The response_format to request from the LLM, set by GRADING_RESPONSE_FORMAT.
+
+    "json_schema" (default) requests structured output matching BatchGrade,
+    "json_object" requests plain JSON mode for deployments without structured
+    outputs, and "none" sends no response_format.
+    """
+    mode = os.getenv("GRADING_RESPONSE_FORMAT", "json_schema").lower()
+    if mode == "none":
+        return None
+    if mode == "json_object":
+        return {"type": "json_object"}
+    if mode == "json_schema":
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "batch_grade",
+                "strict": True,
+                "schema": BatchGrade.model_json_schema()
+            }
+        }
+    raise ValueError(f"Unknown GRADING_RESPONSE_FORMAT: {mode}")
+
+
+def _extract_object(text):
+    """Return the first {...} object in text, closing it if the output was cut off."""
+    start = text.find("{")
+    if start == -1:
+        return text
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+
+    # Truncated: close the open string and objects
+    return text[start:] + ('"' if in_string else "") + "}" * depth
+
+
+def _escape_control_characters(text):
+    """Escape raw newlines and tabs that appear inside JSON strings."""
+    repaired = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            elif char == "\n":
+                char = "\\n"
+            elif char == "\r":
+                char = "\\r"
+            elif char == "\t":
+                char = "\\t"
+        elif char == '"':
+            in_string = True
+        repaired.append(char)
+    return "".join(repaired)
+
+
+def _hundred_point_from_rubric(rubric_score):
+    match = _POINTS_PATTERN.match(str(rubric_score))
+    if not match or float(match.group(2)) == 0:
+        return None
+    return round(float(match.group(1)) / float(match.group(2)) * 100)
+
+
+def _validate(data):
+    if isinstance(data, dict):
+        # Drop extra keys and fill a missing 0-100 score from "points/total"
+        data = {key: data[key] for key in BatchGrade.model_fields if key in data}
+        if "hundred_point_score" not in data and "rubric_score" in data:
+            score = _hundred_point_from_rubric(data["rubric_score"])
+            if score is not None:
+                data["hundred_point_score"] = score
+    return BatchGrade.model_validate(data)
+
+
+def _repair_json(text):
+    candidate = _FENCE_PATTERN.sub("", text.strip())
+    candidate = _extract_object(candidate)
+    candidate = _escape_control_characters(candidate)
+    candidate = _TRAILING_COMMA_PATTERN.sub(r"\1", candidate)
+    return _validate(json.loads(candidate))
+
+
+def _extract_fields(text):
+    """Last resort: pull the three fields out of text that is not valid JSON."""
+    data = {}
+    rubric_match = _RUBRIC_SCORE_PATTERN.search(text)
+    if rubric_match:
+        data["rubric_score"] = re.sub(r"\s+", "", rubric_match.group(1))
+    hundred_match = _HUNDRED_POINT_PATTERN.search(text)
+    if hundred_match:
+        data["hundred_point_score"] = hundred_match.group(1)
+    review_match = _REVIEW_PATTERN.search(text)
+    if review_match:
+        try:
+            data["review"] = json.loads('"' + review_match.group(1) + '"')
+        except json.JSONDecodeError:
+            data["review"] = review_match.group(1)
+    return _validate(data)
+
+
+def parse_grade(text):
+    """
+    Parse an LLM response into a BatchGrade.
+
+    Args:
+        text (str): Raw response content
+
+    Returns:
+        BatchGrade: The validated grade
+
+    Raises:
+        GradeParseError: If the response cannot be parsed even after repair
+    """
+    if not isinstance(text, str):
+        raise GradeParseError("Response content is not text")
+
+    try:
+        return BatchGrade.model_validate_json(text)
+    except ValidationError:
+        pass
+
+    for repair in (_repair_json, _extract_fields):
+        try:
+            grade = repair(text)
+        except (ValueError, ValidationError):
+            continue
+        print(f"Repaired malformed grading response with {repair.__name__.lstrip('_')}")
+        return grade
+
+    raise GradeParseError("Response is not a valid grade")
@@ -0,0 +1,276 @@
+"""
+Durable background job queue for long-running gradings.
+
+Jobs live in a SQLite table so queued work survives a restart. Worker
+threads claim jobs with a time-limited lease that is renewed while the job
+runs; a job whose worker died is picked up again once its lease expires.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+
+DEFAULT_JOB_DB_PATH = "grading_jobs.db"
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_LEASE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+
+class JobStore:
+    """SQLite-backed table of grading jobs."""
+
+    def __init__(self, path=DEFAULT_JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    progress TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_expires_at REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        (job_id, status, request, progress, result, error,
+         attempts, lease_expires_at, created_at, updated_at) = row
+        return {
+            "job_id": job_id,
+            "status": status,
+            "request": json.loads(request),
+            "progress": json.loads(progress),
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "attempts": attempts,
+            "lease_expires_at": lease_expires_at,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+
+    def create(self, request):
+        """Insert a queued job for a JSON-serializable request and return its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, request, progress, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, json.dumps(request), json.dumps({}), now, now)
+            )
+        return job_id
+
+    def get(self, job_id):
+        """Return a job as a dict, or None if it does not exist."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, request, progress, result, error, attempts, lease_expires_at, "
+                "created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        return self._row_to_job(row)
+
+    def claim_next(self, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Atomically claim the oldest runnable job.
+
+        Runnable jobs are queued ones and running ones whose lease has expired.
+        Jobs that have already been attempted max_attempts times are failed.
+
+        Returns:
+            dict or None: The claimed job
+        """
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock so two workers (or processes)
+            # can never claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, updated_at = ? "
+                    "WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                    (JOB_FAILED, "Job abandoned after repeated worker failures", now,
+                     JOB_RUNNING, now, max_attempts)
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_expires_at < ?) "
+                    "ORDER BY created_at LIMIT 1",
+                    (JOB_QUEUED, JOB_RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    (JOB_RUNNING, now + lease_seconds, now, row[0])
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return self.get(row[0])
+
+    def heartbeat(self, job_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend the lease of a running job."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ?",
+                (time.time() + lease_seconds, job_id, JOB_RUNNING)
+            )
+
+    def update_progress(self, job_id, progress):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(progress), time.time(), job_id)
+            )
+
+    def complete(self, job_id, result):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                (JOB_COMPLETED, json.dumps(result), time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                (JOB_FAILED, error, time.time(), job_id)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobQueue:
+    """Pool of worker threads running jobs from a JobStore."""
+
+    def __init__(self, store, handler, workers=DEFAULT_JOB_WORKERS, poll_interval=1.0,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Args:
+            store (JobStore): Durable job table
+            handler (callable): handler(request, progress_callback) -> JSON-serializable
+                result. progress_callback(progress_dict) records progress.
+            workers (int): Number of worker threads
+            poll_interval (float): Seconds between checks for new or abandoned jobs
+            lease_seconds (float): How long a claim lasts without a heartbeat
+            max_attempts (int): Claims allowed before an abandoned job is failed
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads; queued and abandoned jobs are resumed."""
+        if self._threads:
+            return
+        self._stop.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"grading-job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Ask workers to stop after their current job and wait for them."""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, request):
+        """Queue a job and return its id."""
+        job_id = self.store.create(request)
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            job = self.store.claim_next(self.lease_seconds, self.max_attempts)
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        job_id = job["job_id"]
+        done = threading.Event()
+
+        def keep_lease():
+            # Renew well before expiry so long LLM calls don't lose the claim
+            while not done.wait(self.lease_seconds / 3):
+                self.store.heartbeat(job_id, self.lease_seconds)
+
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
+
+        try:
+            print(f"Running grading job {job_id} (attempt {job['attempts']})")
+            result = self.handler(
+                job["request"],
+                lambda progress: self.store.update_progress(job_id, progress)
+            )
+            self.store.complete(job_id, result)
+            print(f"Grading job {job_id} completed")
+        except Exception as e:
+            print(f"Grading job {job_id} failed: {str(e)}")
+            self.store.fail(job_id, str(e))
+        finally:
+            done.set()
+            heartbeat.join()
+
+
+def create_job_queue(handler):
+    """
+    Create a job queue configured by environment variables.
+
+    GRADING_JOB_DB sets the SQLite file, GRADING_JOB_WORKERS the number of
+    worker threads and GRADING_JOB_LEASE_SECONDS the claim lease.
+    """
+    store = JobStore(os.getenv("GRADING_JOB_DB", DEFAULT_JOB_DB_PATH))
+    return JobQueue(
+        store,
+        handler,
+        workers=int(os.getenv("GRADING_JOB_WORKERS", DEFAULT_JOB_WORKERS)),
+        lease_seconds=float(os.getenv("GRADING_JOB_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
+    )
@@ -0,0 +1,241 @@
+"""
+Routing of LLM calls across several Azure OpenAI deployments.
+
+Deployments are configured with AZURE_OPENAI_DEPLOYMENTS, a JSON list, or fall
+back to the single AZURE_OPENAI_* deployment. Each call goes to a deployment
+picked at random in proportion to its weight, the share of its rate limit
+still free and its recent latency. A deployment that is throttled or failing
+is put in a cooldown and traffic fails over to the others until it recovers.
+"""
+
+import os
+import json
+import time
+import random
+import threading
+
+import openai
+
+from services.rate_limiter import create_rate_limiter
+
+
+DEFAULT_API_VERSION = "2024-10-21"
+
+# Cooldown for a deployment that returned 5xx or could not be reached; doubles
+# with each consecutive failure up to the maximum
+DEFAULT_FAILURE_COOLDOWN_SECONDS = 5.0
+MAX_FAILURE_COOLDOWN_SECONDS = 120.0
+
+# Weight of the latest call in the latency moving average
+_LATENCY_SMOOTHING = 0.3
+
+# Floor on the free-capacity share so a drained deployment keeps a small chance
+_MIN_CAPACITY_SHARE = 0.05
+
+
+class Deployment:
+    """One Azure OpenAI deployment and its routing state."""
+
+    def __init__(self, name, endpoint, deployment_name, api_key, api_version=DEFAULT_API_VERSION,
+                 weight=1.0, requests_per_minute=None, tokens_per_minute=None):
+        if weight <= 0:
+            raise ValueError(f"Deployment '{name}' weight must be positive")
+
+        self.name = name
+        self.endpoint = endpoint
+        self.deployment_name = deployment_name
+        self.api_key = api_key
+        self.api_version = api_version
+        self.weight = float(weight)
+        # Keyed by endpoint and deployment, the scope of an Azure quota
+        self.limiter = create_rate_limiter(
+            f"{deployment_name}@{endpoint}",
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute
+        )
+        self.latency = None
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+
+class LLMRouter:
+    """Chooses a deployment for each LLM call and tracks deployment health."""
+
+    def __init__(self, deployments, clock=time.monotonic):
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        names = [deployment.name for deployment in deployments]
+        if len(set(names)) != len(names):
+            raise ValueError("Deployment names must be unique")
+
+        self.deployments = list(deployments)
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self):
+        return self.deployments[0]
+
+    def cache_identity(self):
+        """Model identity for result cache keys: the set of deployment names."""
+        return ",".join(sorted({deployment.deployment_name for deployment in self.deployments}))
+
+    def _score(self, deployment, mean_latency, capacity_share):
+        latency = deployment.latency if deployment.latency is not None else mean_latency
+        capacity = max(capacity_share, _MIN_CAPACITY_SHARE)
+        return deployment.weight * capacity / (latency or 1.0) / (1 + deployment.in_flight)
+
+    def acquire(self):
+        """
+        Pick a deployment for one call and count it as in flight.
+
+        Deployments in cooldown are skipped; when all are cooling down the one
+        that recovers first is used. Pair with release().
+        """
+        # Read before taking the lock: a shared limiter reads them from disk
+        shares = {deployment.name: deployment.limiter.capacity_share() for deployment in self.deployments}
+        with self._lock:
+            now = self._clock()
+            available = [d for d in self.deployments if d.cooldown_until <= now]
+            if not available:
+                chosen = min(self.deployments, key=lambda d: d.cooldown_until)
+            else:
+                latencies = [d.latency for d in available if d.latency is not None]
+                mean_latency = sum(latencies) / len(latencies) if latencies else None
+                scores = [self._score(d, mean_latency, shares[d.name]) for d in available]
+                chosen = random.choices(available, weights=scores)[0]
+            chosen.in_flight += 1
+            chosen.calls += 1
+            return chosen
+
+    def release(self, deployment, latency=None, error=None, cooldown=None):
+        """
+        Record the outcome of a call started with acquire().
+
+        Args:
+            deployment (Deployment): The deployment that served the call
+            latency (float, optional): Seconds the successful call took
+            error (Exception, optional): The error the call failed with
+            cooldown (float, optional): Seconds to avoid the deployment after a
+                throttled call, usually the server's retry-after
+        """
+        with self._lock:
+            deployment.in_flight = max(0, deployment.in_flight - 1)
+            if error is None:
+                deployment.failures = 0
+                if latency is not None:
+                    deployment.latency = latency if deployment.latency is None else (
+                        _LATENCY_SMOOTHING * latency + (1 - _LATENCY_SMOOTHING) * deployment.latency
+                    )
+                return
+
+            deployment.errors += 1
+            if isinstance(error, openai.RateLimitError):
+                seconds = cooldown or DEFAULT_FAILURE_COOLDOWN_SECONDS
+            elif _is_outage(error):
+                deployment.failures += 1
+                seconds = min(
+                    MAX_FAILURE_COOLDOWN_SECONDS,
+                    DEFAULT_FAILURE_COOLDOWN_SECONDS * (2 ** (deployment.failures - 1))
+                )
+            else:
+                return
+            deployment.cooldown_until = max(deployment.cooldown_until, self._clock() + seconds)
+            print(f"Deployment '{deployment.name}' cooling down for {seconds:.1f}s after {type(error).__name__}")
+
+    def has_available(self, exclude=None):
+        """Return True if a deployment other than exclude is out of cooldown."""
+        with self._lock:
+            now = self._clock()
+            return any(d is not exclude and d.cooldown_until <= now for d in self.deployments)
+
+    def stats(self):
+        with self._lock:
+            now = self._clock()
+            return [
+                {
+                    "name": d.name,
+                    "deployment": d.deployment_name,
+                    "weight": d.weight,
+                    "in_flight": d.in_flight,
+                    "calls": d.calls,
+                    "errors": d.errors,
+                    "latency_seconds": round(d.latency, 3) if d.latency is not None else None,
+                    "cooldown_seconds": round(max(0.0, d.cooldown_until - now), 3),
+                    **d.limiter.stats()
+                }
+                for d in self.deployments
+            ]
+
+
+def _is_outage(error):
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _optional_int(value):
+    return int(value) if value not in (None, "") else None
+
+
+def load_deployments():
+    """
+    Read deployments from AZURE_OPENAI_DEPLOYMENTS, or the single AZURE_OPENAI_* one.
+
+    AZURE_OPENAI_DEPLOYMENTS is a JSON list of objects with "endpoint" and
+    "deployment" and optionally "name", "api_key" (or "api_key_env" naming an
+    environment variable), "api_version", "weight", "rpm_limit" and
+    "tpm_limit". Missing keys default to the AZURE_OPENAI_* variables.
+    """
+    default_key = os.getenv("AZURE_OPENAI_API_KEY")
+    default_version = os.getenv("AZURE_OPENAI_API_VERSION", DEFAULT_API_VERSION)
+    raw = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+
+    if not raw:
+        return [Deployment(
+            name="default",
+            endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            deployment_name=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            api_key=default_key,
+            api_version=default_version,
+            requests_per_minute=_optional_int(os.getenv("AZURE_OPENAI_RPM_LIMIT")),
+            tokens_per_minute=_optional_int(os.getenv("AZURE_OPENAI_TPM_LIMIT"))
+        )]
+
+    try:
+        entries = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"AZURE_OPENAI_DEPLOYMENTS is not valid JSON: {e}")
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("AZURE_OPENAI_DEPLOYMENTS must be a non-empty JSON list")
+
+    deployments = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError("Each AZURE_OPENAI_DEPLOYMENTS entry must be an object")
+        endpoint = entry.get("endpoint") or os.getenv("AZURE_OPENAI_ENDPOINT")
+        deployment_name = entry.get("deployment") or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+        api_key = entry.get("api_key") or (os.getenv(entry["api_key_env"]) if entry.get("api_key_env") else default_key)
+        name = entry.get("name") or f"{deployment_name}@{endpoint}"
+        if not endpoint or not deployment_name or not api_key:
+            raise ValueError(f"Deployment {index} in AZURE_OPENAI_DEPLOYMENTS needs an endpoint, deployment and API key")
+
+        deployments.append(Deployment(
+            name=name,
+            endpoint=endpoint,
+            deployment_name=deployment_name,
+            api_key=api_key,
+            api_version=entry.get("api_version") or default_version,
+            weight=float(entry.get("weight", 1.0)),
+            requests_per_minute=_optional_int(entry.get("rpm_limit")),
+            tokens_per_minute=_optional_int(entry.get("tpm_limit"))
+        ))
+    return deployments
+
+
+def create_llm_router():
+    """Create the router for the deployments configured in the environment."""
+    return LLMRouter(load_deployments())
@@ -0,0 +1,206 @@
+"""
+Latency and token instrumentation for the grading pipeline.
+
+Each pipeline stage (clone or upload, index, checkout, load, analysis,
+prompt, llm_wait, llm, parse, and tests when they run) is timed with timed().
+Timings feed process-wide Prometheus histograms served at /metrics, and,
+inside a request_timings() block, a per-request breakdown that /grade can
+return. The per-request breakdown lives in a context variable, so it follows
+the request into asyncio tasks and to_thread calls.
+"""
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_current_timings = contextvars.ContextVar("grading_request_timings", default=None)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Counter:
+    """Monotonic counter keyed by one label."""
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+
+    def inc(self, label_value, amount=1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape_label(label_value)}"}} {_format_value(value)}')
+        return lines
+
+
+class _Histogram:
+    """Cumulative-bucket histogram keyed by one label."""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, label_value, value):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            label = f'{self.label}="{_escape_label(label_value)}"'
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f'{self.name}_bucket{{{label},le="{_format_value(float(bound))}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{label}}} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{{{label}}} {series['count']}")
+        return lines
+
+
+class Metrics:
+    """Process-wide pipeline metrics in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stage_seconds = _Histogram(
+            "grading_stage_seconds", "Time spent in each grading pipeline stage", "stage"
+        )
+        self._request_seconds = _Histogram(
+            "grading_request_seconds", "End-to-end grading request latency", "endpoint"
+        )
+        self._tokens = _Counter(
+            "grading_llm_tokens_total", "LLM tokens used, by kind (prompt, completion, cached)", "kind"
+        )
+        self._llm_calls = _Counter(
+            "grading_llm_calls_total", "LLM calls, by outcome", "outcome"
+        )
+
+    def observe_stage(self, stage, seconds):
+        with self._lock:
+            self._stage_seconds.observe(stage, seconds)
+
+    def observe_request(self, endpoint, seconds):
+        with self._lock:
+            self._request_seconds.observe(endpoint, seconds)
+
+    def add_tokens(self, usage):
+        with self._lock:
+            self._tokens.inc("prompt", usage.get("prompt_tokens", 0))
+            self._tokens.inc("completion", usage.get("completion_tokens", 0))
+            self._tokens.inc("cached", usage.get("cached_tokens", 0))
+
+    def count_llm_call(self, outcome):
+        with self._lock:
+            self._llm_calls.inc(outcome)
+
+    def render(self, extra_lines=()):
+        """Render every metric, plus any extra pre-formatted lines, as Prometheus text."""
+        with self._lock:
+            lines = []
+            for metric in (self._stage_seconds, self._request_seconds, self._tokens, self._llm_calls):
+                lines.extend(metric.render())
+        lines.extend(extra_lines)
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RequestTimings:
+    """Per-request totals of stage time and LLM tokens."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stages = {}
+        self._tokens = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+        self._batches = []
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            total = self._stages.setdefault(stage, {"seconds": 0.0, "count": 0})
+            total["seconds"] += seconds
+            total["count"] += 1
+
+    def add_tokens(self, usage):
+        with self._lock:
+            for key in self._tokens:
+                self._tokens[key] += usage.get(key, 0)
+
+    def add_batch(self, batch_number, usage):
+        with self._lock:
+            self._batches.append({"batch_number": batch_number, **usage})
+
+    def as_dict(self):
+        """
+        Stage totals in seconds, summed over batches, so concurrent stages can
+        add up to more than total_seconds.
+        """
+        with self._lock:
+            return {
+                "total_seconds": round(time.perf_counter() - self._started, 4),
+                "stages": {
+                    stage: {"seconds": round(total["seconds"], 4), "count": total["count"]}
+                    for stage, total in self._stages.items()
+                },
+                "tokens": dict(self._tokens),
+                "batches": sorted(self._batches, key=lambda batch: batch["batch_number"])
+            }
+
+
+@contextmanager
+def request_timings(endpoint):
+    """Collect stage timings for everything run inside the block, including tasks it starts."""
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+        metrics.observe_request(endpoint, time.perf_counter() - started)
+
+
+@contextmanager
+def timed(stage):
+    """Time a pipeline stage for /metrics and the current request's timings."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.observe_stage(stage, seconds)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add_stage(stage, seconds)
+
+
+def record_usage(batch_number, usage):
+    """Count one LLM call's token usage for /metrics and the current request."""
+    metrics.add_tokens(usage)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add_tokens(usage)
+        timings.add_batch(batch_number, usage)
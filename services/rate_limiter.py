@@ -0,0 +1,387 @@
+"""
+Client-side rate limiting and retries for Azure OpenAI calls.
+
+A RateLimiter keeps two token buckets per deployment, one for requests per
+minute and one for tokens per minute, and schedules each call for when both
+have room. The buckets tighten from the x-ratelimit-* and retry-after headers
+Azure returns, so a fan-out of batches runs close to the quota instead of
+failing with 429s. A SharedRateLimiter keeps the same buckets in SQLite so
+every server process drawing on a deployment shares one quota. A RetryPolicy
+retries throttled and transient failures with jittered exponential backoff.
+"""
+
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import openai
+
+
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_DELAY_SECONDS = 1.0
+DEFAULT_MAX_DELAY_SECONDS = 60.0
+
+# Completion tokens reserved per call before the real usage is known
+DEFAULT_COMPLETION_TOKEN_ESTIMATE = 1024
+
+# How long a SharedRateLimiter waits for another process's transaction before
+# falling back to the state it last read
+SHARED_STATE_BUSY_TIMEOUT_SECONDS = 1.0
+
+_RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _header(headers, name):
+    if not headers:
+        return None
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.title())
+    return value
+
+
+def _parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(headers):
+    """Return the wait requested by retry-after-ms or retry-after headers, or None."""
+    milliseconds = _parse_number(_header(headers, "retry-after-ms"))
+    if milliseconds is not None:
+        return max(0.0, milliseconds / 1000)
+
+    value = _header(headers, "retry-after")
+    seconds = _parse_number(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    if value:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+class _Bucket:
+    """Token bucket refilled continuously at per_minute / 60 per second."""
+
+    def __init__(self, per_minute, now):
+        self.capacity = None
+        self.rate = None
+        self.level = 0.0
+        self.updated = now
+        if per_minute:
+            self.set_limit(per_minute, now)
+
+    @property
+    def limited(self):
+        return self.capacity is not None
+
+    def set_limit(self, per_minute, now):
+        self._refill(now)
+        first = self.capacity is None
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity if first else min(self.level, self.capacity)
+
+    def _refill(self, now):
+        if self.limited:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take amount from the bucket and return how long the caller must wait for it."""
+        if not self.limited:
+            return 0.0
+        self._refill(now)
+        # Never reserve more than a full bucket, or the call could never run
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount, now):
+        """Return (positive) or charge (negative) tokens after the fact."""
+        if self.limited:
+            self._refill(now)
+            self.level = min(self.capacity, self.level + amount)
+
+    def share(self, now):
+        """Fraction of the bucket currently free."""
+        self._refill(now)
+        return max(0.0, self.level) / self.capacity
+
+    def clamp(self, remaining, now):
+        """Lower the level to what the server reports is left."""
+        if self.limited:
+            self._refill(now)
+            self.level = min(self.level, remaining)
+
+    def state(self):
+        return {"capacity": self.capacity, "level": self.level, "updated": self.updated}
+
+    def load(self, state):
+        self.capacity = state["capacity"]
+        self.rate = self.capacity / 60 if self.capacity is not None else None
+        self.level = state["level"]
+        self.updated = state["updated"]
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limiter for one deployment."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, clock=time.monotonic):
+        """
+        Args:
+            requests_per_minute (int, optional): Deployment RPM quota. Learned from
+                x-ratelimit-limit-requests when not set.
+            tokens_per_minute (int, optional): Deployment TPM quota. Learned from
+                x-ratelimit-limit-tokens when not set.
+            clock (callable): Monotonic time source
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        now = clock()
+        self._requests = _Bucket(requests_per_minute, now)
+        self._tokens = _Bucket(tokens_per_minute, now)
+        self._blocked_until = 0.0
+        self.throttled = 0
+
+    @contextmanager
+    def _synchronized(self, write=True):
+        """Hold the limiter's state for one read or update."""
+        with self._lock:
+            yield
+
+    def _reserve(self, tokens):
+        with self._synchronized():
+            now = self._clock()
+            wait = max(
+                self._requests.reserve(1, now),
+                self._tokens.reserve(tokens, now),
+                self._blocked_until - now
+            )
+        return max(0.0, wait)
+
+    def acquire(self, tokens):
+        """Block until a call estimated at tokens may be sent."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def _areserve(self, tokens):
+        return self._reserve(tokens)
+
+    async def aacquire(self, tokens):
+        """Async version of acquire."""
+        wait = await self._areserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def capacity_share(self):
+        """Fraction of the tighter of the two limits currently free; 1.0 when unlimited."""
+        with self._synchronized(write=False):
+            now = self._clock()
+            if now < self._blocked_until:
+                return 0.0
+            shares = [bucket.share(now) for bucket in (self._requests, self._tokens) if bucket.limited]
+        return min(shares) if shares else 1.0
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once a call's real usage is known."""
+        with self._synchronized():
+            self._tokens.adjust(estimated_tokens - actual_tokens, self._clock())
+
+    def pause(self, seconds):
+        """Hold every caller back for seconds, e.g. after a 429."""
+        with self._synchronized():
+            self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+            self.throttled += 1
+
+    def update_from_headers(self, headers):
+        """Adapt limits and remaining capacity to the server's rate-limit headers."""
+        if not headers:
+            return
+        with self._synchronized():
+            now = self._clock()
+            for bucket, kind in ((self._requests, "requests"), (self._tokens, "tokens")):
+                limit = _parse_number(_header(headers, f"x-ratelimit-limit-{kind}"))
+                if limit and limit != bucket.capacity:
+                    bucket.set_limit(limit, now)
+                remaining = _parse_number(_header(headers, f"x-ratelimit-remaining-{kind}"))
+                if remaining is not None:
+                    bucket.clamp(remaining, now)
+
+    def stats(self):
+        with self._synchronized(write=False):
+            return {
+                "requests_per_minute": self._requests.capacity,
+                "tokens_per_minute": self._tokens.capacity,
+                "throttled": self.throttled
+            }
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter whose buckets are stored in SQLite.
+
+    Every process that opens the same file with the same key draws on one set
+    of buckets, so running several server workers does not multiply the
+    deployment's quota. Times are wall-clock so all processes agree on them.
+    Every method may wait on SQLite, so async callers run them in a thread.
+    """
+
+    def __init__(self, path, key, requests_per_minute=None, tokens_per_minute=None, clock=time.time):
+        """
+        Args:
+            path (str): SQLite file shared by the processes
+            key (str): Identity of the quota, e.g. the deployment and endpoint
+            requests_per_minute (int, optional): Deployment RPM quota
+            tokens_per_minute (int, optional): Deployment TPM quota
+            clock (callable): Wall-clock time source
+        """
+        self.path = path
+        self.key = key
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=SHARED_STATE_BUSY_TIMEOUT_SECONDS,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, state TEXT NOT NULL)")
+        super().__init__(clock=clock)
+
+        # Configured quotas override whatever another process stored or learned
+        with self._synchronized():
+            now = self._clock()
+            for bucket, limit in ((self._requests, requests_per_minute), (self._tokens, tokens_per_minute)):
+                if limit and limit != bucket.capacity:
+                    bucket.set_limit(limit, now)
+
+    def _load(self):
+        row = self._conn.execute("SELECT state FROM rate_limits WHERE key = ?", (self.key,)).fetchone()
+        if row is None:
+            return
+        state = json.loads(row[0])
+        self._requests.load(state["requests"])
+        self._tokens.load(state["tokens"])
+        self._blocked_until = state["blocked_until"]
+        self.throttled = state["throttled"]
+
+    def _save(self):
+        state = {
+            "requests": self._requests.state(),
+            "tokens": self._tokens.state(),
+            "blocked_until": self._blocked_until,
+            "throttled": self.throttled
+        }
+        self._conn.execute(
+            "INSERT INTO rate_limits (key, state) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (self.key, json.dumps(state))
+        )
+
+    @contextmanager
+    def _synchronized(self, write=True):
+        """Load the shared state, and for updates write it back in the same transaction."""
+        with self._lock:
+            # When the file stays busy past the timeout, this process's last
+            # view of the buckets is used rather than holding up the call
+            try:
+                if not write:
+                    self._load()
+                else:
+                    # BEGIN IMMEDIATE takes the write lock, so concurrent
+                    # processes apply their reservations one after another
+                    self._conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                print(f"Warning: shared rate limit state unavailable ({e}), using local state")
+                yield
+                return
+
+            if not write:
+                yield
+                return
+
+            try:
+                self._load()
+                yield
+                self._save()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def _areserve(self, tokens):
+        return await asyncio.to_thread(self._reserve, tokens)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RetryPolicy:
+    """Decides which LLM errors are retried and how long to wait between attempts."""
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY_SECONDS,
+                 max_delay=DEFAULT_MAX_DELAY_SECONDS):
+        if max_retries < 0:
+            raise ValueError("max_retries must not be negative")
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        """Throttling, timeouts, connection failures and 5xx responses are transient."""
+        if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in _RETRYABLE_STATUS_CODES
+        return False
+
+    def delay(self, attempt, error=None):
+        """
+        Seconds to wait before retry number attempt (starting at 0).
+
+        Uses full-jitter exponential backoff, but never less than the
+        server's retry-after.
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        retry_after = retry_after_seconds(error_headers(error))
+        if retry_after is not None:
+            return max(retry_after, backoff)
+        return backoff
+
+
+def error_headers(error):
+    """Return the HTTP response headers attached to an OpenAI error, if any."""
+    response = getattr(error, "response", None)
+    return getattr(response, "headers", None)
+
+
+def create_rate_limiter(key, requests_per_minute=None, tokens_per_minute=None):
+    """
+    Create the limiter for one deployment quota.
+
+    When GRADING_SHARED_STATE_DB names a SQLite file the limiter is shared
+    through it with every other process using the file; otherwise it is
+    local to this process.
+    """
+    path = os.getenv("GRADING_SHARED_STATE_DB")
+    if path:
+        return SharedRateLimiter(path, key, requests_per_minute=requests_per_minute,
+                                 tokens_per_minute=tokens_per_minute)
+    return RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+
+def create_retry_policy():
+    """Create the retry policy configured by GRADING_LLM_MAX_RETRIES and GRADING_LLM_RETRY_*."""
+    return RetryPolicy(
+        max_retries=int(os.getenv("GRADING_LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+        base_delay=float(os.getenv("GRADING_LLM_RETRY_BASE_SECONDS", DEFAULT_BASE_DELAY_SECONDS)),
+        max_delay=float(os.getenv("GRADING_LLM_RETRY_MAX_SECONDS", DEFAULT_MAX_DELAY_SECONDS))
+    )
@@ -0,0 +1,266 @@
+"""
+Per-repository memory of batch grades for incremental regrading.
+
+For each repository URL and rubric, the store keeps every batch's content
+fingerprint (the git blob ids of the files it resolved to) together with
+the grade it received. When the same student is graded again after pushing
+a new commit, batches whose fingerprint is unchanged are answered from the
+store without reading their files or calling the LLM; only batches whose
+files changed are regraded.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import subprocess
+import threading
+
+from services.result_cache import make_cache_key
+
+
+# The default store lives in memory for the life of the process
+DEFAULT_REGRADE_PATH = ":memory:"
+DEFAULT_REGRADE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Seconds allowed for reading a working tree's blob ids
+TREE_LISTING_TIMEOUT_SECONDS = 60
+
+
+def regrade_scope(github_url, rubric, template, deployment):
+    """Key under which one repository's batch grades for one rubric are kept."""
+    url = (github_url or "").strip().rstrip("/")
+    if url.endswith(".git"):
+        url = url[:-len(".git")]
+    return make_cache_key(url, rubric, template, deployment)
+
+
+def blob_id(file_path):
+    """Hash a file the way git hashes a blob, so ids match `git ls-tree` output."""
+    with open(file_path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha1(b"blob %d\0" % len(content))
+    digest.update(content)
+    return digest.hexdigest()
+
+
+def read_tree_blobs(repo_path):
+    """
+    Read the commit and per-file blob ids of a cloned working tree.
+
+    The tree listing needs no blob contents, so it is cheap even for a
+    blobless clone.
+
+    Returns:
+        tuple: (commit, {path: blob_id}), or (None, {}) when repo_path is
+            not the root of a git working tree
+    """
+    if not os.path.isdir(os.path.join(repo_path, ".git")):
+        return None, {}
+
+    try:
+        head = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=repo_path, capture_output=True, text=True,
+            timeout=TREE_LISTING_TIMEOUT_SECONDS
+        )
+        listing = subprocess.run(
+            ["git", "ls-tree", "-r", "-z", "HEAD"], cwd=repo_path, capture_output=True, text=True,
+            timeout=TREE_LISTING_TIMEOUT_SECONDS
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None, {}
+    if head.returncode != 0 or listing.returncode != 0:
+        return None, {}
+
+    blobs = {}
+    for record in listing.stdout.split("\0"):
+        if not record:
+            continue
+        info, path = record.split("\t", 1)
+        _, object_type, object_id = info.split()
+        if object_type == "blob":
+            blobs[path] = object_id
+    return head.stdout.strip(), blobs
+
+
+class RegradeStore:
+    """SQLite table of batch fingerprints and grades per repository and rubric."""
+
+    def __init__(self, path=DEFAULT_REGRADE_PATH, ttl_seconds=DEFAULT_REGRADE_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.reused = 0
+        self.regraded = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS regrade_batches (
+                    scope TEXT NOT NULL,
+                    batch TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    commit_sha TEXT,
+                    stored_at REAL NOT NULL,
+                    PRIMARY KEY (scope, batch)
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_regrade_batches_stored ON regrade_batches (stored_at)"
+            )
+
+    def _is_expired(self, stored_at):
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, scope, file_batch):
+        """
+        Return the stored (fingerprint, result, commit) for a batch, or None.
+        """
+        batch = json.dumps(list(file_batch))
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT fingerprint, result, commit_sha, stored_at FROM regrade_batches "
+                "WHERE scope = ? AND batch = ?",
+                (scope, batch)
+            ).fetchone()
+            if row is None:
+                return None
+
+            fingerprint, result, commit, stored_at = row
+            if self._is_expired(stored_at):
+                self._conn.execute(
+                    "DELETE FROM regrade_batches WHERE scope = ? AND batch = ?", (scope, batch)
+                )
+                return None
+        return fingerprint, json.loads(result), commit
+
+    def set(self, scope, file_batch, fingerprint, result, commit=None):
+        """Remember a batch's fingerprint and grade, replacing any earlier one."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO regrade_batches "
+                "(scope, batch, fingerprint, result, commit_sha, stored_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (scope, json.dumps(list(file_batch)), fingerprint, json.dumps(result), commit, now)
+            )
+            if self.ttl_seconds is not None:
+                self._conn.execute(
+                    "DELETE FROM regrade_batches WHERE stored_at < ?", (now - self.ttl_seconds,)
+                )
+
+    def count(self, reused):
+        """Count one batch as reused from the store or regraded."""
+        with self._lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.regraded += 1
+
+    def stats(self):
+        """Return reuse counters and the number of remembered batches."""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM regrade_batches").fetchone()[0]
+            return {"reused": self.reused, "regraded": self.regraded, "size": size}
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM regrade_batches")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        return self.stats()["size"]
+
+
+class RegradeSession:
+    """
+    Incremental regrade state for one grading request.
+
+    Built once the repository is checked out, and shared by every batch of
+    the request.
+    """
+
+    def __init__(self, store, scope, repo_path, file_index, commit=None, blobs=None):
+        self.store = store
+        self.scope = scope
+        self.repo_path = repo_path
+        self.file_index = file_index
+        self.commit = commit
+        self.blobs = blobs or {}
+
+    def fingerprint(self, file_batch):
+        """Hash which file each entry resolves to and that file's blob id."""
+        parts = []
+        for entry in file_batch:
+            path, _ = self.file_index.resolve(entry)
+            if path is None:
+                parts.append([entry, None, None])
+                continue
+            object_id = self.blobs.get(path) or blob_id(os.path.join(self.repo_path, path))
+            parts.append([entry, path, object_id])
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def lookup(self, file_batch):
+        """
+        Check a batch against its last grade.
+
+        Returns:
+            tuple: (fingerprint, result) where result is the stored grade when
+                the batch's files are unchanged, else None. fingerprint is None
+                when the batch's files could not be hashed.
+        """
+        try:
+            fingerprint = self.fingerprint(file_batch)
+        except OSError as e:
+            print(f"Warning: Could not fingerprint batch files: {e}")
+            return None, None
+
+        stored = self.store.get(self.scope, file_batch)
+        if stored is None or stored[0] != fingerprint:
+            self.store.count(reused=False)
+            return fingerprint, None
+
+        self.store.count(reused=True)
+        _, result, commit = stored
+        result["reused"] = True
+        result["graded_commit"] = commit
+        return fingerprint, result
+
+    def remember(self, file_batch, fingerprint, result):
+        """Store a batch's grade if it is a successfully parsed one."""
+        # Fallback, failed and partly failed results are regraded next time
+        if fingerprint is None or any(
+            key in result for key in ("overall_score", "analysis_result", "error", "chunk_errors")
+        ):
+            return
+
+        stored = {key: value for key, value in result.items() if key not in ("usage", "reused", "graded_commit")}
+        try:
+            self.store.set(self.scope, file_batch, fingerprint, stored, self.commit)
+        except Exception as e:
+            print(f"Warning: Could not store batch grade for regrading: {e}")
+
+
+def create_regrade_store(path=None):
+    """
+    Create the regrade store configured by environment variables.
+
+    GRADING_REGRADE_DB is the SQLite file to keep batch grades in, ":memory:"
+    (default) for a per-process store, or "none" to disable incremental
+    regrading. GRADING_REGRADE_TTL_SECONDS sets how long grades are kept.
+
+    Returns:
+        RegradeStore or None when incremental regrading is disabled
+    """
+    path = path or os.getenv("GRADING_REGRADE_DB", DEFAULT_REGRADE_PATH)
+    if path.lower() == "none":
+        return None
+    ttl_seconds = float(os.getenv("GRADING_REGRADE_TTL_SECONDS", DEFAULT_REGRADE_TTL_SECONDS))
+    return RegradeStore(path=path, ttl_seconds=ttl_seconds)
@@ -0,0 +1,305 @@
+"""
+Persistent on-disk cache of cloned repositories.
+
+Each repository URL gets one working tree under the cache root. A warm repo
+is brought up to date with a shallow fetch and hard reset instead of a fresh
+clone, and a pinned commit that is already present is served with no network
+call at all. Trees are evicted least-recently-used once the cache grows past
+its disk budget.
+
+Several server processes can share one cache root: a file lock per tree
+lets only one process run git in it at a time, and a shared lock held for
+each lease keeps other processes from resetting or evicting a tree that is
+being graded.
+"""
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; trees are then only coordinated within one process
+    fcntl = None
+
+
+DEFAULT_REPO_CACHE_MAX_BYTES = 5 * 1024 ** 3
+GIT_TIMEOUT_SECONDS = 300
+
+_COMMIT_SHA_PATTERN = re.compile(r"^[0-9a-fA-F]{7,40}$")
+
+
+def _directory_size(path):
+    """Return the total size in bytes of the files under path."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class _CachedRepo:
+    """Bookkeeping for one cached working tree."""
+
+    def __init__(self, key, url, path):
+        self.key = key
+        self.url = url
+        self.path = path
+        self.lock = threading.Lock()
+        self.leases = 0
+        self.last_used = time.time()
+        self.fetched_at = 0.0
+        self.size = 0
+        # Open lock files holding a shared flock, one per lease
+        self.lease_locks = []
+
+
+class RepoCache:
+    """LRU cache of git working trees keyed by repository URL."""
+
+    def __init__(self, root, max_bytes=DEFAULT_REPO_CACHE_MAX_BYTES):
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._repos = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._load_existing()
+
+    def _key(self, url):
+        return hashlib.sha256(url.strip().encode("utf-8")).hexdigest()[:24]
+
+    def _load_existing(self):
+        """Register working trees left on disk by a previous process."""
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key)
+            if not os.path.isdir(os.path.join(path, ".git")):
+                continue
+
+            result = subprocess.run(
+                ["git", "config", "--get", "remote.origin.url"],
+                cwd=path, capture_output=True, text=True
+            )
+            url = result.stdout.strip()
+            if result.returncode != 0 or self._key(url) != key:
+                continue
+
+            repo = _CachedRepo(key, url, path)
+            repo.last_used = os.path.getmtime(path)
+            repo.size = _directory_size(path)
+            self._repos[key] = repo
+
+    def _run_git(self, args, cwd):
+        result = subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            timeout=GIT_TIMEOUT_SECONDS
+        )
+        if result.returncode != 0:
+            raise Exception(f"git {args[0]} failed: {result.stderr.strip()}")
+        return result.stdout.strip()
+
+    def _has_commit(self, repo, commit):
+        result = subprocess.run(
+            ["git", "cat-file", "-e", f"{commit}^{{commit}}"],
+            cwd=repo.path, capture_output=True, text=True
+        )
+        return result.returncode == 0
+
+    def _head(self, repo):
+        try:
+            return self._run_git(["rev-parse", "HEAD"], repo.path)
+        except Exception:
+            return None
+
+    def _open_lock(self, repo):
+        """Open the lock file other processes use for repo, or None without flock."""
+        if fcntl is None:
+            return None
+        return open(os.path.join(self.root, f"{repo.key}.lock"), "a")
+
+    def _flock(self, handle, exclusive, blocking=True):
+        """Take or convert the flock on handle; raises BlockingIOError if not blocking and held."""
+        if handle is not None:
+            operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            fcntl.flock(handle, operation if blocking else operation | fcntl.LOCK_NB)
+
+    def _is_current(self, repo, commit, requested_at):
+        """Whether the tree is already what the request needs, so no git command has to change it."""
+        if not os.path.isdir(os.path.join(repo.path, ".git")):
+            return False
+        if commit:
+            head = self._head(repo)
+            return bool(head) and head.startswith(commit.lower())
+        return repo.fetched_at >= requested_at
+
+    def _sync(self, repo, commit, requested_at):
+        """Bring the working tree to commit (or the remote's latest) under repo.lock."""
+        if not os.path.isdir(os.path.join(repo.path, ".git")):
+            shutil.rmtree(repo.path, ignore_errors=True)
+            os.makedirs(repo.path)
+            self._run_git(["init", "--quiet"], repo.path)
+            self._run_git(["remote", "add", "origin", repo.url], repo.path)
+
+        if commit:
+            head = self._head(repo)
+            if head and head.startswith(commit.lower()):
+                print(f"Repository cache hit for {repo.url} at {commit}")
+                return
+            if self._has_commit(repo, commit):
+                print(f"Repository cache hit for {repo.url}, checking out {commit}")
+                self._run_git(["checkout", "--quiet", "--force", "--detach", commit], repo.path)
+                self._run_git(["clean", "-fdxq"], repo.path)
+                return
+        elif repo.fetched_at >= requested_at:
+            # Another request fetched while this one waited for the lock
+            print(f"Reusing concurrent fetch of {repo.url}")
+            return
+
+        print(f"Fetching {repo.url} into repository cache...")
+        self._run_git(["fetch", "--quiet", "--depth", "1", "origin", commit or "HEAD"], repo.path)
+        self._run_git(["reset", "--quiet", "--hard", "FETCH_HEAD"], repo.path)
+        self._run_git(["clean", "-fdxq"], repo.path)
+        if not commit:
+            repo.fetched_at = time.time()
+
+    def acquire(self, url, commit=None):
+        """
+        Return an up-to-date working tree for url and hold a lease on it.
+
+        Args:
+            url (str): Repository URL
+            commit (str, optional): Commit SHA to check out. Served without a
+                network call when the commit is already in the cache.
+
+        Returns:
+            str: Path to the working tree; pass it to release() when done
+        """
+        if commit is not None and not _COMMIT_SHA_PATTERN.match(commit):
+            raise ValueError("commit must be a hexadecimal commit SHA")
+
+        requested_at = time.time()
+        key = self._key(url)
+        with self._lock:
+            repo = self._repos.get(key)
+            if repo is None:
+                repo = _CachedRepo(key, url, os.path.join(self.root, key))
+                self._repos[key] = repo
+            repo.leases += 1
+
+        handle = None
+        try:
+            with repo.lock:
+                handle = self._open_lock(repo)
+                self._flock(handle, exclusive=False)
+                if not self._is_current(repo, commit, requested_at):
+                    # Changing the tree waits for every lease, in any process, to end
+                    self._flock(handle, exclusive=True)
+                    self._sync(repo, commit, requested_at)
+                    repo.size = _directory_size(repo.path)
+                    self._flock(handle, exclusive=False)
+                repo.lease_locks.append(handle)
+        except Exception:
+            if handle is not None:
+                handle.close()
+            # Not release(): its lease_locks belong to other, still active leases
+            with self._lock:
+                repo.leases -= 1
+                repo.last_used = time.time()
+            raise
+
+        with self._lock:
+            repo.last_used = time.time()
+        os.utime(repo.path)
+        self._evict()
+        return repo.path
+
+    def release(self, path):
+        """Drop a lease taken by acquire()."""
+        with self._lock:
+            for repo in self._repos.values():
+                if repo.path == path and repo.leases > 0:
+                    repo.leases -= 1
+                    repo.last_used = time.time()
+                    if repo.lease_locks:
+                        handle = repo.lease_locks.pop()
+                        if handle is not None:
+                            handle.close()
+                    break
+
+    def owns(self, path):
+        """Return True if path is a working tree managed by this cache."""
+        return bool(path) and os.path.dirname(os.path.abspath(path)) == self.root
+
+    @contextmanager
+    def checkout(self, url, commit=None):
+        """Context manager form of acquire()/release()."""
+        path = self.acquire(url, commit)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(repo.size for repo in self._repos.values())
+
+    def _evict(self):
+        """Remove least recently used idle trees until under the disk budget."""
+        with self._lock:
+            total = sum(repo.size for repo in self._repos.values())
+            idle = sorted(
+                (repo for repo in self._repos.values() if repo.leases == 0),
+                key=lambda repo: repo.last_used
+            )
+            evicted = []
+            for repo in idle:
+                if total <= self.max_bytes:
+                    break
+                handle = self._open_lock(repo)
+                try:
+                    self._flock(handle, exclusive=True, blocking=False)
+                except BlockingIOError:
+                    # Leased by another process
+                    handle.close()
+                    continue
+                total -= repo.size
+                del self._repos[repo.key]
+                evicted.append((repo, handle))
+
+        for repo, handle in evicted:
+            print(f"Evicting {repo.url} from repository cache")
+            shutil.rmtree(repo.path, ignore_errors=True)
+            if handle is not None:
+                handle.close()
+
+
+def create_repo_cache():
+    """
+    Create the repository cache configured by environment variables.
+
+    Caching is enabled by setting GRADING_REPO_CACHE_DIR. GRADING_REPO_CACHE_MAX_BYTES
+    sets the disk budget (default 5 GiB).
+
+    Returns:
+        RepoCache or None when the cache is disabled
+    """
+    root = os.getenv("GRADING_REPO_CACHE_DIR")
+    if not root:
+        return None
+
+    max_bytes = int(os.getenv("GRADING_REPO_CACHE_MAX_BYTES", DEFAULT_REPO_CACHE_MAX_BYTES))
+    return RepoCache(root, max_bytes=max_bytes)
@@ -0,0 +1,236 @@
+"""
+Content-addressed cache for grading results.
+
+Results are keyed by a hash of the formatted student code, the rubric text,
+the prompt template and the deployment name, so regrading identical files
+against the same rubric can skip the LLM call entirely.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_MAX_ENTRIES = 1024
+DEFAULT_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_CACHE_PATH = "grading_cache.db"
+
+
+def make_cache_key(code, rubric, template, deployment):
+    """Build a stable SHA-256 key for one grading request."""
+    digest = hashlib.sha256()
+    for part in (code, rubric, template, deployment):
+        encoded = (part or "").encode("utf-8")
+        # Length-prefix each part so boundaries can't be shifted between fields
+        digest.update(str(len(encoded)).encode("ascii") + b":")
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Base class for result cache backends with hit/miss accounting."""
+
+    backend = "base"
+
+    def __init__(self, max_entries=DEFAULT_CACHE_MAX_ENTRIES, ttl_seconds=DEFAULT_CACHE_TTL_SECONDS):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss."""
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if value is None else json.loads(value)
+
+    def set(self, key, result):
+        """Store a JSON-serializable result under key."""
+        self._set(key, json.dumps(result))
+
+    def stats(self):
+        """Return hit, miss and size counters for this cache."""
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "backend": self.backend,
+            "hits": hits,
+            "misses": misses,
+            "size": len(self),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds
+        }
+
+    def _is_expired(self, stored_at):
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryResultCache(ResultCache):
+    """In-process LRU cache with TTL expiry."""
+
+    backend = "memory"
+
+    def __init__(self, max_entries=DEFAULT_CACHE_MAX_ENTRIES, ttl_seconds=DEFAULT_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, ttl_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            stored_at, value = entry
+            if self._is_expired(stored_at):
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteResultCache(ResultCache):
+    """On-disk cache stored in SQLite, evicting least recently used entries."""
+
+    backend = "sqlite"
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_CACHE_MAX_ENTRIES,
+                 ttl_seconds=DEFAULT_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, ttl_seconds)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS grading_results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_grading_results_accessed ON grading_results (accessed_at)"
+            )
+
+    def _get(self, key):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, stored_at FROM grading_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, stored_at = row
+            if self._is_expired(stored_at):
+                self._conn.execute("DELETE FROM grading_results WHERE key = ?", (key,))
+                return None
+
+            self._conn.execute(
+                "UPDATE grading_results SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+            return value
+
+    def _set(self, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO grading_results (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            if self.ttl_seconds is not None:
+                self._conn.execute(
+                    "DELETE FROM grading_results WHERE stored_at < ?", (now - self.ttl_seconds,)
+                )
+            self._conn.execute(
+                """
+                DELETE FROM grading_results WHERE key IN (
+                    SELECT key FROM grading_results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,)
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM grading_results")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM grading_results").fetchone()[0]
+
+
+def create_result_cache(backend=None):
+    """
+    Create the result cache configured by environment variables.
+
+    GRADING_CACHE_BACKEND selects "memory" (default), "sqlite" or "none".
+    GRADING_CACHE_MAX_ENTRIES, GRADING_CACHE_TTL_SECONDS and GRADING_CACHE_PATH
+    tune size, expiry and the SQLite file location.
+
+    Returns:
+        ResultCache or None when caching is disabled
+    """
+    backend = (backend or os.getenv("GRADING_CACHE_BACKEND", "memory")).lower()
+    max_entries = int(os.getenv("GRADING_CACHE_MAX_ENTRIES", DEFAULT_CACHE_MAX_ENTRIES))
+    ttl_seconds = float(os.getenv("GRADING_CACHE_TTL_SECONDS", DEFAULT_CACHE_TTL_SECONDS))
+
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return MemoryResultCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+    if backend == "sqlite":
+        return SQLiteResultCache(
+            path=os.getenv("GRADING_CACHE_PATH", DEFAULT_CACHE_PATH),
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds
+        )
+
+    raise ValueError(f"Unknown GRADING_CACHE_BACKEND: {backend}")
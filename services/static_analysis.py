@@ -0,0 +1,374 @@
+"""
+Local static analysis of student files before they are graded.
+
+Each Python file in a batch is parsed once with ast to measure docstring
+coverage, cyclomatic complexity, a subset of PEP 8 checks and a short
+structure outline. A one- or two-line summary of those facts is put in
+front of the file in the prompt, so the LLM does not have to count them
+itself. Comments and blank lines can optionally be stripped from the code
+sent to the LLM, which shortens prompts without changing what the code does.
+
+Large batches are analyzed in a process pool so parsing does not hold the
+GIL while other batches are being prepared; small ones are analyzed inline,
+where a pool round trip would cost more than the analysis.
+"""
+
+import io
+import os
+import re
+import ast
+import token
+import tokenize
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+DEFAULT_ANALYSIS_WORKERS = 4
+
+# Batches with less source than this are analyzed in the calling thread
+POOL_MIN_BYTES = 64 * 1024
+
+MAX_LINE_LENGTH = 79
+
+# Names listed in a summary before the rest are counted as "+N more"
+MAX_LISTED_NAMES = 8
+
+_SNAKE_CASE = re.compile(r"^_{0,2}[a-z0-9]+(_[a-z0-9]+)*_{0,2}$|^_+$")
+_CAP_WORDS = re.compile(r"^_?[A-Z][A-Za-z0-9]*$")
+_PART_NAME = re.compile(r"^(.*) \(part (\d+)/\d+\)$")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _env_flag(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
+def get_analysis_workers():
+    """Worker processes for analysis from GRADING_ANALYSIS_WORKERS; 0 analyzes inline."""
+    default = min(DEFAULT_ANALYSIS_WORKERS, os.cpu_count() or 1)
+    workers = int(os.getenv("GRADING_ANALYSIS_WORKERS", default))
+    if workers < 0:
+        raise ValueError("GRADING_ANALYSIS_WORKERS must not be negative")
+    return workers
+
+
+def _is_python(path):
+    return path.endswith((".py", ".pyw"))
+
+
+def _complexity(node):
+    """McCabe cyclomatic complexity of one function, not counting nested functions."""
+    complexity = 1
+    stack = list(ast.iter_child_nodes(node))
+    while stack:
+        child = stack.pop()
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+            continue
+        if isinstance(child, (ast.If, ast.IfExp, ast.For, ast.AsyncFor, ast.While,
+                              ast.ExceptHandler, ast.Assert, ast.comprehension)):
+            complexity += 1
+            if isinstance(child, ast.comprehension):
+                complexity += len(child.ifs)
+        elif isinstance(child, ast.BoolOp):
+            complexity += len(child.values) - 1
+        elif isinstance(child, ast.match_case):
+            complexity += 1
+        stack.extend(ast.iter_child_nodes(child))
+    return complexity
+
+
+def _walk_definitions(body, prefix=""):
+    """Yield (qualified name, node) for classes and functions, outermost first."""
+    for node in body:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            name = f"{prefix}{node.name}"
+            yield name, node
+            yield from _walk_definitions(node.body, f"{name}.")
+
+
+def _style_issues(source, definitions):
+    """Count pycodestyle-style codes for the checks that need no extra dependency."""
+    issues = {}
+
+    def add(code):
+        issues[code] = issues.get(code, 0) + 1
+
+    for line in source.splitlines():
+        if len(line) > MAX_LINE_LENGTH:
+            add("E501")
+        if line != line.rstrip():
+            add("W291")
+        if line.startswith("\t"):
+            add("W191")
+
+    for name, node in definitions:
+        short_name = name.rsplit(".", 1)[-1]
+        if isinstance(node, ast.ClassDef):
+            if not _CAP_WORDS.match(short_name):
+                add("N801")
+        elif not _SNAKE_CASE.match(short_name):
+            add("N802")
+    return issues
+
+
+def _outline(tree):
+    """Top-level classes with their methods, then top-level functions."""
+    entries = []
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            methods = [
+                child.name for child in node.body
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))
+            ]
+            entries.append(f"class {node.name}({', '.join(methods)})" if methods else f"class {node.name}")
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            entries.append(f"def {node.name}")
+    return entries
+
+
+def analyze_source(path, source):
+    """
+    Measure one Python file.
+
+    Args:
+        path (str): File name, used only to decide whether it is Python
+        source (str): File content
+
+    Returns:
+        dict or None: "lines", "classes", "functions", "documented",
+            "documentable", "missing_docstrings", "complexity" (name to
+            score), "style" (code to count) and "outline", or
+            "syntax_error" when the file does not parse. None for
+            non-Python files.
+    """
+    if not _is_python(path):
+        return None
+
+    lines = len(source.splitlines())
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError) as e:
+        return {"lines": lines, "syntax_error": f"line {getattr(e, 'lineno', None) or '?'}: {getattr(e, 'msg', e)}"}
+    except (RecursionError, MemoryError):
+        # Valid but too deeply nested for the parser; not worth failing a batch over
+        return {"lines": lines, "syntax_error": "too deeply nested to analyze"}
+
+    definitions = list(_walk_definitions(tree.body))
+    functions = [
+        (name, node) for name, node in definitions
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+    ]
+
+    # The module itself counts towards docstring coverage when it has code
+    documentable = [("module", tree)] if tree.body else []
+    documentable += [
+        (name, node) for name, node in definitions
+        if not name.rsplit(".", 1)[-1].startswith("_") or name.endswith("__init__")
+    ]
+    missing = [name for name, node in documentable if not ast.get_docstring(node)]
+
+    return {
+        "lines": lines,
+        "classes": sum(isinstance(node, ast.ClassDef) for _, node in definitions),
+        "functions": len(functions),
+        "documented": len(documentable) - len(missing),
+        "documentable": len(documentable),
+        "missing_docstrings": missing,
+        "complexity": {name: _complexity(node) for name, node in functions},
+        "style": _style_issues(source, definitions),
+        "outline": _outline(tree)
+    }
+
+
+def analyze_sources(items):
+    """Analyze (path, source) pairs; the unit of work sent to pool workers."""
+    return [analyze_source(path, source) for path, source in items]
+
+
+def _names(names):
+    listed = ", ".join(names[:MAX_LISTED_NAMES])
+    if len(names) > MAX_LISTED_NAMES:
+        listed += f", +{len(names) - MAX_LISTED_NAMES} more"
+    return listed
+
+
+def format_summary(analysis):
+    """Render an analysis as the compact text placed before a file in the prompt."""
+    if "syntax_error" in analysis:
+        return f"{analysis['lines']} lines; does not parse ({analysis['syntax_error']})"
+
+    parts = [
+        f"{analysis['lines']} lines, {analysis['classes']} classes, {analysis['functions']} functions"
+    ]
+    if analysis["documentable"]:
+        docstrings = f"docstrings {analysis['documented']}/{analysis['documentable']}"
+        if analysis["missing_docstrings"]:
+            docstrings += f" (missing: {_names(analysis['missing_docstrings'])})"
+        parts.append(docstrings)
+
+    complexity = analysis["complexity"]
+    if complexity:
+        name = max(complexity, key=complexity.get)
+        mean = sum(complexity.values()) / len(complexity)
+        parts.append(f"cyclomatic complexity max {complexity[name]} ({name}), mean {mean:.1f}")
+
+    style = analysis["style"]
+    if style:
+        counts = ", ".join(f"{code} x{count}" for code, count in sorted(style.items()))
+        parts.append(f"PEP 8: {sum(style.values())} issues ({counts})")
+    else:
+        parts.append("PEP 8: no issues")
+
+    summary = "; ".join(parts)
+    if analysis["outline"]:
+        summary += f"\nOutline: {_names(analysis['outline'])}"
+    return summary
+
+
+def strip_source(source, comments=True, blank_lines=True):
+    """
+    Remove comments and/or blank lines from Python source.
+
+    Docstrings and string contents are kept, so the stripped code parses to
+    the same AST. Source that cannot be tokenized is returned unchanged.
+    """
+    if not (comments or blank_lines):
+        return source
+
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, SyntaxError):
+        return source
+
+    lines = source.splitlines(keepends=True)
+    comment_columns = {}
+    protected = set()
+    for tok in tokens:
+        if tok.type == token.COMMENT:
+            comment_columns[tok.start[0]] = tok.start[1]
+        elif tok.end[0] > tok.start[0]:
+            # Lines inside multi-line strings are content, even when blank
+            protected.update(range(tok.start[0] + 1, tok.end[0] + 1))
+
+    kept = []
+    for row, line in enumerate(lines, 1):
+        if row in protected:
+            kept.append(line)
+            continue
+        if comments and row in comment_columns:
+            code = line[:comment_columns[row]].rstrip()
+            if not code:
+                continue
+            line = code + "\n"
+        if blank_lines and not line.strip():
+            continue
+        kept.append(line)
+    return "".join(kept)
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned workers do not inherit the server's threads and locks
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class StaticAnalyzer:
+    """Analyzes a batch's loaded files and optionally strips them for the prompt."""
+
+    def __init__(self, workers=DEFAULT_ANALYSIS_WORKERS, strip_comments=False, strip_blank_lines=False):
+        self.workers = workers
+        self.strip_comments = strip_comments
+        self.strip_blank_lines = strip_blank_lines
+
+    def _run(self, items):
+        if self.workers and sum(len(source) for _, source in items) >= POOL_MIN_BYTES:
+            try:
+                return _get_pool(self.workers).submit(analyze_sources, items).result()
+            except BrokenProcessPool as e:
+                print(f"Warning: analysis pool failed ({e}), analyzing inline")
+                _reset_pool()
+        return analyze_sources(items)
+
+    def analyze(self, code_files, skip=()):
+        """
+        Analyze loaded files and prepare them for the prompt.
+
+        Args:
+            code_files (dict): Filename to content, in batch order
+            skip (iterable, optional): Filenames whose content is not the
+                whole file (e.g. truncated), which are neither analyzed
+                nor stripped
+
+        Returns:
+            tuple: (code_files, summaries). code_files has comments and blank
+                lines stripped as configured; summaries maps filenames to
+                the text from format_summary.
+        """
+        skip = set(skip)
+        items = [
+            (path, source) for path, source in code_files.items()
+            if _is_python(path) and path not in skip
+        ]
+        if not items:
+            return code_files, {}
+
+        summaries = {
+            path: format_summary(analysis)
+            for (path, _), analysis in zip(items, self._run(items))
+        }
+
+        if self.strip_comments or self.strip_blank_lines:
+            code_files = {
+                path: strip_source(source, self.strip_comments, self.strip_blank_lines)
+                if path in summaries else source
+                for path, source in code_files.items()
+            }
+        return code_files, summaries
+
+
+def summary_for(summaries, filename):
+    """Summary for a prompt section, shown only on the first part of a split file."""
+    if not summaries:
+        return None
+    match = _PART_NAME.match(filename)
+    if match and filename not in summaries:
+        return summaries.get(match.group(1)) if match.group(2) == "1" else None
+    return summaries.get(filename)
+
+
+def create_static_analyzer():
+    """
+    Create the static analyzer configured by environment variables.
+
+    GRADING_STATIC_ANALYSIS=0 disables analysis. GRADING_ANALYSIS_WORKERS sets
+    the process pool size (0 to analyze inline). GRADING_STRIP_COMMENTS and
+    GRADING_STRIP_BLANK_LINES remove comments and blank lines from prompts.
+
+    Returns:
+        StaticAnalyzer or None when analysis is disabled
+    """
+    if not _env_flag("GRADING_STATIC_ANALYSIS", True):
+        return None
+    return StaticAnalyzer(
+        workers=get_analysis_workers(),
+        strip_comments=_env_flag("GRADING_STRIP_COMMENTS", False),
+        strip_blank_lines=_env_flag("GRADING_STRIP_BLANK_LINES", False)
+    )
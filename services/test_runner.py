@@ -0,0 +1,385 @@
+"""
+Sandboxed runs of a submission's own tests, alongside LLM grading.
+
+The repository's pytest suite runs in a subprocess on a private copy of the
+checked-out tree, with CPU, memory and file-size limits (applied by
+`prlimit`), a wall-clock timeout and an environment stripped of the server's
+secrets. By default the run is also sandboxed with `unshare`: new user,
+mount, network and PID namespaces, and a root directory holding only the
+copied tree (read-write) and the interpreter's directories (read-only), so
+student code sees neither the network nor the rest of the host's files.
+Without the sandbox, tests can read anything the server can, including its
+credentials and other submissions.
+
+Runs go through a small pool so a roster of submissions cannot start
+unbounded test processes, and each run starts as soon as the tree is checked
+out, so it overlaps the LLM batches instead of delaying them. Summaries hold
+only the status, exit code and test counts; output from the tests, which
+student code controls, goes to the server log and never to API clients.
+
+Test results supplied with a request are a separate input: they are known
+before grading starts and are placed in every batch's prompt.
+"""
+
+import os
+import sys
+import site
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import contextvars
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from services.metrics import timed
+
+
+DEFAULT_TEST_WORKERS = 2
+DEFAULT_TEST_TIMEOUT_SECONDS = 60
+DEFAULT_TEST_CPU_SECONDS = 60
+DEFAULT_TEST_MEMORY_BYTES = 1024 * 1024 * 1024
+
+# Largest file a test run may write, which also bounds its captured output
+TEST_MAX_FILE_BYTES = 64 * 1024 * 1024
+
+# Largest JUnit report that is parsed; a bigger one is treated as an error
+MAX_REPORT_BYTES = 4 * 1024 * 1024
+
+# Characters of test results placed in a prompt; the end of the text is kept
+MAX_TEST_RESULTS_CHARS = 4000
+
+# Failing test ids listed in a summary
+MAX_LISTED_FAILURES = 10
+
+# Characters of test output written to the server log when a run does not finish cleanly
+MAX_LOGGED_OUTPUT_CHARS = 1000
+
+# Where the copied tree's working directory appears inside the sandbox
+SANDBOX_DIR = "/sandbox"
+
+# Run by `sh` inside the new namespaces: mount an empty root, expose the
+# read-only paths and the work directory in it, then run the command there.
+# Arguments: new root, work directory, read-only paths, "--", command.
+_SANDBOX_SCRIPT = r"""
+set -e
+root=$1 workdir=$2
+shift 2
+mount -t tmpfs -o mode=755 sandbox "$root"
+while [ "$1" != "--" ]; do
+    mkdir -p "$root$(dirname "$1")"
+    if [ -L "$1" ]; then
+        ln -s "$(readlink "$1")" "$root$1"
+    else
+        mkdir -p "$root$1"
+        mount --rbind "$1" "$root$1"
+        mount -o remount,bind,ro "$root$1"
+    fi
+    shift
+done
+shift
+mkdir -p "$root/sandbox" "$root/tmp" "$root/proc" "$root/dev"
+mount --bind "$workdir" "$root/sandbox"
+for device in null zero random urandom; do
+    touch "$root/dev/$device"
+    mount --bind "/dev/$device" "$root/dev/$device"
+done
+mount -t proc proc "$root/proc" 2>/dev/null || true
+exec unshare --root="$root" --wd=/sandbox/repo -- "$@"
+"""
+
+# pytest exit codes
+_EXIT_OK = 0
+_EXIT_TESTS_FAILED = 1
+_EXIT_NO_TESTS = 5
+
+_sandbox_available = None
+_sandbox_lock = threading.Lock()
+
+
+def format_test_results(test_results):
+    """
+    Render test results supplied with a request for the end of a prompt.
+
+    Long output keeps its end, where pytest and most runners put their
+    summary. Returns an empty string when there are no test results.
+    """
+    if not test_results or not test_results.strip():
+        return ""
+    text = test_results.strip()
+    if len(text) > MAX_TEST_RESULTS_CHARS:
+        text = "... [earlier output omitted]\n" + text[-MAX_TEST_RESULTS_CHARS:]
+    return f"\n\nTest Results (supplied with the submission, not written by the student):\n{text}\n"
+
+
+def _sandbox_paths():
+    """Host paths visible (read-only) in the sandbox: system directories and the interpreter's."""
+    paths = [path for path in ("/usr", "/bin", "/lib", "/lib64", "/sbin") if os.path.lexists(path)]
+    interpreter = [sys.base_prefix, sys.prefix, sys.exec_prefix,
+                   os.path.dirname(os.path.realpath(sys.executable)), *site.getsitepackages()]
+    for path in sorted(os.path.abspath(path) for path in interpreter):
+        if os.path.isdir(path) and not any(path == seen or path.startswith(seen + "/") for seen in paths):
+            paths.append(path)
+    return paths
+
+
+def _sandbox_command(workdir, command):
+    """Wrap command to run in new namespaces, rooted in workdir's "root" with workdir at SANDBOX_DIR."""
+    return [
+        "unshare", "--user", "--map-root-user", "--mount", "--net", "--pid", "--fork", "--kill-child", "--",
+        "sh", "-c", _SANDBOX_SCRIPT, "sandbox", os.path.join(workdir, "root"), workdir,
+        *_sandbox_paths(), "--", *command
+    ]
+
+
+def _make_workdir():
+    workdir = tempfile.mkdtemp(prefix="grading-tests-")
+    os.mkdir(os.path.join(workdir, "root"))
+    return workdir
+
+
+def sandbox_available():
+    """Whether `unshare` can run a test process in the sandbox on this host."""
+    global _sandbox_available
+    with _sandbox_lock:
+        if _sandbox_available is None:
+            workdir = _make_workdir()
+            try:
+                os.mkdir(os.path.join(workdir, "repo"))
+                _sandbox_available = subprocess.run(
+                    _sandbox_command(workdir, ["true"]), capture_output=True, timeout=10
+                ).returncode == 0
+            except (OSError, subprocess.SubprocessError):
+                _sandbox_available = False
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        return _sandbox_available
+
+
+def _sandbox_environment(home):
+    """Environment for a test run, without the server's credentials."""
+    return {
+        "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+        "HOME": home,
+        "TMPDIR": home,
+        "USER": "sandbox",
+        "LANG": "C.UTF-8",
+        "PYTHONDONTWRITEBYTECODE": "1",
+        "PYTHONNOUSERSITE": "1",
+        "PYTHONHASHSEED": "0"
+    }
+
+
+def _tail(path, limit=MAX_LOGGED_OUTPUT_CHARS):
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.fstat(f.fileno()).st_size - limit))
+            return f.read().decode("utf-8", errors="ignore").strip()
+    except OSError:
+        return ""
+
+
+def parse_junit_report(report_path):
+    """
+    Read test counts and failing test ids from a pytest JUnit XML report.
+
+    Returns:
+        dict or None: "passed", "failed", "errors", "skipped" and "failures",
+            or None when the report is missing, oversized or malformed
+    """
+    try:
+        if os.path.getsize(report_path) > MAX_REPORT_BYTES:
+            return None
+        root = ElementTree.parse(report_path).getroot()
+    except (OSError, ElementTree.ParseError):
+        return None
+
+    suites = [root] if root.tag == "testsuite" else root.findall("testsuite")
+    counts = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    failures = []
+    for suite in suites:
+        for name in counts:
+            counts[name] += int(suite.get(name, 0) or 0)
+        for case in suite.iter("testcase"):
+            if case.find("failure") is not None or case.find("error") is not None:
+                failures.append(f"{case.get('classname', '')}::{case.get('name', '')}".lstrip(":"))
+
+    return {
+        "passed": counts["tests"] - counts["failures"] - counts["errors"] - counts["skipped"],
+        "failed": counts["failures"],
+        "errors": counts["errors"],
+        "skipped": counts["skipped"],
+        "failures": failures[:MAX_LISTED_FAILURES]
+    }
+
+
+class TestRunner:
+    """Runs a repository's pytest suite in a bounded pool of sandboxed subprocesses."""
+
+    # Not a test class, despite the name
+    __test__ = False
+
+    def __init__(self, workers=DEFAULT_TEST_WORKERS, timeout_seconds=DEFAULT_TEST_TIMEOUT_SECONDS,
+                 cpu_seconds=DEFAULT_TEST_CPU_SECONDS, memory_bytes=DEFAULT_TEST_MEMORY_BYTES,
+                 isolate=True):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        self.timeout_seconds = timeout_seconds
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.isolate = isolate
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grading-tests")
+
+    def _command(self, workdir):
+        """The limited, and by default sandboxed, pytest command for a copied tree."""
+        # The sandbox sees workdir at SANDBOX_DIR
+        report_dir = SANDBOX_DIR if self.isolate else workdir
+        command = [
+            sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider",
+            f"--junitxml={report_dir}/report.xml"
+        ]
+        if self.isolate:
+            command = _sandbox_command(workdir, command)
+        # prlimit rather than preexec_fn, which is unsafe to fork from a threaded server
+        return [
+            "prlimit", f"--cpu={self.cpu_seconds}", f"--as={self.memory_bytes}",
+            f"--fsize={TEST_MAX_FILE_BYTES}", "--core=0", "--"
+        ] + command
+
+    def _run_in(self, workdir):
+        """Run pytest in the copied tree under workdir and summarize the outcome."""
+        report_path = os.path.join(workdir, "report.xml")
+        output_path = os.path.join(workdir, "output.txt")
+        started = time.monotonic()
+
+        def summary(status, **fields):
+            return {"status": status, **fields, "duration_seconds": round(time.monotonic() - started, 3)}
+
+        def log_output(status):
+            # Student code controls this text, so it stays in the server log
+            print(f"Test run {status}, last output:\n{_tail(output_path)}")
+
+        if self.isolate and not sandbox_available():
+            return summary("error", detail=(
+                "The test sandbox is unavailable (unshare failed); GRADING_TEST_SANDBOX=none "
+                "runs tests without it, which lets them read the server's files"
+            ))
+
+        with open(output_path, "wb") as output:
+            process = subprocess.Popen(
+                self._command(workdir),
+                cwd=os.path.join(workdir, "repo"),
+                env=_sandbox_environment(SANDBOX_DIR if self.isolate else workdir),
+                stdin=subprocess.DEVNULL,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+                # Own process group, so a timeout also kills processes the tests started
+                start_new_session=True
+            )
+            try:
+                returncode = process.wait(timeout=self.timeout_seconds)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, 9)
+                process.wait()
+                log_output("timeout")
+                return summary("timeout")
+
+        if returncode == _EXIT_NO_TESTS:
+            return summary("no_tests", exit_code=returncode)
+
+        report = parse_junit_report(report_path)
+        if returncode not in (_EXIT_OK, _EXIT_TESTS_FAILED) or report is None:
+            log_output("error")
+            return summary("error", exit_code=returncode)
+
+        failures = report.pop("failures")
+        if failures:
+            print(f"Failing tests: {', '.join(failures)}")
+        return summary("passed" if returncode == _EXIT_OK else "failed", exit_code=returncode, **report)
+
+    def _run(self, workdir):
+        try:
+            with timed("tests"):
+                return self._run_in(workdir)
+        except Exception as e:
+            return {"status": "error", "detail": str(e)}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def submit(self, repo_path):
+        """
+        Start a test run of a checked-out repository.
+
+        The tree is copied before this returns, so the caller may release or
+        reuse repo_path while the tests run.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the summary dict, with
+                "status" (passed, failed, no_tests, timeout or error),
+                "duration_seconds", "exit_code" when pytest exited, and test
+                counts for passed and failed runs. Test output and failing
+                test ids are only logged.
+        """
+        workdir = _make_workdir()
+        try:
+            shutil.copytree(repo_path, os.path.join(workdir, "repo"), symlinks=True,
+                            ignore=shutil.ignore_patterns(".git"))
+        except Exception:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+
+        future = self._executor.submit(contextvars.copy_context().run, self._run, workdir)
+        # A run cancelled before it started never removes its copy
+        future.add_done_callback(lambda done: done.cancelled() and shutil.rmtree(workdir, ignore_errors=True))
+        return future
+
+    def run(self, repo_path):
+        """Run a repository's tests and wait for the summary."""
+        return self.submit(repo_path).result()
+
+    def close(self):
+        """Stop accepting runs; queued runs are cancelled."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def format_test_summary(summary):
+    """One-line description of a test run summary, for logs."""
+    if summary["status"] in ("passed", "failed"):
+        return (f"Tests {summary['status']}: {summary['passed']} passed, {summary['failed']} failed, "
+                f"{summary['errors']} errors, {summary['skipped']} skipped")
+    if summary["status"] == "no_tests":
+        return "No tests were collected"
+    return f"Test run {summary['status']}: {summary.get('detail', '')}".strip()
+
+
+def create_test_runner():
+    """
+    Create the test runner configured by environment variables.
+
+    GRADING_RUN_TESTS=1 enables running each submission's tests (off by
+    default, since it executes student code). GRADING_TEST_WORKERS,
+    GRADING_TEST_TIMEOUT_SECONDS, GRADING_TEST_CPU_SECONDS and
+    GRADING_TEST_MEMORY_BYTES bound the runs. GRADING_TEST_SANDBOX is
+    "unshare" (default) to isolate runs from the network and the host's
+    files, or "none", which is unsafe: tests can then read the server's
+    credentials and other students' submissions.
+
+    Returns:
+        TestRunner or None when tests are not run
+    """
+    if os.getenv("GRADING_RUN_TESTS", "").lower() not in ("1", "true", "yes"):
+        return None
+
+    sandbox = os.getenv("GRADING_TEST_SANDBOX", "unshare").lower()
+    if sandbox not in ("unshare", "none"):
+        raise ValueError(f"Unknown GRADING_TEST_SANDBOX '{sandbox}', expected unshare or none")
+
+    return TestRunner(
+        workers=int(os.getenv("GRADING_TEST_WORKERS", DEFAULT_TEST_WORKERS)),
+        timeout_seconds=float(os.getenv("GRADING_TEST_TIMEOUT_SECONDS", DEFAULT_TEST_TIMEOUT_SECONDS)),
+        cpu_seconds=int(os.getenv("GRADING_TEST_CPU_SECONDS", DEFAULT_TEST_CPU_SECONDS)),
+        memory_bytes=int(os.getenv("GRADING_TEST_MEMORY_BYTES", DEFAULT_TEST_MEMORY_BYTES)),
+        isolate=sandbox == "unshare"
+    )
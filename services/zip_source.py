@@ -0,0 +1,478 @@
+"""
+Grading source for uploaded zip archives, read as they stream in.
+
+A zip archive is parsed from its local file headers as the bytes arrive,
+so an upload is never buffered whole, written to a temporary file or
+extracted. Only members whose basename matches a rubric batch entry are
+inflated into memory; every other member is skipped over (or inflated and
+discarded, when its size is only known after its data), and only its name
+is kept so entries resolve against the whole tree exactly as they do for
+a cloned repository.
+
+Member count, upload size, inflated size and compression ratio are all
+limited while streaming, so a zip bomb is rejected before it is expanded.
+"""
+
+import os
+import json
+import zlib
+import struct
+import asyncio
+import posixpath
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # pragma: no cover - only used by the upload endpoint
+    MultipartParser = None
+    parse_options_header = None
+
+from services.file_index import RepoFileIndex
+
+
+DEFAULT_UPLOAD_MAX_BYTES = 50 * 2 ** 20
+DEFAULT_UPLOAD_MAX_MEMBERS = 10000
+DEFAULT_UPLOAD_MAX_MEMBER_BYTES = 5 * 2 ** 20
+DEFAULT_UPLOAD_MAX_TOTAL_BYTES = 100 * 2 ** 20
+DEFAULT_UPLOAD_MAX_RATIO = 100
+
+# A member must inflate past this many bytes before its ratio is enforced,
+# so small, highly repetitive files are not mistaken for bombs
+RATIO_GRACE_BYTES = 64 * 1024
+
+# Largest rubric form field accepted ahead of the archive
+MAX_RUBRIC_FIELD_BYTES = 2 ** 20
+
+_LOCAL_HEADER = 0x04034b50
+_DATA_DESCRIPTOR = 0x08074b50
+_CENTRAL_HEADER = 0x02014b50
+_END_RECORDS = (0x06054b50, 0x06064b50, 0x07064b50)
+_LOCAL_HEADER_SIZE = 30
+_ZIP64_EXTRA = 0x0001
+
+_STORED = 0
+_DEFLATED = 8
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_FLAG_UTF8 = 0x800
+
+
+class ArchiveError(ValueError):
+    """Raised when an uploaded archive is malformed or unsupported."""
+
+
+class ArchiveTooLarge(ArchiveError):
+    """Raised when an uploaded archive exceeds a size, count or ratio limit."""
+
+
+class ZipLimits:
+    """Limits applied to an archive while it streams in."""
+
+    def __init__(self, max_bytes=DEFAULT_UPLOAD_MAX_BYTES, max_members=DEFAULT_UPLOAD_MAX_MEMBERS,
+                 max_member_bytes=DEFAULT_UPLOAD_MAX_MEMBER_BYTES, max_total_bytes=DEFAULT_UPLOAD_MAX_TOTAL_BYTES,
+                 max_ratio=DEFAULT_UPLOAD_MAX_RATIO):
+        """
+        Args:
+            max_bytes (int): Compressed size of the whole archive
+            max_members (int): Entries in the archive, directories included
+            max_member_bytes (int): Inflated size of one graded file
+            max_total_bytes (int): Bytes inflated across the whole archive
+            max_ratio (float): Inflated to compressed size of any member
+        """
+        self.max_bytes = max_bytes
+        self.max_members = max_members
+        self.max_member_bytes = max_member_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_ratio = max_ratio
+
+    @classmethod
+    def from_env(cls):
+        """
+        Read limits from GRADING_UPLOAD_MAX_BYTES, GRADING_UPLOAD_MAX_MEMBERS,
+        GRADING_UPLOAD_MAX_MEMBER_BYTES, GRADING_UPLOAD_MAX_TOTAL_BYTES and
+        GRADING_UPLOAD_MAX_RATIO.
+        """
+        return cls(
+            max_bytes=int(os.getenv("GRADING_UPLOAD_MAX_BYTES", DEFAULT_UPLOAD_MAX_BYTES)),
+            max_members=int(os.getenv("GRADING_UPLOAD_MAX_MEMBERS", DEFAULT_UPLOAD_MAX_MEMBERS)),
+            max_member_bytes=int(os.getenv("GRADING_UPLOAD_MAX_MEMBER_BYTES", DEFAULT_UPLOAD_MAX_MEMBER_BYTES)),
+            max_total_bytes=int(os.getenv("GRADING_UPLOAD_MAX_TOTAL_BYTES", DEFAULT_UPLOAD_MAX_TOTAL_BYTES)),
+            max_ratio=float(os.getenv("GRADING_UPLOAD_MAX_RATIO", DEFAULT_UPLOAD_MAX_RATIO))
+        )
+
+
+class ZipSource:
+    """Files read from an uploaded archive, graded in memory instead of from disk."""
+
+    def __init__(self, names, files):
+        """
+        Args:
+            names (list): Every file path in the archive
+            files (dict): Contents of the members that were read, by path
+        """
+        self.file_index = RepoFileIndex(names)
+        self.files = files
+
+    def __len__(self):
+        return len(self.file_index)
+
+    def read(self, path):
+        """Return a member's text, or None if it was not read from the archive."""
+        content = self.files.get(path)
+        return None if content is None else content.decode("utf-8", errors="ignore")
+
+
+def _member_path(name):
+    """Normalize an archive member name to a relative POSIX path."""
+    path = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    return "" if path in (".", "..") or path.startswith("../") else path
+
+
+class ZipStreamReader:
+    """
+    Push parser that reads the wanted members of a zip archive as bytes arrive.
+
+    Call feed() with each chunk of the archive in order and close() at the
+    end to get a ZipSource. Only stored and deflated members are supported,
+    which is what git, GitHub and common zip tools produce.
+    """
+
+    def __init__(self, entries, limits=None):
+        """
+        Args:
+            entries (iterable): File entries named in the rubric batches
+            limits (ZipLimits, optional): Defaults to ZipLimits.from_env()
+        """
+        self.limits = limits or ZipLimits.from_env()
+        self.received = 0
+        self.inflated = 0
+        self.names = []
+        self.files = {}
+        self._wanted = {posixpath.basename(_member_path(entry)) for entry in entries} - {""}
+        self._buffer = bytearray()
+        self._members = 0
+        self._member = None
+        self._finished = False
+
+    def feed(self, data):
+        """Parse the next chunk of the archive."""
+        self.received += len(data)
+        if self.received > self.limits.max_bytes:
+            raise ArchiveTooLarge(f"Archive is larger than {self.limits.max_bytes} bytes")
+        if self._finished:
+            # The central directory repeats what the local headers said
+            return
+        self._buffer += data
+        while not self._finished and self._step():
+            pass
+
+    def close(self):
+        """Finish parsing and return the archive's files."""
+        if not self._finished:
+            if self.received == 0:
+                raise ArchiveError("Archive is empty")
+            raise ArchiveError("Archive is truncated")
+        return ZipSource(self.names, self.files)
+
+    def _take(self, size):
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+    def _step(self):
+        """Consume one record or data chunk; returns False when more bytes are needed."""
+        if self._member is not None:
+            return self._read_member_data()
+
+        if len(self._buffer) < 4:
+            return False
+        signature = struct.unpack_from("<I", self._buffer)[0]
+        if signature in (_CENTRAL_HEADER, *_END_RECORDS):
+            self._finished = True
+            return False
+        if signature != _LOCAL_HEADER:
+            raise ArchiveError("Not a zip archive" if not self._members else "Corrupt zip archive")
+        return self._read_local_header()
+
+    def _read_local_header(self):
+        if len(self._buffer) < _LOCAL_HEADER_SIZE:
+            return False
+        (_, _, flags, method, _, _, crc, compressed_size, size,
+         name_length, extra_length) = struct.unpack_from("<IHHHHHIIIHH", self._buffer)
+        if len(self._buffer) < _LOCAL_HEADER_SIZE + name_length + extra_length:
+            return False
+
+        self._take(_LOCAL_HEADER_SIZE)
+        raw_name = self._take(name_length)
+        extra = self._take(extra_length)
+
+        self._members += 1
+        if self._members > self.limits.max_members:
+            raise ArchiveTooLarge(f"Archive has more than {self.limits.max_members} entries")
+
+        zip64 = False
+        if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            size, compressed_size = self._zip64_sizes(extra, size, compressed_size)
+            zip64 = True
+
+        name = raw_name.decode("utf-8" if flags & _FLAG_UTF8 else "cp437", errors="replace")
+        path = _member_path(name)
+        is_file = bool(path) and not name.endswith("/")
+        if is_file:
+            self.names.append(path)
+
+        keep = is_file and posixpath.basename(path) in self._wanted
+        has_descriptor = bool(flags & _FLAG_DATA_DESCRIPTOR)
+        if keep and (flags & _FLAG_ENCRYPTED or method not in (_STORED, _DEFLATED)):
+            raise ArchiveError(f"'{path}' is encrypted or uses an unsupported compression method")
+        if has_descriptor and method != _DEFLATED:
+            # Without a size up front, only a deflate stream marks its own end
+            raise ArchiveError(f"'{path}' has no size in its header and is not deflated")
+        if keep and not has_descriptor and size > self.limits.max_member_bytes:
+            raise ArchiveTooLarge(f"'{path}' is larger than {self.limits.max_member_bytes} bytes")
+
+        self._member = {
+            "path": path,
+            "keep": keep,
+            "method": method,
+            "crc": crc,
+            "size": size,
+            "remaining": None if has_descriptor else compressed_size,
+            "zip64": zip64,
+            "consumed": 0,
+            "output": bytearray() if keep else None,
+            "output_size": 0,
+            "inflater": zlib.decompressobj(-15) if method == _DEFLATED and (keep or has_descriptor) else None,
+            "descriptor": has_descriptor,
+            "data_done": False
+        }
+        return True
+
+    def _zip64_sizes(self, extra, size, compressed_size):
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, length = struct.unpack_from("<HH", extra, offset)
+            if header_id == _ZIP64_EXTRA:
+                values = iter(struct.unpack_from(f"<{length // 8}Q", extra, offset + 4))
+                if size == 0xFFFFFFFF:
+                    size = next(values)
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = next(values)
+                return size, compressed_size
+            offset += 4 + length
+        raise ArchiveError("Zip64 member is missing its extended sizes")
+
+    def _read_member_data(self):
+        member = self._member
+        if member["data_done"]:
+            return self._read_descriptor()
+
+        if not self._buffer:
+            return member["remaining"] == 0 and self._finish_data()
+
+        remaining = member["remaining"]
+        chunk = self._take(len(self._buffer) if remaining is None else min(remaining, len(self._buffer)))
+
+        if member["inflater"] is None:
+            # Skipped, or stored: the bytes are the file
+            if member["keep"]:
+                self._add_output(chunk)
+        else:
+            self._inflate(chunk)
+
+        member["consumed"] += len(chunk)
+        if remaining is not None:
+            member["remaining"] -= len(chunk)
+            if member["remaining"] == 0:
+                return self._finish_data()
+        return True
+
+    def _inflate(self, chunk):
+        member = self._member
+        inflater = member["inflater"]
+        if inflater.eof:
+            raise ArchiveError(f"'{member['path']}' has data after its end")
+        data = chunk
+        while data and not inflater.eof:
+            output = inflater.decompress(data, 256 * 1024)
+            data = inflater.unconsumed_tail
+            consumed = len(chunk) - len(data) - len(inflater.unused_data)
+            self._add_output(output, member["consumed"] + consumed)
+        if inflater.eof and inflater.unused_data:
+            if member["remaining"] is not None:
+                raise ArchiveError(f"'{member['path']}' has data after its end")
+            # Bytes past the deflate stream belong to the data descriptor
+            unused = bytes(inflater.unused_data)
+            self._buffer[:0] = unused
+            member["consumed"] -= len(unused)
+        if inflater.eof and member["remaining"] is None:
+            member["data_done"] = True
+
+    def _add_output(self, output, compressed=None):
+        member = self._member
+        member["output_size"] += len(output)
+        self.inflated += len(output)
+        if self.inflated > self.limits.max_total_bytes:
+            raise ArchiveTooLarge(f"Archive inflates to more than {self.limits.max_total_bytes} bytes")
+        if member["keep"]:
+            if member["output_size"] > self.limits.max_member_bytes:
+                raise ArchiveTooLarge(f"'{member['path']}' is larger than {self.limits.max_member_bytes} bytes")
+            member["output"] += output
+        if compressed is not None and member["output_size"] > RATIO_GRACE_BYTES \
+                and member["output_size"] > self.limits.max_ratio * max(compressed, 1):
+            raise ArchiveTooLarge(
+                f"'{member['path']}' exceeds the compression ratio limit of {self.limits.max_ratio:g}"
+            )
+
+    def _finish_data(self):
+        member = self._member
+        if member["inflater"] is not None and not member["inflater"].eof:
+            raise ArchiveError(f"'{member['path']}' has a truncated deflate stream")
+        member["data_done"] = True
+        if not member["descriptor"]:
+            self._finish_member(member["crc"], member["size"])
+        return True
+
+    def _read_descriptor(self):
+        member = self._member
+        sizes = 16 if member["zip64"] else 8
+        if len(self._buffer) < 4:
+            return False
+        has_signature = struct.unpack_from("<I", self._buffer)[0] == _DATA_DESCRIPTOR
+        length = (4 if has_signature else 0) + 4 + sizes
+        if len(self._buffer) < length:
+            return False
+        descriptor = self._take(length)[4 if has_signature else 0:]
+        crc = struct.unpack_from("<I", descriptor)[0]
+        size = struct.unpack_from("<Q" if member["zip64"] else "<I", descriptor, 4 + sizes // 2)[0]
+        self._finish_member(crc, size)
+        return True
+
+    def _finish_member(self, crc, size):
+        member = self._member
+        self._member = None
+        if not member["keep"]:
+            return
+        content = bytes(member["output"])
+        if len(content) != size or zlib.crc32(content) != crc:
+            raise ArchiveError(f"'{member['path']}' failed its size or CRC check")
+        self.files[member["path"]] = content
+
+
+def read_zip(data, entries, limits=None, chunk_size=64 * 1024):
+    """Read the wanted members of an in-memory zip archive."""
+    reader = ZipStreamReader(entries, limits)
+    for start in range(0, len(data), chunk_size):
+        reader.feed(data[start:start + chunk_size])
+    return reader.close()
+
+
+async def read_grading_upload(content_type, body, limits=None):
+    """
+    Read a multipart/form-data grading upload as it streams in.
+
+    The form must send a "rubric" field, the rubric JSON, before an
+    "archive" file field holding the zip, so the archive can be filtered
+    to the batch-listed files while it is still arriving.
+
+    Args:
+        content_type (str): The request's Content-Type header
+        body: Async iterator over the request body's chunks
+        limits (ZipLimits, optional): Defaults to ZipLimits.from_env()
+
+    Returns:
+        tuple: (rubric_json, ZipSource)
+
+    Raises:
+        ArchiveError: If the form or archive is invalid
+        ArchiveTooLarge: If the archive exceeds a limit
+    """
+    if MultipartParser is None:
+        raise RuntimeError("python-multipart is required for archive uploads")
+    limits = limits or ZipLimits.from_env()
+
+    media_type, options = parse_options_header(content_type)
+    if media_type != b"multipart/form-data" or b"boundary" not in options:
+        raise ArchiveError("Upload must be multipart/form-data")
+
+    state = {"headers": {}, "field": None, "name": None, "value": bytearray()}
+    form = {"rubric": None, "reader": None}
+
+    def on_part_begin():
+        state["headers"] = {}
+        state["field"] = b""
+        state["value"] = bytearray()
+
+    def on_header_field(data, start, end):
+        state["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        name = state["field"].lower()
+        state["headers"][name] = state["headers"].get(name, b"") + data[start:end]
+
+    def on_header_end():
+        state["field"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition"))
+        state["name"] = disposition.get(b"name", b"").decode("utf-8", errors="replace")
+        if state["name"] == "archive":
+            if form["rubric"] is None:
+                raise ArchiveError("The rubric field must come before the archive")
+            form["reader"] = ZipStreamReader(_rubric_entries(form["rubric"]), limits)
+
+    def on_part_data(data, start, end):
+        if state["name"] == "archive":
+            form["reader"].feed(data[start:end])
+        elif state["name"] == "rubric":
+            state["value"] += data[start:end]
+            if len(state["value"]) > MAX_RUBRIC_FIELD_BYTES:
+                raise ArchiveTooLarge("The rubric field is too large")
+
+    def on_part_end():
+        if state["name"] == "rubric":
+            form["rubric"] = _parse_rubric(bytes(state["value"]))
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished
+    })
+
+    received = 0
+    async for chunk in body:
+        received += len(chunk)
+        if received > limits.max_bytes + MAX_RUBRIC_FIELD_BYTES:
+            # Bounds fields other than the archive and rubric, which are ignored
+            raise ArchiveTooLarge(f"Upload is larger than {limits.max_bytes} bytes")
+        if chunk:
+            # Inflating happens here; keep it off the event loop
+            await asyncio.to_thread(parser.write, chunk)
+    parser.finalize()
+
+    if form["reader"] is None:
+        raise ArchiveError("The upload has no archive file field")
+    return form["rubric"], form["reader"].close()
+
+
+def _parse_rubric(value):
+    try:
+        rubric_json = json.loads(value)
+    except ValueError as e:
+        raise ArchiveError(f"The rubric field is not valid JSON: {e}")
+    if not isinstance(rubric_json, dict) or "rubric" not in rubric_json or "batches" not in rubric_json:
+        raise ArchiveError('The rubric field must be an object with "rubric" and "batches"')
+    batches = rubric_json["batches"]
+    if not isinstance(batches, list) or not all(
+        isinstance(file_batch, list) and all(isinstance(entry, str) for entry in file_batch)
+        for file_batch in batches
+    ):
+        raise ArchiveError('"batches" must be a list of lists of file names')
+    return rubric_json
+
+
+def _rubric_entries(rubric_json):
+    return [entry for file_batch in rubric_json["batches"] for entry in file_batch]
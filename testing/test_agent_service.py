@@ -4,18 +4,33 @@ Tests all functions in the AgentService class
 """
 
 import pytest
+import asyncio
+import json
 import os
 import sys
 import tempfile
 import shutil
+import threading
 import zipfile
 from pathlib import Path
-from unittest.mock import patch, MagicMock, mock_open
+from unittest.mock import patch, MagicMock, AsyncMock, mock_open
 
 # Add parent directory to Python path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from services.agent_service import AgentService, agent_service_function
+from services.agent_service import (
+    AgentService,
+    agent_service_function,
+    agent_service_function_async,
+    agent_service_stream_async,
+    grade_many_async,
+    resolve_sparse_paths
+)
+from services.batch_packer import count_tokens
+from services.metrics import request_timings
+from services.static_analysis import StaticAnalyzer
+from services.test_runner import TestRunner
+from langchain_core.messages import AIMessage
 
 
 @pytest.fixture
@@ -45,6 +60,42 @@ def temp_repo_dir():
         shutil.rmtree(temp_dir)
 
 
+@pytest.fixture
+def origin_repo():
+    """Create a local git repository with code, data and nested files."""
+    import subprocess
+    temp_dir = tempfile.mkdtemp()
+    files = {
+        "main.py": "def main():\n    pass",
+        "src/helper.py": "def helper():\n    return 1",
+        "data/big.csv": "a,b\n" * 1000
+    }
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(temp_dir, name)), exist_ok=True)
+        with open(os.path.join(temp_dir, name), "w") as f:
+            f.write(content)
+    
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.run(["git", "init", "-q"], cwd=temp_dir, check=True)
+    subprocess.run(["git", "config", "uploadpack.allowFilter", "true"], cwd=temp_dir, check=True)
+    subprocess.run(["git", "add", "."], cwd=temp_dir, check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "initial"], cwd=temp_dir, check=True)
+    
+    yield temp_dir
+    
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _list_worktree(path):
+    """List files in a checkout, excluding the .git directory."""
+    return sorted(
+        os.path.relpath(os.path.join(root, name), path)
+        for root, dirs, files in os.walk(path)
+        if '.git' not in Path(root).relative_to(path).parts
+        for name in files
+    )
+
+
 @pytest.fixture
 def sample_zip_data():
     """Create sample zip file data."""
@@ -87,6 +138,14 @@ class TestValidateEnvironment:
         with patch.dict(os.environ, {'AZURE_OPENAI_ENDPOINT': 'test', 'AZURE_OPENAI_DEPLOYMENT_NAME': 'test'}, clear=True):
             with pytest.raises(Exception, match="AZURE_OPENAI_API_KEY"):
                 AgentService()
+    
+    def test_validate_environment_deployment_list(self):
+        """Test that a deployment list replaces the single-deployment variables."""
+        config = [{"endpoint": "https://a.openai.azure.com", "deployment": "gpt-4o", "api_key": "key"}]
+        with patch.dict(os.environ, {'AZURE_OPENAI_DEPLOYMENTS': json.dumps(config)}, clear=True):
+            agent_service = AgentService()
+        
+        assert agent_service.router.primary.endpoint == "https://a.openai.azure.com"
 
 
 class TestExtractRepoFromGithub:
@@ -125,6 +184,264 @@ class TestExtractRepoFromGithub:
             agent_service.extract_repo_from_github("https://github.com/test/repo.git")
 
 
+    @patch('subprocess.run')
+    def test_extract_repo_pinned_commit(self, mock_run, agent_service):
+        """Test that a pinned commit is fetched and checked out after cloning."""
+        mock_run.return_value = MagicMock(returncode=0, stderr="")
+        with patch('tempfile.mkdtemp', return_value='/tmp/test_repo'):
+            agent_service.extract_repo_from_github("https://github.com/test/repo.git", commit="abc1234")
+        
+        commands = [call[0][0] for call in mock_run.call_args_list]
+        assert commands[1] == ['git', 'fetch', '--depth', '1', 'origin', 'abc1234']
+        assert commands[2] == ['git', 'checkout', '--detach', 'FETCH_HEAD']
+
+
+class TestResolveSparsePaths:
+    """Tests for resolve_sparse_paths."""
+    
+    def test_exact_path(self):
+        """Test that full paths match exactly."""
+        tree = ["src/a.py", "tests/src/a.py"]
+        assert resolve_sparse_paths(tree, ["src/a.py"]) == ["src/a.py"]
+    
+    def test_filename_only(self):
+        """Test that bare filenames resolve through the tree listing."""
+        tree = ["README.md", "src/a.py", "lib/a.py", "src/b.py"]
+        assert resolve_sparse_paths(tree, ["a.py"]) == ["lib/a.py", "src/a.py"]
+    
+    def test_normalizes_entries(self):
+        """Test that leading ./ and / are ignored."""
+        tree = ["src/a.py", ".hidden.py"]
+        assert resolve_sparse_paths(tree, ["./src/a.py", "/.hidden.py"]) == [".hidden.py", "src/a.py"]
+    
+    def test_basename_fallback(self):
+        """Test that a wrong directory still matches on the filename."""
+        assert resolve_sparse_paths(["app/a.py"], ["src/a.py"]) == ["app/a.py"]
+    
+    def test_missing(self):
+        """Test that unknown files resolve to nothing."""
+        assert resolve_sparse_paths(["src/a.py"], ["missing.py"]) == []
+
+
+class TestSparseClone:
+    """Tests for the sparse clone mode of extract_repo_from_github."""
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_sparse_clone_only_requested_files(self, mock_validate, agent_service, origin_repo):
+        """Test that only the batch-listed files are checked out."""
+        path = agent_service.extract_repo_from_github(f"file://{origin_repo}", paths=["helper.py", "main.py"])
+        try:
+            assert _list_worktree(path) == ["main.py", "src/helper.py"]
+        finally:
+            shutil.rmtree(path)
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_async_sparse_clone(self, mock_validate, agent_service, origin_repo):
+        """Test the async sparse clone."""
+        path = asyncio.run(agent_service.aextract_repo_from_github(f"file://{origin_repo}", paths=["helper.py"]))
+        try:
+            assert _list_worktree(path) == ["src/helper.py"]
+        finally:
+            shutil.rmtree(path)
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_sparse_clone_falls_back_to_full(self, mock_validate, agent_service, origin_repo):
+        """Test that a failed sparse clone falls back to a full shallow clone."""
+        path = agent_service.extract_repo_from_github(f"file://{origin_repo}", paths=["missing.py"])
+        try:
+            assert "data/big.csv" in _list_worktree(path)
+        finally:
+            shutil.rmtree(path)
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_full_clone_mode(self, mock_validate, agent_service, origin_repo):
+        """Test that GRADING_CLONE_MODE=full skips the sparse clone."""
+        with patch.dict(os.environ, {'GRADING_CLONE_MODE': 'full'}), \
+             patch.object(AgentService, '_sparse_clone') as mock_sparse:
+            path = agent_service.extract_repo_from_github(f"file://{origin_repo}", paths=["main.py"])
+        try:
+            mock_sparse.assert_not_called()
+            assert "data/big.csv" in _list_worktree(path)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestPipelinedClone:
+    """Tests for cloning without a checkout and checking out each batch as it is graded."""
+    
+    @pytest.fixture
+    def pipelined(self):
+        with patch.dict(os.environ, {'GRADING_CLONE_MODE': 'pipelined'}):
+            yield
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_batches_checked_out_on_demand(self, mock_validate, pipelined, agent_service, origin_repo):
+        """Test that the clone has the tree listing but only checked-out batches have files."""
+        checkout = agent_service.acquire_checkout(f"file://{origin_repo}", paths=["main.py", "helper.py"])
+        try:
+            assert _list_worktree(checkout.repo_path) == []
+            assert checkout.file_index.resolve("helper.py") == ("src/helper.py", None)
+            
+            agent_service.checkout_batch(checkout, ["helper.py"])
+            assert _list_worktree(checkout.repo_path) == ["src/helper.py"]
+            
+            agent_service.checkout_batch(checkout, ["main.py", "helper.py"])
+            assert _list_worktree(checkout.repo_path) == ["main.py", "src/helper.py"]
+            assert checkout.pending_paths(["main.py", "helper.py"]) == []
+        finally:
+            shutil.rmtree(checkout.repo_path)
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_pinned_commit(self, mock_validate, pipelined, agent_service, origin_repo):
+        """Test that a pinned commit's files are checked out, not the latest ones."""
+        import subprocess
+        git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        first = subprocess.run(["git", "rev-parse", "HEAD"], cwd=origin_repo, capture_output=True, text=True).stdout.strip()
+        with open(os.path.join(origin_repo, "main.py"), "w") as f:
+            f.write("def main():\n    return 2\n")
+        subprocess.run(git + ["commit", "-qam", "change main"], cwd=origin_repo, check=True)
+        subprocess.run(["git", "config", "uploadpack.allowAnySHA1InWant", "true"], cwd=origin_repo, check=True)
+        
+        checkout = asyncio.run(agent_service.aacquire_checkout(f"file://{origin_repo}", first, ["main.py"]))
+        try:
+            asyncio.run(agent_service.acheckout_batch(checkout, ["main.py"]))
+            with open(os.path.join(checkout.repo_path, "main.py")) as f:
+                assert f.read() == "def main():\n    pass"
+        finally:
+            shutil.rmtree(checkout.repo_path)
+    
+    def test_disabled_cases(self, agent_service):
+        """Test that pipelining is skipped outside its mode, with a repo cache or for full trees."""
+        assert agent_service.acquire_checkout("https://github.com/a/repo", paths=["main.py"]) is None
+        with patch.dict(os.environ, {'GRADING_CLONE_MODE': 'pipelined'}):
+            assert agent_service.acquire_checkout("https://github.com/a/repo", paths=None) is None
+            agent_service.repo_cache = MagicMock()
+            assert agent_service.acquire_checkout("https://github.com/a/repo", paths=["main.py"]) is None
+    
+    @patch.object(AgentService, '_validate_github_url')
+    def test_failed_clone_falls_back(self, mock_validate, pipelined, agent_service, temp_repo_dir):
+        """Test that a failed pipelined clone returns None so the caller clones normally."""
+        assert agent_service.acquire_checkout(f"file://{temp_repo_dir}/missing", paths=["main.py"]) is None
+    
+    @pytest.mark.parametrize("use_async", [False, True])
+    @patch.object(AgentService, '_validate_github_url')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_grading_checks_out_each_batch(self, mock_init_llm, mock_validate, use_async, pipelined,
+                                           agent_service, origin_repo):
+        """Test that a pipelined submission is graded without cloning its unused files."""
+        content = '{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content=content)
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=content))
+        mock_init_llm.return_value = mock_llm
+        agent_service.result_cache = None
+        
+        url = f"file://{origin_repo}"
+        rubric_json = {"batches": [["main.py"], ["helper.py"]], "rubric": "Test rubric"}
+        checkouts = []
+        original = AgentService.checkout_batch
+        
+        def record_checkout(self, checkout, file_batch):
+            original(self, checkout, file_batch)
+            checkouts.append(_list_worktree(checkout.repo_path))
+        
+        def grade():
+            if use_async:
+                return asyncio.run(agent_service_function_async(url, rubric_json, agent=agent_service))
+            return agent_service_function(url, rubric_json, agent=agent_service)
+        
+        with patch.object(AgentService, 'checkout_batch', record_checkout):
+            first = grade()
+            second = grade()
+        
+        assert [result["hundred_point_score"] for result in first] == [83, 83]
+        assert all("data/big.csv" not in files for files in checkouts)
+        assert len(checkouts) == 2
+        # Unchanged batches are answered from the regrade store without a checkout
+        assert all(result["reused"] for result in second)
+
+
+class TestAcquireRepo:
+    """Tests for acquire_repo and release_repo."""
+    
+    @patch.object(AgentService, 'extract_repo_from_github', return_value='/tmp/test_repo')
+    def test_acquire_without_cache_clones(self, mock_extract, agent_service):
+        """Test that a temporary clone is used when the repo cache is disabled."""
+        agent_service.repo_cache = None
+        
+        assert agent_service.acquire_repo("https://github.com/test/repo.git") == '/tmp/test_repo'
+        mock_extract.assert_called_once_with("https://github.com/test/repo.git", None, None)
+    
+    @patch.object(AgentService, 'extract_repo_from_github')
+    def test_acquire_with_cache(self, mock_extract, agent_service):
+        """Test that the repo cache serves the working tree when enabled."""
+        agent_service.repo_cache = MagicMock()
+        agent_service.repo_cache.acquire.return_value = '/cache/abc'
+        
+        path = agent_service.acquire_repo("https://github.com/test/repo.git", "abc1234")
+        
+        assert path == '/cache/abc'
+        agent_service.repo_cache.acquire.assert_called_once_with("https://github.com/test/repo.git", "abc1234")
+        mock_extract.assert_not_called()
+    
+    def test_acquire_with_cache_validates_url(self, agent_service):
+        """Test that the URL is still validated when the repo cache is enabled."""
+        agent_service.repo_cache = MagicMock()
+        
+        with pytest.raises(ValueError, match="Invalid GitHub URL"):
+            agent_service.acquire_repo("https://gitlab.com/test/repo.git")
+    
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_release_cached_repo_keeps_tree(self, mock_cleanup, agent_service):
+        """Test that cached trees are released rather than deleted."""
+        agent_service.repo_cache = MagicMock()
+        agent_service.repo_cache.owns.return_value = True
+        
+        agent_service.release_repo('/cache/abc')
+        
+        agent_service.repo_cache.release.assert_called_once_with('/cache/abc')
+        mock_cleanup.assert_not_called()
+    
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_release_temp_clone_deletes_tree(self, mock_cleanup, agent_service):
+        """Test that temporary clones are deleted."""
+        agent_service.repo_cache = None
+        
+        agent_service.release_repo('/tmp/test_repo')
+        
+        mock_cleanup.assert_called_once_with('/tmp/test_repo')
+
+
+class TestAsyncExtractRepoFromGithub:
+    """Tests for aextract_repo_from_github method."""
+    
+    def test_aextract_repo_invalid_url_format(self, agent_service):
+        """Test with invalid GitHub URL."""
+        with pytest.raises(ValueError, match="Invalid GitHub URL"):
+            asyncio.run(agent_service.aextract_repo_from_github("https://gitlab.com/test/repo.git"))
+    
+    def test_aextract_repo_success(self, agent_service):
+        """Test successful async repository cloning."""
+        mock_process = MagicMock(returncode=0)
+        mock_process.communicate = AsyncMock(return_value=(b"", b""))
+        
+        with patch('asyncio.create_subprocess_exec', AsyncMock(return_value=mock_process)) as mock_exec, \
+             patch('tempfile.mkdtemp', return_value='/tmp/test_repo'):
+            result = asyncio.run(agent_service.aextract_repo_from_github("https://github.com/test/repo.git"))
+        
+        assert result == '/tmp/test_repo'
+        assert mock_exec.call_args[0][:2] == ('git', 'clone')
+    
+    def test_aextract_repo_git_failure(self, agent_service):
+        """Test async git clone failure."""
+        mock_process = MagicMock(returncode=1)
+        mock_process.communicate = AsyncMock(return_value=(b"", b"Permission denied"))
+        
+        with patch('asyncio.create_subprocess_exec', AsyncMock(return_value=mock_process)):
+            with pytest.raises(Exception, match="Git clone failed"):
+                asyncio.run(agent_service.aextract_repo_from_github("https://github.com/test/repo.git"))
+
+
 class TestExtractZipFromData:
     """Tests for _extract_zip_from_data method."""
     
@@ -162,6 +479,36 @@ class TestFindFileInRepo:
         result = agent_service._find_file_in_repo(temp_repo_dir, "nonexistent.py")
         assert result is None
     
+    def test_find_file_ambiguous_warning(self, agent_service, temp_repo_dir):
+        """Test that an ambiguous name is resolved with a warning."""
+        for directory in ("a", "b"):
+            os.makedirs(os.path.join(temp_repo_dir, directory))
+            with open(os.path.join(temp_repo_dir, directory, "dup.py"), "w") as f:
+                f.write("x = 1")
+        warnings = []
+        
+        result = agent_service._find_file_in_repo(temp_repo_dir, "dup.py", warnings=warnings)
+        
+        assert result == os.path.join(temp_repo_dir, "a", "dup.py")
+        assert len(warnings) == 1 and "ambiguous" in warnings[0]
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_batch_result_reports_file_warnings(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that missing files are listed in the batch result."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        file_index = agent_service.build_file_index(temp_repo_dir)
+        
+        result = agent_service._process_single_batch(
+            temp_repo_dir, ["test.py", "missing.py"], 1, "Test rubric", file_index=file_index
+        )
+        
+        assert result['hundred_point_score'] == 83
+        assert result['file_warnings'] == ["File 'missing.py' not found in repository"]
+    
 
 
 class TestLoadCodeFiles:
@@ -179,8 +526,8 @@ class TestLoadCodeFiles:
         with pytest.raises(Exception, match="No code files could be loaded"):
             agent_service._load_code_files(temp_repo_dir, ["nonexistent.py"])
     
-    def test_load_code_files_limit(self, agent_service, temp_repo_dir):
-        """Test file limit enforcement."""
+    def test_load_code_files_no_file_limit(self, agent_service, temp_repo_dir):
+        """Test that every file is loaded; token packing decides how they are sent."""
         # Create 7 files
         for i in range(7):
             with open(os.path.join(temp_repo_dir, f"file{i}.py"), "w") as f:
@@ -189,8 +536,44 @@ class TestLoadCodeFiles:
         file_list = [f"file{i}.py" for i in range(7)]
         result = agent_service._load_code_files(temp_repo_dir, file_list)
         
-        # Should only load first 5
-        assert len(result) == 5
+        assert len(result) == 7
+    
+    def test_load_code_files_skips_binary_and_truncates_large(self, agent_service, temp_repo_dir):
+        """Test that binary files are skipped and oversized files bounded, with notes for each."""
+        with open(os.path.join(temp_repo_dir, "data.py"), "wb") as f:
+            f.write(b"\x00\x01" * 1000)
+        with open(os.path.join(temp_repo_dir, "big.py"), "w") as f:
+            f.write("x = 1\n" * 10000)
+        notes = []
+        
+        with patch.dict(os.environ, {"GRADING_MAX_FILE_BYTES": "1000"}):
+            result = agent_service._load_code_files(
+                temp_repo_dir, ["test.py", "data.py", "big.py"], notes=notes
+            )
+        
+        assert sorted(result) == ["big.py", "test.py"]
+        assert len(result["big.py"]) < 1100
+        assert notes == [
+            {"file": "data.py", "status": "skipped", "reason": "binary", "size_bytes": 2000},
+            {"file": "big.py", "status": "truncated", "size_bytes": 60000, "kept_bytes": 996}
+        ]
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_batch_result_reports_skipped_files(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that skipped files are listed in the batch result."""
+        with open(os.path.join(temp_repo_dir, "data.py"), "wb") as f:
+            f.write(b"\x00" * 100)
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(temp_repo_dir, ["test.py", "data.py"], 1, "Test rubric")
+        
+        assert result["hundred_point_score"] == 83
+        assert result["skipped_files"] == [{"file": "data.py", "reason": "binary", "size_bytes": 100}]
+        assert "truncated_files" not in result
 
 
 class TestInitializeLLM:
@@ -204,6 +587,58 @@ class TestInitializeLLM:
         mock_azure_chat.assert_called_once()
         call_kwargs = mock_azure_chat.call_args[1]
         assert call_kwargs['temperature'] == 0
+    
+    @patch('services.agent_service.AzureChatOpenAI')
+    def test_initialize_llm_pooled_clients(self, mock_azure_chat, agent_service):
+        """Test that the LLM gets pooled HTTP clients sized from the environment."""
+        import httpx
+        with patch.dict(os.environ, {
+            'AZURE_OPENAI_POOL_SIZE': '7',
+            'AZURE_OPENAI_KEEPALIVE_SECONDS': '15'
+        }):
+            agent_service._initialize_llm()
+        
+            limits = agent_service._http_limits()
+        
+        call_kwargs = mock_azure_chat.call_args[1]
+        assert isinstance(call_kwargs['http_client'], httpx.Client)
+        assert isinstance(call_kwargs['http_async_client'], httpx.AsyncClient)
+        assert limits.max_connections == 7
+        assert limits.keepalive_expiry == 15
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_get_llm_reuses_client(self, mock_init_llm, agent_service):
+        """Test that the shared LLM client is created only once."""
+        first = agent_service._get_llm()
+        second = agent_service._get_llm()
+        
+        assert first is second
+        mock_init_llm.assert_called_once()
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_close_releases_client(self, mock_init_llm, agent_service):
+        """Test that close drops the shared client so the next call rebuilds it."""
+        agent_service._get_llm()
+        agent_service.close()
+        agent_service._get_llm()
+        
+        assert mock_init_llm.call_count == 2
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_warm_up_creates_client_per_deployment(self, mock_init_llm):
+        """Test that warm_up builds every deployment's client ahead of the first request."""
+        deployments = [
+            {"name": "east", "endpoint": "https://east.openai.azure.com", "deployment": "gpt", "api_key": "k1"},
+            {"name": "west", "endpoint": "https://west.openai.azure.com", "deployment": "gpt", "api_key": "k2"}
+        ]
+        with patch.dict(os.environ, {'AZURE_OPENAI_DEPLOYMENTS': json.dumps(deployments)}):
+            service = AgentService()
+        
+        service.warm_up()
+        service.warm_up()
+        
+        assert mock_init_llm.call_count == 2
+        assert set(service._llms) == {"east", "west"}
 
 
 class TestFormatCodeContent:
@@ -227,6 +662,82 @@ class TestFormatCodeContent:
         
         assert "File 1:" in result
         assert "File 2:" in result
+    
+    def test_format_code_content_with_analysis(self, agent_service):
+        """Test that a file's static analysis summary is labelled and placed above its code."""
+        code_files = {"test.py": "def hello():\n    pass", "notes.md": "# Notes"}
+        result = agent_service._format_code_content(code_files, {"test.py": "2 lines, 0 classes, 1 functions"})
+        
+        analysis, code = result.split("def hello():")
+        assert "[Static analysis by the grader, not the student]\n2 lines, 0 classes, 1 functions" in analysis
+        assert "Static analysis" not in code
+
+
+class TestStaticAnalysisPrePass:
+    """Tests for analyzing and stripping a batch before it is packed and graded."""
+    
+    SOURCE = "# Helper module\n\n\ndef helper():\n    return 1  # one\n"
+    
+    @pytest.fixture
+    def stripping_service(self, agent_service):
+        agent_service.static_analyzer = StaticAnalyzer(workers=0, strip_comments=True, strip_blank_lines=True)
+        return agent_service
+    
+    @pytest.mark.parametrize("mode", ["sync", "async"])
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_prompt_has_summary_and_stripped_code(self, mock_init_llm, mock_load_files, mode,
+                                                  stripping_service, temp_repo_dir):
+        mock_load_files.return_value = {"helper.py": self.SOURCE}
+        content = '{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content=content)
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=content))
+        mock_init_llm.return_value = mock_llm
+        
+        with request_timings("test") as timings:
+            if mode == "sync":
+                stripping_service._process_single_batch(temp_repo_dir, ["helper.py"], 1, "Test rubric")
+                prompt = mock_llm.invoke.call_args[0][0]
+            else:
+                asyncio.run(stripping_service._aprocess_single_batch(temp_repo_dir, ["helper.py"], 1, "Test rubric"))
+                prompt = mock_llm.ainvoke.call_args[0][0]
+        
+        code = prompt[1].content
+        assert "docstrings 0/2 (missing: module, helper)" in code
+        assert "def helper():\n    return 1\n" in code
+        assert "# one" not in code and "# Helper module" not in code
+        assert "analysis" in timings.as_dict()["stages"]
+    
+    def test_truncated_files_not_analyzed(self, stripping_service):
+        notes = [{"file": "helper.py", "status": "truncated", "size_bytes": 10, "kept_bytes": 5}]
+        
+        code_files, summaries = stripping_service._analyze_code_files({"helper.py": self.SOURCE}, notes)
+        
+        assert code_files == {"helper.py": self.SOURCE}
+        assert summaries == {}
+    
+    def test_disabled(self, agent_service):
+        agent_service.static_analyzer = None
+        
+        assert agent_service._analyze_code_files({"helper.py": self.SOURCE}) == ({"helper.py": self.SOURCE}, {})
+    
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_analysis_failure_grades_without_summaries(self, mock_init_llm, mock_load_files,
+                                                        stripping_service, temp_repo_dir):
+        mock_load_files.return_value = {"helper.py": self.SOURCE}
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        with patch.object(StaticAnalyzer, '_run', side_effect=RecursionError("too deep")):
+            result = stripping_service._process_single_batch(temp_repo_dir, ["helper.py"], 1, "Test rubric")
+        
+        assert result["hundred_point_score"] == 83
+        assert "# Helper module" in mock_llm.invoke.call_args[0][0][1].content
 
 
 class TestProcessSingleBatch:
@@ -254,6 +765,572 @@ class TestProcessSingleBatch:
         assert result['rubric_score'] == "5/6"
         assert result['hundred_point_score'] == 83
         assert 'file_name' in result
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_requests_structured_output(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that the LLM is asked for output matching the BatchGrade schema."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        response_format = mock_llm.invoke.call_args[1]["response_format"]
+        assert response_format["type"] == "json_schema"
+        assert response_format["json_schema"]["name"] == "batch_grade"
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_malformed_response_repaired(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that malformed JSON is repaired locally without another LLM call."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='Sure!\n{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good\ncode.",}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        mock_llm.invoke.assert_called_once()
+        assert result == {
+            "rubric_score": "5/6",
+            "hundred_point_score": 83,
+            "review": "Good\ncode.",
+            "file_name": ["test.py"]
+        }
+
+
+class TestPromptLayout:
+    """Tests for the cache-friendly prompt layout and token usage reporting."""
+    
+    def test_rubric_in_stable_prefix(self, agent_service):
+        """Test that instructions and rubric form a system prefix shared by every batch."""
+        first = agent_service._build_prompt("=== a.py ===\nx = 1", "Test rubric")
+        second = agent_service._build_prompt("=== b.py ===\ny = 2", "Test rubric")
+        
+        assert [message.type for message in first] == ["system", "human"]
+        assert "Test rubric" in first[0].content
+        assert "x = 1" not in first[0].content
+        assert "x = 1" in first[1].content
+        assert first[0].content == second[0].content
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_cached_tokens_reported(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that cached prompt tokens from the response are surfaced."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = AIMessage(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}',
+            usage_metadata={
+                "input_tokens": 2000,
+                "output_tokens": 100,
+                "total_tokens": 2100,
+                "input_token_details": {"cache_read": 1536}
+            }
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert result['usage'] == {"prompt_tokens": 2000, "completion_tokens": 100, "cached_tokens": 1536}
+        stats = agent_service.usage_stats()
+        assert stats['llm_calls'] == 1
+        assert stats['cached_tokens'] == 1536
+        assert stats['cached_token_ratio'] == 0.768
+    
+    def test_usage_from_response_metadata(self, agent_service):
+        """Test reading usage from the raw token_usage response metadata."""
+        response = AIMessage(content="{}", response_metadata={"token_usage": {
+            "prompt_tokens": 1200,
+            "completion_tokens": 50,
+            "prompt_tokens_details": {"cached_tokens": 1024}
+        }})
+        
+        assert agent_service._response_usage(response) == {
+            "prompt_tokens": 1200, "completion_tokens": 50, "cached_tokens": 1024
+        }
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_usage_not_replayed_from_result_cache(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that a result cache hit does not report the original call's usage."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = AIMessage(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}',
+            usage_metadata={"input_tokens": 2000, "output_tokens": 100, "total_tokens": 2100}
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        cached = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert "usage" not in cached
+        assert agent_service.usage_stats()['llm_calls'] == 1
+
+
+def _rate_limit_error(retry_after_ms="10"):
+    import httpx
+    import openai
+    request = httpx.Request("POST", "https://test.openai.azure.com/chat/completions")
+    response = httpx.Response(429, headers={"retry-after-ms": retry_after_ms}, request=request)
+    return openai.RateLimitError("Too many requests", response=response, body=None)
+
+
+class TestLLMRetries:
+    """Tests for rate limiting and retrying LLM calls."""
+    
+    @pytest.fixture(autouse=True)
+    def fast_backoff(self):
+        with patch.dict(os.environ, {
+            'AZURE_OPENAI_API_KEY': 'test-key',
+            'AZURE_OPENAI_ENDPOINT': 'https://test.openai.azure.com',
+            'AZURE_OPENAI_DEPLOYMENT_NAME': 'test-deployment',
+            "GRADING_LLM_RETRY_BASE_SECONDS": "0.001",
+            "GRADING_LLM_RETRY_MAX_SECONDS": "0.01"
+        }):
+            yield
+    
+    @pytest.fixture
+    def agent_service(self, fast_backoff):
+        return AgentService()
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_throttled_call_retried(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that a 429 is retried instead of failing the batch."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = [
+            _rate_limit_error(),
+            MagicMock(content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}')
+        ]
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert result['hundred_point_score'] == 83
+        assert mock_llm.invoke.call_count == 2
+        assert agent_service.router.primary.limiter.stats()['throttled'] == 1
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_non_transient_error_not_retried(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that other errors fail the batch on the first attempt."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = Exception("Invalid request")
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert result['success'] is False
+        assert "Invalid request" in result['analysis_result']
+        mock_llm.invoke.assert_called_once()
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_retries_exhausted(self, mock_init_llm, temp_repo_dir):
+        """Test that the batch fails once the retry budget is used up."""
+        with patch.dict(os.environ, {"GRADING_LLM_MAX_RETRIES": "2"}):
+            agent_service = AgentService()
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = _rate_limit_error("1")
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert result['success'] is False
+        assert "Too many requests" in result['analysis_result']
+        assert mock_llm.invoke.call_count == 3
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_async_throttled_call_retried(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that the async path retries 429s too."""
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(side_effect=[
+            _rate_limit_error(),
+            MagicMock(content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}')
+        ])
+        mock_init_llm.return_value = mock_llm
+        
+        result = asyncio.run(agent_service._aprocess_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric"))
+        
+        assert result['hundred_point_score'] == 83
+        assert mock_llm.ainvoke.await_count == 2
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_failover_to_healthy_deployment(self, mock_init_llm, temp_repo_dir):
+        """Test that a throttled deployment's batch is served by another deployment."""
+        config = [
+            {"name": "throttled", "endpoint": "https://a.openai.azure.com", "deployment": "gpt-4o"},
+            {"name": "healthy", "endpoint": "https://b.openai.azure.com", "deployment": "gpt-4o"}
+        ]
+        with patch.dict(os.environ, {"AZURE_OPENAI_DEPLOYMENTS": json.dumps(config)}):
+            agent_service = AgentService()
+        
+        throttled_llm = MagicMock()
+        throttled_llm.invoke.side_effect = _rate_limit_error("60000")
+        healthy_llm = MagicMock()
+        healthy_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.side_effect = lambda deployment: (
+            throttled_llm if deployment.name == "throttled" else healthy_llm
+        )
+        
+        for batch_number in range(1, 4):
+            result = agent_service._process_single_batch(
+                temp_repo_dir, ["test.py"], batch_number, f"Rubric {batch_number}"
+            )
+            assert result['hundred_point_score'] == 83
+        
+        assert healthy_llm.invoke.call_count == 3
+        assert throttled_llm.invoke.call_count <= 1
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_response_headers_adapt_limiter(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that rate-limit headers on a response configure the limiter."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = AIMessage(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}',
+            response_metadata={"headers": {"x-ratelimit-limit-tokens": "80000"}}
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert agent_service.router.primary.limiter.stats()['tokens_per_minute'] == 80000
+
+
+class TestResultCaching:
+    """Tests for the grading result cache in batch processing."""
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_cache_hit_skips_llm(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that regrading identical code does not call the LLM again."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        first = agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        second = agent_service._process_single_batch(temp_repo_dir, ["./test.py"], 2, "Test rubric")
+        
+        assert first['hundred_point_score'] == second['hundred_point_score'] == 83
+        assert second['file_name'] == ["./test.py"]
+        mock_llm.invoke.assert_called_once()
+        assert agent_service.result_cache.stats()["hits"] == 1
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_async_cache_access_off_the_event_loop(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that the async path reads and writes the cache, which may be SQLite, in a thread."""
+        content = '{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=content))
+        mock_init_llm.return_value = mock_llm
+        cache = agent_service.result_cache
+        threads = []
+        
+        def record(method):
+            def call(*args):
+                threads.append(threading.current_thread())
+                return method(*args)
+            return call
+        
+        async def grade():
+            with patch.object(cache, 'get', side_effect=record(cache.get)), \
+                 patch.object(cache, 'set', side_effect=record(cache.set)):
+                await agent_service._aprocess_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+            return threading.current_thread()
+        
+        loop_thread = asyncio.run(grade())
+        
+        assert len(threads) == 2
+        assert loop_thread not in threads
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_cache_miss_on_rubric_change(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that a different rubric is graded again."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Rubric A")
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Rubric B")
+        
+        assert mock_llm.invoke.call_count == 2
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_unparsed_results_not_cached(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that responses that failed to parse are not reused."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content="not json")
+        mock_init_llm.return_value = mock_llm
+        
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        
+        assert mock_llm.invoke.call_count == 2
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_cache_hit_skips_ainvoke(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that the async path also serves cache hits."""
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        ))
+        mock_init_llm.return_value = mock_llm
+        
+        for _ in range(2):
+            asyncio.run(agent_service._aprocess_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric"))
+        
+        mock_llm.ainvoke.assert_awaited_once()
+
+
+class TestIncrementalRegrade:
+    """Tests for regrading only the batches whose files changed."""
+
+    @pytest.mark.parametrize("use_async", [False, True])
+    @patch.object(AgentService, '_validate_github_url')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_only_changed_batches_call_llm(self, mock_init_llm, mock_validate, use_async, agent_service,
+                                           origin_repo):
+        """Test that a regrade after a new commit reuses the unchanged batch's grade."""
+        import subprocess
+        content = '{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content=content)
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=content))
+        mock_init_llm.return_value = mock_llm
+        # Reuse must come from the regrade store, not the content cache
+        agent_service.result_cache = None
+
+        url = f"file://{origin_repo}"
+        rubric_json = {"batches": [["main.py"], ["helper.py"]], "rubric": "Test rubric"}
+
+        def grade():
+            if use_async:
+                return asyncio.run(agent_service_function_async(url, rubric_json, agent=agent_service))
+            return agent_service_function(url, rubric_json, agent=agent_service)
+
+        def llm_calls():
+            return mock_llm.ainvoke.await_count if use_async else mock_llm.invoke.call_count
+
+        first = grade()
+        assert llm_calls() == 2
+        assert not any(result.get("reused") for result in first)
+
+        with open(os.path.join(origin_repo, "src/helper.py"), "a") as f:
+            f.write("\n\ndef extra():\n    return 2\n")
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                        "commit", "-qam", "change helper"], cwd=origin_repo, check=True)
+
+        second = grade()
+
+        assert llm_calls() == 3
+        assert second[0]["reused"] is True
+        assert second[0]["hundred_point_score"] == 83
+        assert "reused" not in second[1]
+        assert agent_service.regrade_store.stats()["reused"] == 1
+
+
+class TestTestResults:
+    """Tests for supplied test results and sandboxed test runs alongside grading."""
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_test_results_in_every_prompt(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that supplied test results follow the code and change the cache key."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        agent_service._process_single_batch(temp_repo_dir, ["test.py"], 1, "Test rubric")
+        agent_service._process_single_batch(
+            temp_repo_dir, ["test.py"], 1, "Test rubric", test_results="1 failed, 4 passed"
+        )
+        
+        assert mock_llm.invoke.call_count == 2
+        code = mock_llm.invoke.call_args[0][0][1].content
+        assert code.index("def hello():") < code.index("Test Results") < code.index("1 failed, 4 passed")
+    
+    def test_clone_paths(self, agent_service):
+        """Test that the whole tree is cloned only when its tests will run."""
+        batches = [["main.py"], ["helper.py", "main.py"]]
+        
+        assert agent_service.clone_paths(batches, run_tests=True) == ["main.py", "helper.py"]
+        agent_service.test_runner = TestRunner(workers=1, isolate=False)
+        try:
+            assert agent_service.clone_paths(batches, run_tests=False) == ["main.py", "helper.py"]
+            assert agent_service.clone_paths(batches, run_tests=True) is None
+        finally:
+            agent_service.test_runner.close()
+    
+    @pytest.mark.parametrize("use_async", [False, True])
+    @patch.object(AgentService, '_validate_github_url')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_tests_run_alongside_batches(self, mock_init_llm, mock_validate, use_async, agent_service,
+                                         origin_repo):
+        """Test that the repository's tests run and their summary is reported after the batches."""
+        import subprocess
+        with open(os.path.join(origin_repo, "test_main.py"), "w") as f:
+            f.write("from main import main\n\ndef test_main():\n    assert main() is None\n")
+        subprocess.run(["git", "add", "."], cwd=origin_repo, check=True)
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                        "commit", "-qm", "add tests"], cwd=origin_repo, check=True)
+        
+        content = '{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(content=content)
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(content=content))
+        mock_init_llm.return_value = mock_llm
+        agent_service.test_runner = TestRunner(workers=1, isolate=False)
+        
+        url = f"file://{origin_repo}"
+        rubric_json = {"batches": [["main.py"]], "rubric": "Test rubric"}
+        summaries = []
+        try:
+            if use_async:
+                results = asyncio.run(agent_service_function_async(
+                    url, rubric_json, agent=agent_service, tests_callback=summaries.append
+                ))
+            else:
+                results = agent_service_function(url, rubric_json, agent=agent_service, tests_callback=summaries.append)
+        finally:
+            agent_service.test_runner.close()
+        
+        assert results[0]["hundred_point_score"] == 83
+        assert len(summaries) == 1
+        assert summaries[0]["status"] == "passed"
+        assert summaries[0]["passed"] == 1
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_no_tests_without_callback(self, mock_init_llm, agent_service):
+        """Test that callers that do not want a test run do not start one."""
+        agent_service.test_runner = MagicMock()
+        
+        async def fake_acquire(github_url, commit=None, paths=None):
+            assert paths == ["main.py"]
+            return None
+        
+        with patch.object(agent_service, 'aacquire_repo', side_effect=fake_acquire), \
+             patch.object(agent_service, 'build_file_index', return_value=None), \
+             patch.object(agent_service, '_aprocess_single_batch', AsyncMock(return_value={"ok": True})):
+            asyncio.run(agent_service_function_async(
+                "https://github.com/user/repo", {"batches": [["main.py"]], "rubric": "Test rubric"},
+                agent=agent_service
+            ))
+        
+        agent_service.test_runner.submit.assert_not_called()
+
+
+class TestTokenPacking:
+    """Tests for splitting batches that exceed the token budget."""
+    
+    @pytest.fixture
+    def large_repo(self, temp_repo_dir):
+        for name in ("one.py", "two.py"):
+            with open(os.path.join(temp_repo_dir, name), "w") as f:
+                f.write("".join(f"{name[:-3]}_{i} = {i}\n" for i in range(200)))
+        return temp_repo_dir
+    
+    def _one_file_budget(self, agent_service, repo_path):
+        """Token budget that fits one of the large files but not both."""
+        code_files, summaries = agent_service._analyze_code_files(agent_service._load_code_files(repo_path, ["one.py"]))
+        prompt = agent_service._prompt_text(agent_service._format_code_content(code_files, summaries), "Test rubric")
+        return str(count_tokens(prompt) + 20)
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_oversized_batch_split_and_merged(self, mock_init_llm, agent_service, large_repo):
+        """Test that an over-budget batch is graded in chunks and merged."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.side_effect = [
+            MagicMock(content='{"rubric_score": "6/6", "hundred_point_score": 100, "review": "Great."}'),
+            MagicMock(content='{"rubric_score": "3/6", "hundred_point_score": 50, "review": "Weak."}')
+        ]
+        mock_init_llm.return_value = mock_llm
+        
+        with patch.dict(os.environ, {"GRADING_TOKEN_BUDGET": self._one_file_budget(agent_service, large_repo)}):
+            result = agent_service._process_single_batch(large_repo, ["one.py", "two.py"], 1, "Test rubric")
+        
+        assert mock_llm.invoke.call_count == 2
+        assert result['chunks'] == 2
+        assert result['hundred_point_score'] == 75
+        assert result['file_name'] == ["one.py", "two.py"]
+        assert "Part 1 (one.py): Great." in result['review']
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_async_chunks_graded_concurrently(self, mock_init_llm, agent_service, large_repo):
+        """Test that the async path grades every chunk and merges the results."""
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 80, "review": "Good."}'
+        ))
+        mock_init_llm.return_value = mock_llm
+        
+        with patch.dict(os.environ, {"GRADING_TOKEN_BUDGET": self._one_file_budget(agent_service, large_repo)}):
+            result = asyncio.run(
+                agent_service._aprocess_single_batch(large_repo, ["one.py", "two.py"], 1, "Test rubric")
+            )
+        
+        assert mock_llm.ainvoke.await_count == 2
+        assert result['chunks'] == 2
+        assert result['rubric_score'] == "5/6"
+        assert result['hundred_point_score'] == 80
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_batch_within_budget_single_call(self, mock_init_llm, agent_service, large_repo):
+        """Test that a batch within the default budget is one LLM call."""
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        result = agent_service._process_single_batch(large_repo, ["one.py", "two.py"], 1, "Test rubric")
+        
+        mock_llm.invoke.assert_called_once()
+        assert "chunks" not in result
+
+
+class TestAsyncProcessSingleBatch:
+    """Tests for _aprocess_single_batch method."""
+    
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_aprocess_single_batch_success(self, mock_init_llm, mock_load_files, agent_service, temp_repo_dir):
+        """Test successful async batch processing with ainvoke."""
+        mock_load_files.return_value = {"test.py": "def test(): pass"}
+        
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(
+            content='```json\n{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}\n```'
+        ))
+        mock_init_llm.return_value = mock_llm
+        
+        result = asyncio.run(agent_service._aprocess_single_batch(
+            temp_repo_dir,
+            ["test.py"],
+            1,
+            "Test rubric"
+        ))
+        
+        assert result['hundred_point_score'] == 83
+        assert result['file_name'] == ["test.py"]
+        mock_llm.ainvoke.assert_awaited_once()
+        mock_llm.invoke.assert_not_called()
+    
+    @patch.object(AgentService, '_initialize_llm')
+    def test_aprocess_single_batch_error(self, mock_init_llm, agent_service, temp_repo_dir):
+        """Test that async batch errors are returned as failed batch results."""
+        result = asyncio.run(agent_service._aprocess_single_batch(
+            temp_repo_dir,
+            ["missing.py"],
+            2,
+            "Test rubric"
+        ))
+        
+        assert result['success'] is False
+        assert result['batch_number'] == 2
+        mock_init_llm.assert_not_called()
 
 
 class TestCleanupTempDirectory:
@@ -301,3 +1378,516 @@ class TestAgentServiceFunction:
         mock_extract.assert_called_once()
         mock_process.assert_called_once()
         mock_cleanup.assert_called_once()
+    
+    @patch.object(AgentService, 'extract_repo_from_github')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_preserves_batch_order(self, mock_cleanup, mock_extract):
+        """Test that concurrent batches are returned in the order they were given."""
+        import time
+        mock_extract.return_value = "/tmp/test_repo"
+        
+        def fake_process(self, repo_path, file_batch, batch_number, rubric_text, **kwargs):
+            # Earlier batches finish last
+            time.sleep(0.05 * (4 - batch_number))
+            return {"batch_number": batch_number, "file_name": file_batch}
+        
+        rubric_json = {
+            "batches": [["a.py"], ["b.py"], ["c.py"]],
+            "rubric": "Test rubric"
+        }
+        
+        with patch.object(AgentService, '_process_single_batch', fake_process):
+            result = agent_service_function("https://github.com/test/repo.git", rubric_json)
+        
+        assert [r["batch_number"] for r in result] == [1, 2, 3]
+        assert [r["file_name"] for r in result] == [["a.py"], ["b.py"], ["c.py"]]
+    
+    @patch.object(AgentService, 'extract_repo_from_github')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_runs_batches_concurrently(self, mock_cleanup, mock_extract):
+        """Test that wall-clock time is close to the slowest batch, not the sum."""
+        import time
+        mock_extract.return_value = "/tmp/test_repo"
+        
+        def fake_process(self, repo_path, file_batch, batch_number, rubric_text, **kwargs):
+            time.sleep(0.2)
+            return {"batch_number": batch_number}
+        
+        rubric_json = {
+            "batches": [[f"code{i}.py"] for i in range(6)],
+            "rubric": "Test rubric"
+        }
+        
+        with patch.object(AgentService, '_process_single_batch', fake_process):
+            start = time.monotonic()
+            result = agent_service_function(
+                "https://github.com/test/repo.git", rubric_json, max_concurrency=6
+            )
+            elapsed = time.monotonic() - start
+        
+        assert len(result) == 6
+        assert elapsed < 0.6
+    
+    @patch.object(AgentService, 'extract_repo_from_github')
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_isolates_batch_failures(self, mock_cleanup, mock_init_llm, mock_load_files, mock_extract):
+        """Test that one failing batch does not affect the others."""
+        mock_extract.return_value = "/tmp/test_repo"
+        
+        def fake_load(repo_path, file_list, file_index=None, warnings=None, notes=None):
+            if file_list == ["bad.py"]:
+                raise Exception("No code files could be loaded")
+            return {file_list[0]: "def test(): pass"}
+        
+        mock_load_files.side_effect = fake_load
+        mock_llm = MagicMock()
+        mock_llm.invoke.return_value = MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        )
+        mock_init_llm.return_value = mock_llm
+        
+        rubric_json = {
+            "batches": [["good.py"], ["bad.py"], ["other.py"]],
+            "rubric": "Test rubric"
+        }
+        
+        result = agent_service_function("https://github.com/test/repo.git", rubric_json)
+        
+        assert result[0]["hundred_point_score"] == 83
+        assert result[1]["success"] is False
+        assert result[1]["batch_number"] == 2
+        assert result[2]["hundred_point_score"] == 83
+    
+    @patch.object(AgentService, 'extract_repo_from_github')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_progress_callback(self, mock_cleanup, mock_extract):
+        """Test that progress is reported once per finished batch."""
+        mock_extract.return_value = "/tmp/test_repo"
+        progress = []
+        
+        def fake_process(self, repo_path, file_batch, batch_number, rubric_text, **kwargs):
+            return {"batch_number": batch_number}
+        
+        rubric_json = {"batches": [["a.py"], ["b.py"]], "rubric": "Test rubric"}
+        
+        with patch.object(AgentService, '_process_single_batch', fake_process):
+            agent_service_function(
+                "https://github.com/test/repo.git",
+                rubric_json,
+                progress_callback=lambda number, total, result: progress.append((number, total, result))
+            )
+        
+        assert sorted(progress, key=lambda item: item[0]) == [
+            (1, 2, {"batch_number": 1}),
+            (2, 2, {"batch_number": 2})
+        ]
+    
+    def test_agent_service_function_invalid_concurrency(self):
+        """Test that a non-positive concurrency limit is reported as an error."""
+        rubric_json = {"batches": [["test.py"]], "rubric": "Test rubric"}
+        
+        with patch.object(AgentService, 'extract_repo_from_github', return_value="/tmp/test_repo"), \
+             patch.object(AgentService, '_cleanup_temp_directory'):
+            result = agent_service_function(
+                "https://github.com/test/repo.git", rubric_json, max_concurrency=0
+            )
+        
+        assert result["success"] is False
+        assert "max_concurrency" in result["error"]
+
+
+class TestAgentServiceFunctionAsync:
+    """Tests for agent_service_function_async."""
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_async_success(self, mock_cleanup, mock_extract):
+        """Test that batches are graded concurrently and returned in order."""
+        import time
+        mock_extract.return_value = "/tmp/test_repo"
+        
+        async def fake_process(self, repo_path, file_batch, batch_number, rubric_text, **kwargs):
+            await asyncio.sleep(0.05 * (4 - batch_number))
+            return {"batch_number": batch_number, "file_name": file_batch}
+        
+        rubric_json = {
+            "batches": [["a.py"], ["b.py"], ["c.py"]],
+            "rubric": "Test rubric"
+        }
+        
+        with patch.object(AgentService, '_aprocess_single_batch', fake_process):
+            start = time.monotonic()
+            result = asyncio.run(agent_service_function_async(
+                "https://github.com/test/repo.git", rubric_json
+            ))
+            elapsed = time.monotonic() - start
+        
+        assert [r["batch_number"] for r in result] == [1, 2, 3]
+        assert elapsed < 0.3
+        mock_extract.assert_awaited_once()
+        mock_cleanup.assert_called_once_with("/tmp/test_repo")
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    @patch.object(AgentService, '_initialize_llm')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_async_records_stage_timings(self, mock_cleanup, mock_init_llm,
+                                                                 mock_extract, temp_repo_dir):
+        """Test that every pipeline stage and the token counts reach the request timings."""
+        from services.metrics import request_timings
+        mock_extract.return_value = temp_repo_dir
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=AIMessage(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}',
+            usage_metadata={"input_tokens": 500, "output_tokens": 40, "total_tokens": 540}
+        ))
+        mock_init_llm.return_value = mock_llm
+        rubric_json = {"batches": [["test.py"]], "rubric": "Timing rubric"}
+        
+        async def run():
+            with request_timings("test") as timings:
+                await agent_service_function_async("https://github.com/test/repo.git", rubric_json)
+            return timings.as_dict()
+        
+        timings = asyncio.run(run())
+        
+        assert {"clone", "index", "load", "prompt", "llm_wait", "llm", "parse"} <= set(timings["stages"])
+        assert timings["tokens"]["prompt_tokens"] == 500
+        assert timings["batches"][0]["completion_tokens"] == 40
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    def test_agent_service_function_async_clone_error(self, mock_extract):
+        """Test that clone failures are returned as an error dict."""
+        mock_extract.side_effect = Exception("Git clone failed: not found")
+        
+        rubric_json = {"batches": [["test.py"]], "rubric": "Test rubric"}
+        result = asyncio.run(agent_service_function_async(
+            "https://github.com/test/repo.git", rubric_json
+        ))
+        
+        assert result["success"] is False
+        assert "Git clone failed" in result["error"]
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_agent_service_function_async_shares_llm(self, mock_cleanup, mock_init_llm, mock_load_files, mock_extract, agent_service):
+        """Test that every batch and request reuses the service's LLM client."""
+        mock_extract.return_value = "/tmp/test_repo"
+        mock_load_files.side_effect = lambda repo_path, file_list, *args: {file_list[0]: f"# {file_list[0]}"}
+        agent_service.result_cache = None
+        agent_service.regrade_store = None
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        ))
+        mock_init_llm.return_value = mock_llm
+        
+        rubric_json = {"batches": [["a.py"], ["b.py"], ["c.py"]], "rubric": "Test rubric"}
+        
+        for _ in range(2):
+            result = asyncio.run(agent_service_function_async(
+                "https://github.com/test/repo.git", rubric_json, agent=agent_service
+            ))
+            assert len(result) == 3
+        
+        mock_init_llm.assert_called_once()
+        assert mock_llm.ainvoke.await_count == 6
+
+
+    @patch.object(AgentService, 'aacquire_repo', new_callable=AsyncMock)
+    @patch.object(AgentService, '_initialize_llm')
+    def test_agent_service_function_async_grades_archive(self, mock_init_llm, mock_acquire, agent_service):
+        """Test that an uploaded archive is graded in memory without cloning."""
+        import io
+        from services.zip_source import read_zip
+        
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('repo-main/main.py', 'def main():\n    pass\n')
+            archive.writestr('repo-main/src/helper.py', 'def helper():\n    return 1\n')
+        rubric_json = {"batches": [["main.py"], ["helper.py"], ["missing.py"]], "rubric": "Test rubric"}
+        source = read_zip(buffer.getvalue(), ["main.py", "helper.py", "missing.py"])
+        
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = AsyncMock(return_value=MagicMock(
+            content='{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}'
+        ))
+        mock_init_llm.return_value = mock_llm
+        
+        result = asyncio.run(agent_service_function_async(
+            None, rubric_json, agent=agent_service, archive=source
+        ))
+        
+        mock_acquire.assert_not_awaited()
+        assert result[0]["hundred_point_score"] == 83
+        assert result[1]["hundred_point_score"] == 83
+        assert result[2]["success"] is False
+        assert "not found" in result[2]["file_warnings"][0]
+        prompts = [call.args[0][1].content for call in mock_llm.ainvoke.await_args_list]
+        assert any("repo-main/src/helper.py" in prompt for prompt in prompts)
+
+
+class TestGradeManyAsync:
+    """Tests for grade_many_async."""
+    
+    def test_grade_many_yields_every_student(self, agent_service):
+        """Test that every link is graded and yielded as it completes."""
+        async def fake_grade(github_link, rubric_json, max_concurrency=None, agent=None, grading_slot=None):
+            await asyncio.sleep(0.05 if github_link.endswith("slow") else 0)
+            return [{"graded": github_link}]
+        
+        async def collect():
+            return [
+                item async for item in grade_many_async(
+                    ["https://github.com/a/slow", "https://github.com/b/fast"],
+                    {"batches": [["a.py"]], "rubric": "Test rubric"},
+                    agent=agent_service
+                )
+            ]
+        
+        with patch('services.agent_service.agent_service_function_async', fake_grade):
+            results = asyncio.run(collect())
+        
+        assert [index for index, _, _ in results] == [1, 0]
+        assert results[0][2] == [{"graded": "https://github.com/b/fast"}]
+    
+    def test_grade_many_bounds_students(self, agent_service):
+        """Test that no more than bulk_concurrency students are graded, and prefetch more are cloned, at once."""
+        active = {"cloning": 0, "grading": 0}
+        peak = {"cloning": 0, "grading": 0}
+        
+        async def step(stage):
+            active[stage] += 1
+            peak[stage] = max(peak[stage], active[stage])
+            await asyncio.sleep(0.01)
+            active[stage] -= 1
+        
+        async def fake_grade(github_link, rubric_json, max_concurrency=None, agent=None, grading_slot=None):
+            await step("cloning")
+            async with grading_slot:
+                await step("grading")
+            return []
+        
+        async def collect():
+            return [
+                item async for item in grade_many_async(
+                    [f"https://github.com/s{i}/repo" for i in range(10)],
+                    {"batches": [], "rubric": "Test rubric"},
+                    agent=agent_service,
+                    bulk_concurrency=3,
+                    prefetch=2
+                )
+            ]
+        
+        with patch('services.agent_service.agent_service_function_async', fake_grade):
+            results = asyncio.run(collect())
+        
+        assert len(results) == 10
+        assert peak["grading"] == 3
+        assert peak["cloning"] == 5
+    
+    def test_next_student_clones_while_current_is_graded(self, agent_service):
+        """Test that with one grading slot, the second clone overlaps the first student's grading."""
+        events = []
+        
+        async def fake_grade(github_link, rubric_json, max_concurrency=None, agent=None, grading_slot=None):
+            name = github_link.rsplit("/", 2)[-2]
+            events.append(f"clone {name}")
+            await asyncio.sleep(0.01)
+            async with grading_slot:
+                events.append(f"grade {name}")
+                await asyncio.sleep(0.05)
+                events.append(f"graded {name}")
+            return []
+        
+        async def collect():
+            return [
+                item async for item in grade_many_async(
+                    ["https://github.com/a/repo", "https://github.com/b/repo"],
+                    {"batches": [], "rubric": "Test rubric"},
+                    agent=agent_service,
+                    bulk_concurrency=1,
+                    prefetch=1
+                )
+            ]
+        
+        with patch('services.agent_service.agent_service_function_async', fake_grade):
+            asyncio.run(collect())
+        
+        assert events.index("clone b") < events.index("graded a") < events.index("grade b")
+    
+    def test_closing_waits_for_cancelled_students(self, agent_service):
+        """Test that a consumer going away leaves no student still cleaning up."""
+        cleaned = []
+        
+        async def fake_grade(github_link, rubric_json, max_concurrency=None, agent=None, grading_slot=None):
+            try:
+                await asyncio.sleep(0 if github_link.endswith("fast") else 10)
+            finally:
+                # Cleanup that itself awaits, like removing a clone in a thread
+                await asyncio.sleep(0.01)
+                cleaned.append(github_link)
+            return []
+        
+        async def first_then_close():
+            results = grade_many_async(
+                ["https://github.com/a/fast", "https://github.com/b/slow", "https://github.com/c/slow"],
+                {"batches": [], "rubric": "Test rubric"},
+                agent=agent_service
+            )
+            await results.__anext__()
+            await results.aclose()
+            return list(cleaned)
+        
+        with patch('services.agent_service.agent_service_function_async', fake_grade):
+            cleaned_at_close = asyncio.run(first_then_close())
+        
+        assert len(cleaned_at_close) == 3
+
+
+class TestGlobalLimits:
+    """Tests for the global git and LLM concurrency limits."""
+    
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    def test_llm_limit_bounds_calls(self, mock_init_llm, mock_load_files):
+        """Test that concurrent LLM calls never exceed GRADING_LLM_CONCURRENCY."""
+        with patch.dict(os.environ, {
+            'AZURE_OPENAI_API_KEY': 'test-key',
+            'AZURE_OPENAI_ENDPOINT': 'https://test.openai.azure.com',
+            'AZURE_OPENAI_DEPLOYMENT_NAME': 'test-deployment',
+            'GRADING_LLM_CONCURRENCY': '2',
+            'GRADING_CACHE_BACKEND': 'none'
+        }):
+            agent = AgentService()
+        
+        active = 0
+        peak = 0
+        
+        async def fake_ainvoke(prompt, **kwargs):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return MagicMock(content='{"rubric_score": "1/1", "hundred_point_score": 100, "review": "ok"}')
+        
+        mock_load_files.return_value = {"test.py": "def test(): pass"}
+        mock_llm = MagicMock()
+        mock_llm.ainvoke = fake_ainvoke
+        mock_init_llm.return_value = mock_llm
+        
+        async def run_batches():
+            return await asyncio.gather(*(
+                agent._aprocess_single_batch("/tmp/repo", ["test.py"], i, "Test rubric")
+                for i in range(8)
+            ))
+        
+        results = asyncio.run(run_batches())
+        
+        assert all(result["hundred_point_score"] == 100 for result in results)
+        assert peak == 2
+    
+    def test_git_limit_bounds_clones(self, agent_service):
+        """Test that concurrent clones never exceed the git limit."""
+        from services.agent_service import _LoopLocalSemaphore
+        agent_service.git_limit = _LoopLocalSemaphore(1)
+        active = 0
+        peak = 0
+        
+        async def fake_extract(github_url, commit=None, paths=None):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return "/tmp/repo"
+        
+        async def clone_many():
+            return await asyncio.gather(*(
+                agent_service.aacquire_repo("https://github.com/test/repo.git") for _ in range(4)
+            ))
+        
+        with patch.object(agent_service, 'aextract_repo_from_github', fake_extract):
+            asyncio.run(clone_many())
+        
+        assert peak == 1
+
+
+def _collect_events(stream):
+    """Run an async event generator to completion and return its events."""
+    async def collect():
+        return [event async for event in stream]
+    return asyncio.run(collect())
+
+
+class TestAgentServiceStreamAsync:
+    """Tests for agent_service_stream_async."""
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_stream_event_order(self, mock_cleanup, mock_extract, agent_service):
+        """Test that clone, batch and done events arrive as work completes."""
+        mock_extract.return_value = "/tmp/test_repo"
+        
+        async def fake_process(self, repo_path, file_batch, batch_number, rubric_text, **kwargs):
+            await asyncio.sleep(0.05 * (3 - batch_number))
+            return {"batch_number": batch_number}
+        
+        rubric_json = {"batches": [["a.py"], ["b.py"]], "rubric": "Test rubric"}
+        
+        with patch.object(AgentService, '_aprocess_single_batch', fake_process):
+            events = _collect_events(agent_service_stream_async(
+                "https://github.com/test/repo.git", rubric_json, agent=agent_service
+            ))
+        
+        assert [name for name, _ in events] == ["clone_complete", "batch", "batch", "done"]
+        assert events[0][1] == {"total_batches": 2}
+        assert [data["batch_number"] for name, data in events if name == "batch"] == [2, 1]
+        mock_cleanup.assert_called_once_with("/tmp/test_repo")
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    @patch.object(AgentService, '_load_code_files')
+    @patch.object(AgentService, '_initialize_llm')
+    @patch.object(AgentService, '_cleanup_temp_directory')
+    def test_stream_tokens(self, mock_cleanup, mock_init_llm, mock_load_files, mock_extract, agent_service):
+        """Test that LLM tokens are streamed before the batch result."""
+        from langchain_core.messages import AIMessageChunk
+        mock_extract.return_value = "/tmp/test_repo"
+        mock_load_files.return_value = {"test.py": "def test(): pass"}
+        
+        tokens = ['{"rubric_score": "5/6", ', '"hundred_point_score": 83, ', '"review": "Good."}']
+        
+        async def fake_astream(prompt, **kwargs):
+            for token in tokens:
+                yield AIMessageChunk(content=token)
+        
+        mock_llm = MagicMock()
+        mock_llm.astream = fake_astream
+        mock_init_llm.return_value = mock_llm
+        
+        rubric_json = {"batches": [["test.py"]], "rubric": "Test rubric"}
+        events = _collect_events(agent_service_stream_async(
+            "https://github.com/test/repo.git", rubric_json, agent=agent_service, stream_tokens=True
+        ))
+        
+        names = [name for name, _ in events]
+        assert names == ["clone_complete", "token", "token", "token", "batch", "done"]
+        assert "".join(data["content"] for name, data in events if name == "token") == "".join(tokens)
+        assert events[4][1]["result"]["hundred_point_score"] == 83
+        mock_llm.ainvoke.assert_not_called()
+    
+    @patch.object(AgentService, 'aextract_repo_from_github', new_callable=AsyncMock)
+    def test_stream_clone_error(self, mock_extract, agent_service):
+        """Test that a clone failure ends the stream with an error event."""
+        mock_extract.side_effect = Exception("Git clone failed: not found")
+        
+        rubric_json = {"batches": [["test.py"]], "rubric": "Test rubric"}
+        events = _collect_events(agent_service_stream_async(
+            "https://github.com/test/repo.git", rubric_json, agent=agent_service
+        ))
+        
+        assert events == [("error", {"error": "Git clone failed: not found"})]
@@ -0,0 +1,188 @@
+"""
+Unit tests for batch_packer.py
+Tests token counting, packing/splitting and merging of chunk results
+"""
+
+import pytest
+import os
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services import batch_packer
+from services.batch_packer import (
+    count_tokens,
+    download_encoding,
+    get_token_budget,
+    pack_code_files,
+    merge_chunk_results
+)
+
+
+def _format_code(code_files):
+    return "\n\n".join(f"=== {name} ===\n{content}" for name, content in code_files.items())
+
+
+def _render_prompt(combined_code):
+    return f"Grade this code against the rubric.\n{combined_code}"
+
+
+class TestCountTokens:
+    """Tests for count_tokens and get_token_budget."""
+    
+    def test_count_tokens(self):
+        """Test that longer text has more tokens."""
+        assert count_tokens("") == 0
+        assert 0 < count_tokens("def f(): pass") < count_tokens("def f(): pass\n" * 10)
+    
+    def test_uncached_encoding_never_downloaded(self, tmp_path):
+        """Test that a missing tokenizer falls back to estimates instead of going to the network."""
+        with patch.object(batch_packer, "_encoding", None), \
+             patch.object(batch_packer, "_load_encoding") as load, \
+             patch.dict(os.environ, {"GRADING_TOKENIZER_CACHE_DIR": str(tmp_path)}):
+            assert count_tokens("abcd" * 10) == 10
+        
+        load.assert_not_called()
+    
+    def test_cached_encoding_loaded(self, tmp_path):
+        """Test that an encoding saved at build time is used, without touching tiktoken's cache settings."""
+        def tiny():
+            return {
+                "name": "tiny",
+                "pat_str": r"\S+|\s+",
+                "mergeable_ranks": {bytes([value]): value for value in range(256)},
+                "special_tokens": {"<|end|>": 256}
+            }
+        
+        with patch.object(batch_packer, "_encoding", None), \
+             patch.dict("tiktoken_ext.openai_public.ENCODING_CONSTRUCTORS", {"tiny": tiny}), \
+             patch.dict(os.environ, {"GRADING_TOKENIZER_CACHE_DIR": str(tmp_path),
+                                     "GRADING_TOKENIZER_ENCODING": "tiny"}):
+            os.environ.pop("TIKTOKEN_CACHE_DIR", None)
+            download_encoding()
+            # Every byte is its own token in this encoding
+            assert count_tokens("def f(): pass") == 13
+            assert "TIKTOKEN_CACHE_DIR" not in os.environ
+        
+        assert sorted(os.listdir(tmp_path)) == ["tiny.json", "tiny.tiktoken"]
+    
+    def test_token_budget_from_env(self):
+        """Test reading the budget from GRADING_TOKEN_BUDGET."""
+        with patch.dict(os.environ, {"GRADING_TOKEN_BUDGET": "5000"}):
+            assert get_token_budget() == 5000
+    
+    def test_invalid_token_budget(self):
+        """Test that a non-positive budget is rejected."""
+        with patch.dict(os.environ, {"GRADING_TOKEN_BUDGET": "0"}):
+            with pytest.raises(ValueError):
+                get_token_budget()
+
+
+class TestPackCodeFiles:
+    """Tests for pack_code_files."""
+    
+    def test_small_files_share_one_chunk(self):
+        """Test that files that fit together are sent in one prompt."""
+        code_files = {"a.py": "x = 1", "b.py": "y = 2", "c.py": "z = 3"}
+        
+        chunks = pack_code_files(code_files, _format_code, _render_prompt, 1000)
+        
+        assert chunks == [code_files]
+    
+    def test_batch_split_across_chunks(self):
+        """Test that a batch over budget is split between files."""
+        code_files = {f"file{i}.py": f"value_{i} = {i}\n" * 40 for i in range(4)}
+        budget = count_tokens(_render_prompt(_format_code({"file0.py": code_files["file0.py"]}))) + 20
+        
+        chunks = pack_code_files(code_files, _format_code, _render_prompt, budget)
+        
+        assert len(chunks) == 4
+        assert [name for chunk in chunks for name in chunk] == list(code_files)
+        for chunk in chunks:
+            assert count_tokens(_render_prompt(_format_code(chunk))) <= budget
+    
+    def test_oversized_file_split_into_parts(self):
+        """Test that a single file over budget is split on line boundaries."""
+        content = "".join(f"line_{i} = {i}\n" for i in range(300))
+        
+        chunks = pack_code_files({"big.py": content}, _format_code, _render_prompt, 300)
+        
+        assert len(chunks) > 1
+        names = [name for chunk in chunks for name in chunk]
+        assert names[0] == f"big.py (part 1/{len(names)})"
+        assert "".join(part for chunk in chunks for part in chunk.values()) == content
+        for chunk in chunks:
+            assert count_tokens(_render_prompt(_format_code(chunk))) <= 300
+    
+    def test_minified_line_split(self):
+        """Test that a single very long line is still split to fit."""
+        content = "x" * 5000 + ";" + "y" * 5000
+        
+        chunks = pack_code_files({"min.js": content}, _format_code, _render_prompt, 200)
+        
+        assert "".join(part for chunk in chunks for part in chunk.values()) == content
+        for chunk in chunks:
+            assert count_tokens(_render_prompt(_format_code(chunk))) <= 200
+    
+    def test_budget_smaller_than_prompt(self):
+        """Test that a budget below the prompt overhead is an error."""
+        with pytest.raises(Exception) as exc_info:
+            pack_code_files({"a.py": "x = 1"}, _format_code, _render_prompt, 3)
+        
+        assert "Token budget" in str(exc_info.value)
+
+
+class TestMergeChunkResults:
+    """Tests for merge_chunk_results."""
+    
+    def test_weighted_merge(self):
+        """Test that scores are averaged by token weight and reviews joined."""
+        results = [
+            {"rubric_score": "6/6", "hundred_point_score": 100, "review": "Great."},
+            {"rubric_score": "3/6", "hundred_point_score": 50, "review": "Needs work."}
+        ]
+        
+        merged = merge_chunk_results(results, [300, 100], [["a.py"], ["b.py"]], ["a.py", "b.py"])
+        
+        assert merged["hundred_point_score"] == 88
+        assert merged["rubric_score"] == "5.2/6"
+        assert merged["review"] == "Part 1 (a.py): Great. Part 2 (b.py): Needs work."
+        assert merged["file_name"] == ["a.py", "b.py"]
+        assert merged["chunks"] == 2
+        assert "chunk_errors" not in merged
+    
+    def test_usage_summed(self):
+        """Test that token usage is summed across chunks."""
+        results = [
+            {"hundred_point_score": 80, "review": "A.", "usage": {"prompt_tokens": 100, "cached_tokens": 64}},
+            {"hundred_point_score": 60, "review": "B.", "usage": {"prompt_tokens": 50, "cached_tokens": 0}}
+        ]
+        
+        merged = merge_chunk_results(results, [1, 1], [["a.py"], ["b.py"]], ["a.py", "b.py"])
+        
+        assert merged["usage"] == {"prompt_tokens": 150, "cached_tokens": 64}
+    
+    def test_failed_chunk_reported(self):
+        """Test that a failed chunk is excluded from scores and reported."""
+        results = [
+            {"rubric_score": "4/6", "hundred_point_score": 70, "review": "Fine."},
+            {"overall_score": "Error processing batch 1: boom", "file_name": ["b.py"]}
+        ]
+        
+        merged = merge_chunk_results(results, [100, 100], [["a.py"], ["b.py"]], ["a.py", "b.py"])
+        
+        assert merged["hundred_point_score"] == 70
+        assert merged["chunk_errors"] == [{"files": ["b.py"], "error": "Error processing batch 1: boom"}]
+    
+    def test_all_chunks_failed(self):
+        """Test that the error is kept when no chunk was graded."""
+        results = [{"overall_score": "Error", "analysis_result": "boom"}] * 2
+        
+        merged = merge_chunk_results(results, [1, 1], [["a.py"], ["b.py"]], ["a.py", "b.py"])
+        
+        assert merged["overall_score"] == "Error"
+        assert merged["file_name"] == ["a.py", "b.py"]
+        assert len(merged["chunk_errors"]) == 2
@@ -0,0 +1,164 @@
+"""
+Unit tests for the offline benchmark harness
+Tests the fixture repository, the fake LLM, pipeline scenarios and the load-test app
+"""
+
+import pytest
+import os
+import sys
+import asyncio
+import subprocess
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import openai
+from langchain_core.messages import HumanMessage
+
+from benchmarks.fixtures import BENCH_ENVIRONMENT, FakeLLM, make_fixture_repo, make_rubric
+from benchmarks.bench_pipeline import compare_results, percentile, run_scenario
+
+
+@pytest.fixture
+def fixture_repo(tmp_path):
+    return make_fixture_repo(str(tmp_path), files=4, lines_per_file=30)
+
+
+@pytest.fixture
+def bench_env():
+    with patch.dict(os.environ, {**BENCH_ENVIRONMENT, "GRADING_CACHE_BACKEND": "none", "GRADING_REGRADE_DB": "none"}):
+        yield
+
+
+class TestFixtures:
+    """Tests for the generated repository and fake LLM."""
+
+    def test_fixture_repo_is_cloneable(self, fixture_repo, tmp_path):
+        url, file_names = fixture_repo
+
+        target = tmp_path / "clone"
+        subprocess.run(
+            ["git", "clone", "-q", "--filter=blob:none", "--depth", "1", url, str(target)],
+            check=True, capture_output=True
+        )
+
+        assert len(file_names) == 4
+        for name in file_names:
+            assert (target / name).read_text().startswith('"""Generated benchmark module')
+
+    def test_make_rubric_batches(self, fixture_repo):
+        _, file_names = fixture_repo
+
+        assert make_rubric(file_names, 3)["batches"] == [[name] for name in file_names[:3]]
+        with pytest.raises(ValueError):
+            make_rubric(file_names, 5)
+
+    def test_fake_llm_response_and_errors(self):
+        prompt = [HumanMessage(content="x" * 400)]
+
+        response = asyncio.run(FakeLLM(latency=0).ainvoke(prompt))
+        assert '"hundred_point_score": 83' in response.content
+        assert response.usage_metadata["input_tokens"] == 100
+
+        with pytest.raises(openai.APITimeoutError):
+            FakeLLM(latency=0, error_rate=1.0).invoke(prompt)
+
+
+class TestScenario:
+    """Tests for running and comparing benchmark scenarios."""
+
+    @pytest.mark.parametrize("target", ["async", "sync"])
+    def test_run_scenario(self, bench_env, fixture_repo, target):
+        url, file_names = fixture_repo
+
+        result = run_scenario(target, url, file_names, batches=2, concurrency=2, requests=3,
+                              llm_options={"latency": 0.0})
+
+        assert result["failures"] == 0
+        assert result["llm_calls"] == 6
+        assert result["requests_per_second"] > 0
+        assert result["p50_seconds"] <= result["p95_seconds"]
+
+    def test_percentile(self):
+        values = [float(value) for value in range(1, 101)]
+
+        assert percentile(values, 0.5) == 50.0
+        assert percentile(values, 0.95) == 95.0
+        assert percentile([], 0.5) is None
+
+    def test_compare_results_flags_regressions(self):
+        baseline = [{"target": "async", "batches": 1, "concurrency": 1,
+                     "p95_seconds": 1.0, "requests_per_second": 10.0}]
+        slower = [{**baseline[0], "p95_seconds": 1.5, "requests_per_second": 9.5}]
+
+        assert compare_results(baseline, baseline, 0.2) == []
+        assert len(compare_results(slower, baseline, 0.2)) == 1
+
+
+class TestLoadTest:
+    """Tests for the load-test app and result summary."""
+
+    def test_loop_lag_monitor_summary(self):
+        from benchmarks.load_app import LoopLagMonitor
+
+        monitor = LoopLagMonitor(interval=0.001)
+        assert monitor.summary()["samples"] == 0
+
+        monitor.samples = [0.001 * value for value in range(100)]
+        summary = monitor.summary()
+
+        assert summary["samples"] == 100
+        assert summary["p50_seconds"] == 0.05
+        assert summary["max_seconds"] == 0.099
+
+    def test_load_app_grades_and_reports_loop_lag(self, bench_env, tmp_path):
+        import httpx
+        import main
+        from benchmarks.fixtures import write_fixture_tree
+        from benchmarks.load_app import create_app
+
+        repo_dir = str(tmp_path / "repo")
+        file_names = write_fixture_tree(repo_dir, files=2, lines_per_file=20)
+
+        async def grade(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                return await client.post("/grade", json={
+                    "github_link": "https://github.com/benchmark/load-test.git",
+                    "rubric": make_rubric(file_names, 2)
+                })
+
+        with patch.dict(os.environ, {"BENCH_REPO_DIR": repo_dir, "BENCH_LLM_LATENCY": "0", "BENCH_LLM_JITTER": "0"}), \
+                patch.object(main, "grading_service"):
+            response = asyncio.run(grade(create_app()))
+
+        assert response.status_code == 200
+        assert response.json()["success"] is True
+        assert len(response.json()["analysis"]) == 2
+        assert response.headers["x-bench-worker"] == str(os.getpid())
+        assert "p99_seconds" in response.headers["x-bench-loop-lag"]
+        # The fixture tree is graded in place, never cloned or deleted
+        assert os.path.isdir(repo_dir)
+
+    def test_summarize_takes_worst_worker_lag(self):
+        from benchmarks.load_test import summarize
+
+        outcome = {
+            "latencies": [0.1, 0.2, 0.3, 0.4],
+            "failures": 1,
+            "seconds": 2.0,
+            "loop_lag": {
+                "1": {"p99_seconds": 0.01, "max_seconds": 0.02},
+                "2": {"p99_seconds": 0.03, "max_seconds": 0.05}
+            }
+        }
+
+        result = summarize(2, 10, outcome)
+
+        assert result["requests_per_second"] == 2.0
+        assert result["p95_seconds"] == 0.4
+        assert result["workers_seen"] == 2
+        assert result["loop_lag_p99_seconds"] == 0.03
+        assert result["loop_lag_max_seconds"] == 0.05
@@ -0,0 +1,99 @@
+"""
+Unit tests for file_index.py
+Tests building the index and resolving rubric file names
+"""
+
+import pytest
+import os
+import sys
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.file_index import RepoFileIndex
+
+
+@pytest.fixture
+def repo_tree(tmp_path):
+    """Create a repository tree with nested, duplicate and vendored files."""
+    files = [
+        "main.py",
+        "src/utils.py",
+        "tests/utils.py",
+        "src/models/user.py",
+        "node_modules/lib/index.js",
+        ".venv/lib/site.py",
+        "pkg/__pycache__/main.cpython-312.pyc"
+    ]
+    for name in files:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"# {name}")
+    return tmp_path
+
+
+class TestBuild:
+    """Tests for RepoFileIndex.build."""
+    
+    def test_skips_vendored_directories(self, repo_tree):
+        """Test that dependency and cache directories are not indexed."""
+        index = RepoFileIndex.build(str(repo_tree))
+        
+        assert len(index) == 4
+        assert index.candidates("index.js") == []
+        assert index.candidates("site.py") == []
+    
+    def test_vendored_file_by_full_path(self, repo_tree):
+        """Test that a vendored file named by its full path still resolves."""
+        index = RepoFileIndex.build(str(repo_tree))
+        
+        assert index.resolve("node_modules/lib/index.js") == ("node_modules/lib/index.js", None)
+
+
+class TestResolve:
+    """Tests for RepoFileIndex.resolve and candidates."""
+    
+    def test_exact_path(self, repo_tree):
+        index = RepoFileIndex.build(str(repo_tree))
+        assert index.resolve("src/utils.py") == ("src/utils.py", None)
+        assert index.resolve("./src/utils.py") == ("src/utils.py", None)
+    
+    def test_basename(self, repo_tree):
+        index = RepoFileIndex.build(str(repo_tree))
+        assert index.resolve("user.py") == ("src/models/user.py", None)
+    
+    def test_path_suffix(self, repo_tree):
+        index = RepoFileIndex.build(str(repo_tree))
+        assert index.resolve("models/user.py") == ("src/models/user.py", None)
+    
+    def test_basename_fallback_for_wrong_directory(self, repo_tree):
+        """Test that a path with the wrong directory falls back to the basename."""
+        index = RepoFileIndex.build(str(repo_tree))
+        assert index.resolve("app/main.py") == ("main.py", None)
+    
+    def test_ambiguous_name_reported(self, repo_tree):
+        """Test that a name matching several files is reported, not silently resolved."""
+        index = RepoFileIndex.build(str(repo_tree))
+        
+        path, warning = index.resolve("utils.py")
+        
+        assert path == "src/utils.py"
+        assert "ambiguous" in warning
+        assert "src/utils.py" in warning and "tests/utils.py" in warning
+    
+    def test_not_found(self, repo_tree):
+        index = RepoFileIndex.build(str(repo_tree))
+        
+        path, warning = index.resolve("missing.py")
+        
+        assert path is None
+        assert "not found" in warning
+    
+    def test_from_tree_listing(self):
+        """Test an index built from a path listing without a directory on disk."""
+        index = RepoFileIndex(["a/x.py", "b/x.py", "c.py"])
+        
+        assert sorted(index.candidates("x.py")) == ["a/x.py", "b/x.py"]
+        assert index.candidates("c.py") == ["c.py"]
+        assert index.candidates("") == []
@@ -0,0 +1,91 @@
+"""
+Unit tests for file_loader.py
+Tests content sniffing and memory-bounded file reads
+"""
+
+import pytest
+import os
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.file_loader import (
+    get_max_file_bytes,
+    load_code_bytes,
+    read_code_file,
+    sniff_content
+)
+
+
+class TestSniffContent:
+    """Tests for binary and minified detection."""
+
+    def test_source_is_text(self):
+        assert sniff_content(b"def main():\n    print('h\xc3\xa9llo')\n") is None
+        assert sniff_content(b"") is None
+
+    def test_binary(self):
+        assert sniff_content(b"PK\x03\x04\x00\x00binary") == "binary"
+        assert sniff_content(bytes(range(1, 32)) * 10) == "binary"
+
+    def test_minified(self):
+        assert sniff_content(b"var a=1;" * 1000) == "minified"
+        # Short single-line files are not minified
+        assert sniff_content(b"x = 1") is None
+
+
+class TestReadCodeFile:
+    """Tests for reading files within the size cap."""
+
+    def test_small_file_read_in_full(self, tmp_path):
+        path = tmp_path / "main.py"
+        path.write_text("def main():\n    pass\n")
+
+        assert read_code_file(str(path)) == ("def main():\n    pass\n", None)
+
+    def test_binary_file_skipped(self, tmp_path):
+        path = tmp_path / "data.py"
+        path.write_bytes(b"\x00\x01\x02" * 100)
+
+        content, note = read_code_file(str(path))
+
+        assert content is None
+        assert note == {"status": "skipped", "reason": "binary", "size_bytes": 300}
+
+    @pytest.mark.parametrize("reader", ["file", "bytes"])
+    def test_large_file_keeps_head_and_tail(self, tmp_path, reader):
+        lines = [f"line_{index} = {index}\n" for index in range(20000)]
+        data = "".join(lines).encode()
+        path = tmp_path / "big.py"
+        path.write_bytes(data)
+
+        if reader == "file":
+            content, note = read_code_file(str(path), max_bytes=4096)
+        else:
+            content, note = load_code_bytes(data, max_bytes=4096)
+
+        assert note["status"] == "truncated"
+        assert note["size_bytes"] == len(data)
+        assert note["kept_bytes"] <= 4096
+        assert content.startswith("line_0 = 0\n")
+        assert content.endswith("line_19999 = 19999\n")
+        assert "bytes omitted" in content
+        # Only whole lines are kept on either side of the cut
+        head, tail = content.split("\n... [", 1)
+        assert all(line in lines for line in head.splitlines(keepends=True))
+
+    def test_large_binary_skipped_from_sniff(self, tmp_path):
+        path = tmp_path / "model.py"
+        path.write_bytes(b"\x00" * (1 << 20))
+
+        content, note = read_code_file(str(path), max_bytes=4096)
+
+        assert content is None
+        assert note["reason"] == "binary"
+
+    def test_max_file_bytes_from_env(self):
+        with patch.dict(os.environ, {"GRADING_MAX_FILE_BYTES": "1234"}):
+            assert get_max_file_bytes() == 1234
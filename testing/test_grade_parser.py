@@ -0,0 +1,105 @@
+"""
+Unit tests for grade_parser.py
+Tests structured-output parsing, local repair and the response format setting
+"""
+
+import pytest
+import os
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.grade_parser import GradeParseError, parse_grade, response_format
+
+
+class TestParseGrade:
+    """Tests for parse_grade."""
+    
+    def test_valid_json(self):
+        grade = parse_grade('{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good code."}')
+        
+        assert grade.rubric_score == "5/6"
+        assert grade.hundred_point_score == 83
+        assert grade.review == "Good code."
+    
+    def test_code_fences(self):
+        grade = parse_grade('```json\n{"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good."}\n```')
+        
+        assert grade.hundred_point_score == 83
+    
+    def test_surrounding_text_and_trailing_comma(self):
+        text = 'Here is the grade:\n{"rubric_score": "4/6", "hundred_point_score": 67, "review": "Ok.",}\nThanks!'
+        
+        assert parse_grade(text).rubric_score == "4/6"
+    
+    def test_raw_newlines_in_review(self):
+        grade = parse_grade('{"rubric_score": "4/6", "hundred_point_score": 67, "review": "Line one.\nLine two."}')
+        
+        assert grade.review == "Line one.\nLine two."
+    
+    def test_truncated_response(self):
+        """Test that output cut off mid-review is closed and kept."""
+        grade = parse_grade('{"rubric_score": "4/6", "hundred_point_score": 67, "review": "Criterion 1 (1/1 points): Doc')
+        
+        assert grade.hundred_point_score == 67
+        assert grade.review.startswith("Criterion 1")
+    
+    def test_coerces_score_types(self):
+        grade = parse_grade('{"rubric_score": 5, "hundred_point_score": "83.6%", "review": "Good."}')
+        
+        assert grade.rubric_score == "5"
+        assert grade.hundred_point_score == 84
+    
+    def test_missing_hundred_point_score_derived(self):
+        grade = parse_grade('{"rubric_score": "3/4", "review": "Fine."}')
+        
+        assert grade.hundred_point_score == 75
+    
+    def test_extra_fields_dropped(self):
+        grade = parse_grade('{"rubric_score": "3/4", "hundred_point_score": 75, "review": "Fine.", "notes": "x"}')
+        
+        assert grade.model_dump() == {"rubric_score": "3/4", "hundred_point_score": 75, "review": "Fine."}
+    
+    def test_field_extraction_from_invalid_json(self):
+        """Test the last-resort extraction from single-quoted, non-JSON output."""
+        text = "rubric_score: 2/6\nhundred_point_score: 33\nreview: \"Needs docstrings.\""
+        
+        grade = parse_grade(text)
+        
+        assert grade.rubric_score == "2/6"
+        assert grade.hundred_point_score == 33
+        assert grade.review == "Needs docstrings."
+    
+    def test_unparseable(self):
+        with pytest.raises(GradeParseError):
+            parse_grade("not json")
+        with pytest.raises(GradeParseError):
+            parse_grade(None)
+
+
+class TestResponseFormat:
+    """Tests for the GRADING_RESPONSE_FORMAT setting."""
+    
+    def test_json_schema_default(self):
+        with patch.dict(os.environ, {}, clear=True):
+            fmt = response_format()
+        
+        assert fmt["type"] == "json_schema"
+        assert fmt["json_schema"]["strict"] is True
+        schema = fmt["json_schema"]["schema"]
+        assert schema["additionalProperties"] is False
+        assert set(schema["required"]) == {"rubric_score", "hundred_point_score", "review"}
+    
+    def test_json_object_and_none(self):
+        with patch.dict(os.environ, {"GRADING_RESPONSE_FORMAT": "json_object"}):
+            assert response_format() == {"type": "json_object"}
+        with patch.dict(os.environ, {"GRADING_RESPONSE_FORMAT": "none"}):
+            assert response_format() is None
+    
+    def test_unknown_format(self):
+        with patch.dict(os.environ, {"GRADING_RESPONSE_FORMAT": "xml"}):
+            with pytest.raises(ValueError):
+                response_format()
@@ -0,0 +1,165 @@
+"""
+Unit tests for job_queue.py
+Tests the SQLite job store and the worker pool
+"""
+
+import pytest
+import sys
+import time
+import threading
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.job_queue import JobStore, JobQueue
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Create a job store in a temporary database."""
+    job_store = JobStore(str(tmp_path / "jobs.db"))
+    yield job_store
+    job_store.close()
+
+
+def _wait_for_status(store, job_id, statuses, timeout=5):
+    """Poll until a job reaches one of the given statuses."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not reach {statuses}")
+
+
+class TestJobStore:
+    """Tests for JobStore."""
+    
+    def test_create_and_get(self, store):
+        """Test that a new job is queued with its request."""
+        job_id = store.create({"github_link": "https://github.com/test/repo.git"})
+        job = store.get(job_id)
+        
+        assert job["status"] == "queued"
+        assert job["request"]["github_link"] == "https://github.com/test/repo.git"
+        assert job["progress"] == {}
+        assert job["result"] is None
+    
+    def test_get_missing(self, store):
+        """Test that unknown job ids return None."""
+        assert store.get("missing") is None
+    
+    def test_claim_oldest_once(self, store):
+        """Test that jobs are claimed oldest first and only once."""
+        first = store.create({"n": 1})
+        second = store.create({"n": 2})
+        
+        assert store.claim_next()["job_id"] == first
+        assert store.claim_next()["job_id"] == second
+        assert store.claim_next() is None
+    
+    def test_expired_lease_is_reclaimed(self, store):
+        """Test that a job whose worker died is claimed again."""
+        job_id = store.create({"n": 1})
+        store.claim_next(lease_seconds=0.01)
+        time.sleep(0.05)
+        
+        job = store.claim_next()
+        assert job["job_id"] == job_id
+        assert job["attempts"] == 2
+    
+    def test_heartbeat_keeps_lease(self, store):
+        """Test that a renewed lease is not reclaimed."""
+        store.create({"n": 1})
+        job = store.claim_next(lease_seconds=0.05)
+        store.heartbeat(job["job_id"], lease_seconds=60)
+        time.sleep(0.1)
+        
+        assert store.claim_next() is None
+    
+    def test_abandoned_job_fails_after_max_attempts(self, store):
+        """Test that a repeatedly abandoned job is failed instead of retried forever."""
+        job_id = store.create({"n": 1})
+        for _ in range(2):
+            store.claim_next(lease_seconds=0.01, max_attempts=2)
+            time.sleep(0.05)
+        
+        assert store.claim_next(max_attempts=2) is None
+        assert store.get(job_id)["status"] == "failed"
+    
+    def test_survives_reopen(self, tmp_path):
+        """Test that queued jobs persist across a restart."""
+        path = str(tmp_path / "jobs.db")
+        job_id = JobStore(path).create({"n": 1})
+        
+        assert JobStore(path).claim_next()["job_id"] == job_id
+
+
+class TestJobQueue:
+    """Tests for JobQueue."""
+    
+    def test_runs_job_and_records_progress(self, store):
+        """Test that a submitted job runs and records progress and result."""
+        def handler(request, report_progress):
+            report_progress({"completed_batches": 1})
+            return {"success": True, "value": request["n"] * 2}
+        
+        queue = JobQueue(store, handler, workers=2, poll_interval=0.01)
+        queue.start()
+        try:
+            job_id = queue.submit({"n": 21})
+            job = _wait_for_status(store, job_id, {"completed"})
+        finally:
+            queue.stop(timeout=5)
+        
+        assert job["result"] == {"success": True, "value": 42}
+        assert job["progress"] == {"completed_batches": 1}
+    
+    def test_handler_failure_marks_job_failed(self, store):
+        """Test that an exception in the handler fails the job."""
+        def handler(request, report_progress):
+            raise Exception("Git clone failed")
+        
+        queue = JobQueue(store, handler, workers=1, poll_interval=0.01)
+        queue.start()
+        try:
+            job_id = queue.submit({})
+            job = _wait_for_status(store, job_id, {"failed"})
+        finally:
+            queue.stop(timeout=5)
+        
+        assert job["error"] == "Git clone failed"
+    
+    def test_resumes_jobs_queued_before_start(self, store):
+        """Test that jobs queued before a restart run once workers start."""
+        job_id = store.create({"n": 1})
+        queue = JobQueue(store, lambda request, report_progress: {"ok": True}, workers=1, poll_interval=0.01)
+        queue.start()
+        try:
+            _wait_for_status(store, job_id, {"completed"})
+        finally:
+            queue.stop(timeout=5)
+    
+    def test_workers_run_jobs_in_parallel(self, store):
+        """Test that the worker pool runs jobs concurrently."""
+        barrier = threading.Barrier(2, timeout=5)
+        
+        def handler(request, report_progress):
+            barrier.wait()
+            return {}
+        
+        queue = JobQueue(store, handler, workers=2, poll_interval=0.01)
+        queue.start()
+        try:
+            job_ids = [queue.submit({}) for _ in range(2)]
+            for job_id in job_ids:
+                assert _wait_for_status(store, job_id, {"completed", "failed"})["status"] == "completed"
+        finally:
+            queue.stop(timeout=5)
+    
+    def test_invalid_worker_count(self, store):
+        """Test that at least one worker is required."""
+        with pytest.raises(ValueError, match="workers"):
+            JobQueue(store, lambda request, report_progress: None, workers=0)
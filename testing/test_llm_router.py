@@ -0,0 +1,206 @@
+"""
+Unit tests for llm_router.py
+Tests deployment configuration, weighted routing and failover cooldowns
+"""
+
+import pytest
+import os
+import sys
+import json
+import httpx
+import openai
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.llm_router import Deployment, LLMRouter, load_deployments
+
+
+class FakeClock:
+    """Manually advanced monotonic clock."""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+def _deployment(name, weight=1.0, **limits):
+    return Deployment(name, f"https://{name}.openai.azure.com", "gpt-4o", "key", weight=weight, **limits)
+
+
+def _api_error(error_class, status_code):
+    request = httpx.Request("POST", "https://test.openai.azure.com/chat/completions")
+    return error_class("error", response=httpx.Response(status_code, request=request), body=None)
+
+
+def _pick_counts(router, picks=2000):
+    counts = {deployment.name: 0 for deployment in router.deployments}
+    for _ in range(picks):
+        deployment = router.acquire()
+        counts[deployment.name] += 1
+        router.release(deployment)
+    return counts
+
+
+class TestLoadDeployments:
+    """Tests for reading deployments from the environment."""
+    
+    def test_single_deployment_fallback(self):
+        with patch.dict(os.environ, {
+            "AZURE_OPENAI_API_KEY": "key",
+            "AZURE_OPENAI_ENDPOINT": "https://east.openai.azure.com",
+            "AZURE_OPENAI_DEPLOYMENT_NAME": "gpt-4o",
+            "AZURE_OPENAI_RPM_LIMIT": "300",
+            "AZURE_OPENAI_TPM_LIMIT": "50000"
+        }):
+            os.environ.pop("AZURE_OPENAI_DEPLOYMENTS", None)
+            deployments = load_deployments()
+        
+        assert len(deployments) == 1
+        assert deployments[0].deployment_name == "gpt-4o"
+        assert deployments[0].limiter.stats()["requests_per_minute"] == 300
+        assert deployments[0].limiter.stats()["tokens_per_minute"] == 50000
+    
+    def test_deployment_list(self):
+        config = [
+            {"name": "east", "endpoint": "https://east.openai.azure.com", "deployment": "gpt-4o", "weight": 3},
+            {"name": "west", "endpoint": "https://west.openai.azure.com", "deployment": "gpt-4o",
+             "api_key_env": "WEST_KEY", "tpm_limit": 90000}
+        ]
+        with patch.dict(os.environ, {
+            "AZURE_OPENAI_DEPLOYMENTS": json.dumps(config),
+            "AZURE_OPENAI_API_KEY": "default-key",
+            "WEST_KEY": "west-key"
+        }):
+            deployments = load_deployments()
+        
+        assert [d.name for d in deployments] == ["east", "west"]
+        assert deployments[0].weight == 3
+        assert deployments[0].api_key == "default-key"
+        assert deployments[1].api_key == "west-key"
+        assert deployments[1].limiter.stats()["tokens_per_minute"] == 90000
+    
+    def test_invalid_deployment_list(self):
+        with patch.dict(os.environ, {"AZURE_OPENAI_DEPLOYMENTS": "not json"}):
+            with pytest.raises(ValueError, match="not valid JSON"):
+                load_deployments()
+        
+        with patch.dict(os.environ, {"AZURE_OPENAI_DEPLOYMENTS": json.dumps([{"name": "x"}])}, clear=True):
+            with pytest.raises(ValueError, match="needs an endpoint"):
+                load_deployments()
+
+
+class TestRouting:
+    """Tests for LLMRouter deployment selection."""
+    
+    def test_duplicate_names_rejected(self):
+        with pytest.raises(ValueError):
+            LLMRouter([_deployment("a"), _deployment("a")])
+    
+    def test_weights_respected(self):
+        """Test that traffic is split roughly by weight."""
+        router = LLMRouter([_deployment("big", weight=3), _deployment("small", weight=1)])
+        
+        counts = _pick_counts(router)
+        
+        assert 2.2 < counts["big"] / counts["small"] < 4.0
+    
+    def test_prefers_faster_deployment(self):
+        """Test that a deployment with lower latency gets more calls."""
+        router = LLMRouter([_deployment("fast"), _deployment("slow")])
+        router.deployments[0].latency = 1.0
+        router.deployments[1].latency = 4.0
+        
+        counts = _pick_counts(router)
+        
+        assert counts["fast"] > 2.5 * counts["slow"]
+    
+    def test_prefers_remaining_capacity(self):
+        """Test that a deployment near its rate limit gets fewer calls."""
+        router = LLMRouter([_deployment("fresh", tokens_per_minute=10000),
+                            _deployment("drained", tokens_per_minute=10000)])
+        router.deployments[1].limiter._reserve(9000)
+        
+        counts = _pick_counts(router, picks=1000)
+        
+        assert counts["fresh"] > 5 * counts["drained"]
+    
+    def test_capacity_read_outside_lock(self):
+        """Test that limiter state, which may live on disk, is not read under the routing lock."""
+        router = LLMRouter([_deployment("a"), _deployment("b")])
+        held = []
+        
+        def capacity_share():
+            held.append(router._lock.locked())
+            return 1.0
+        
+        for deployment in router.deployments:
+            deployment.limiter.capacity_share = capacity_share
+        router.acquire()
+        
+        assert held == [False, False]
+    
+    def test_latency_moving_average(self):
+        router = LLMRouter([_deployment("a")])
+        deployment = router.acquire()
+        router.release(deployment, latency=2.0)
+        deployment = router.acquire()
+        router.release(deployment, latency=4.0)
+        
+        assert deployment.latency == pytest.approx(2.6)
+        assert deployment.in_flight == 0
+
+
+class TestFailover:
+    """Tests for cooldowns after throttling and outages."""
+    
+    def test_throttled_deployment_skipped(self):
+        """Test that a 429 removes the deployment from rotation for the cooldown."""
+        clock = FakeClock()
+        router = LLMRouter([_deployment("a"), _deployment("b")], clock=clock)
+        
+        throttled = router.deployments[0]
+        router.acquire()
+        router.release(throttled, error=_api_error(openai.RateLimitError, 429), cooldown=10)
+        
+        assert all(router.acquire() is router.deployments[1] for _ in range(20))
+        assert router.has_available(exclude=throttled)
+        
+        clock.now += 11
+        assert router.deployments[0].cooldown_until <= clock.now
+    
+    def test_outage_cooldown_grows(self):
+        """Test that consecutive 5xx failures lengthen the cooldown."""
+        clock = FakeClock()
+        router = LLMRouter([_deployment("a")], clock=clock)
+        deployment = router.deployments[0]
+        
+        router.release(deployment, error=_api_error(openai.InternalServerError, 503))
+        first = deployment.cooldown_until - clock.now
+        clock.now = deployment.cooldown_until
+        router.release(deployment, error=_api_error(openai.InternalServerError, 503))
+        second = deployment.cooldown_until - clock.now
+        
+        assert second == 2 * first
+    
+    def test_all_cooling_uses_first_to_recover(self):
+        clock = FakeClock()
+        router = LLMRouter([_deployment("a"), _deployment("b")], clock=clock)
+        router.deployments[0].cooldown_until = clock.now + 30
+        router.deployments[1].cooldown_until = clock.now + 5
+        
+        assert router.acquire() is router.deployments[1]
+        assert not router.has_available()
+    
+    def test_client_errors_do_not_cool_down(self):
+        router = LLMRouter([_deployment("a")])
+        deployment = router.deployments[0]
+        
+        router.release(deployment, error=_api_error(openai.BadRequestError, 400))
+        
+        assert deployment.cooldown_until == 0.0
+        assert deployment.errors == 1
@@ -7,7 +7,7 @@ import pytest
 import sys
 from pathlib import Path
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 # Add parent directory to Python path
 sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -56,7 +56,7 @@ class TestGradeEndpoint:
             "review": "Good code structure with minor improvements needed"
         }]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
@@ -66,6 +66,31 @@ class TestGradeEndpoint:
             assert len(data["analysis"]) == 1
             assert data["analysis"][0]["rubric_score"] == "85/100"
     
+    def test_grade_endpoint_uses_shared_service(self, client, valid_grade_request):
+        """Test that the endpoint grades with the long-lived service instance."""
+        import main
+        
+        with patch('main.agent_service_function_async', return_value=[]) as mock_grade:
+            response = client.post("/grade", json=valid_grade_request)
+            
+            assert response.status_code == 200
+            assert mock_grade.call_args.kwargs["agent"] is main.grading_service
+    
+    def test_grade_endpoint_passes_test_results(self, client, valid_grade_request):
+        """Test that test_results reach the grader and a sandboxed test run is returned."""
+        summary = {"status": "passed", "passed": 3, "failed": 0, "errors": 0, "skipped": 0}
+        
+        async def fake_grade(**kwargs):
+            kwargs["tests_callback"](summary)
+            return []
+        
+        with patch('main.agent_service_function_async', side_effect=fake_grade) as mock_grade:
+            response = client.post("/grade", json=valid_grade_request)
+        
+        assert response.status_code == 200
+        assert mock_grade.call_args.kwargs["test_results"] == "All tests passed"
+        assert response.json()["tests"] == summary
+    
     def test_grade_endpoint_success_multiple_batches(self, client, valid_grade_request):
         """Test successful grading with multiple batches."""
         valid_grade_request["rubric"]["batches"] = [
@@ -90,7 +115,7 @@ class TestGradeEndpoint:
             }
         ]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
@@ -109,7 +134,7 @@ class TestGradeEndpoint:
             "review": "Satisfactory"
         }]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
@@ -140,8 +165,8 @@ class TestGradeEndpoint:
             assert "not initialized" in response.json()["detail"]
     
     def test_grade_endpoint_agent_service_exception(self, client, valid_grade_request):
-        """Test when agent_service_function raises an exception."""
-        with patch('main.agent_service_function', side_effect=Exception("Service error")):
+        """Test when agent_service_function_async raises an exception."""
+        with patch('main.agent_service_function_async', side_effect=Exception("Service error")):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 500
@@ -155,7 +180,7 @@ class TestGradeEndpoint:
             "analysis": []
         }
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
@@ -174,7 +199,7 @@ class TestGradeEndpoint:
             "review": "Good work"
         }]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
@@ -196,13 +221,365 @@ class TestGradeEndpoint:
             for i in range(1, 11)
         ]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
             data = response.json()
             assert len(data["analysis"]) == 10
 
+def _fake_grade_many(results_by_link, order=None):
+    """Build a stand-in for grade_many_async yielding canned results."""
+    async def fake_grade_many(github_links, rubric_json, agent=None):
+        indexes = order or range(len(github_links))
+        for index in indexes:
+            yield index, github_links[index], results_by_link[github_links[index]]
+    return fake_grade_many
+
+
+class TestBulkGradeEndpoint:
+    """Tests for the /grade/bulk endpoint."""
+    
+    @pytest.fixture
+    def bulk_request(self, valid_grade_request):
+        return {
+            "github_links": [
+                "https://github.com/student1/repo.git",
+                "https://github.com/student2/repo.git"
+            ],
+            "rubric": valid_grade_request["rubric"]
+        }
+    
+    def test_bulk_collected(self, client, bulk_request):
+        """Test that collected results are returned in request order."""
+        results = {
+            "https://github.com/student1/repo.git": [{"rubric_score": "90/100"}],
+            "https://github.com/student2/repo.git": {"success": False, "error": "Git clone failed", "batch_results": []}
+        }
+        
+        with patch('main.grade_many_async', _fake_grade_many(results, order=[1, 0])):
+            response = client.post("/grade/bulk", json=bulk_request)
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["success"] is False
+        assert [r["index"] for r in data["results"]] == [0, 1]
+        assert data["results"][0]["analysis"][0]["rubric_score"] == "90/100"
+        assert data["results"][1]["success"] is False
+        assert data["results"][1]["error"] == "Git clone failed"
+    
+    def test_bulk_streaming(self, client, bulk_request):
+        """Test that streamed results arrive one JSON line per student."""
+        import json
+        bulk_request["stream"] = True
+        results = {
+            "https://github.com/student1/repo.git": [{"rubric_score": "90/100"}],
+            "https://github.com/student2/repo.git": [{"rubric_score": "80/100"}]
+        }
+        
+        with patch('main.grade_many_async', _fake_grade_many(results, order=[1, 0])):
+            response = client.post("/grade/bulk", json=bulk_request)
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["index"] for line in lines] == [1, 0]
+        assert lines[0]["github_link"] == "https://github.com/student2/repo.git"
+    
+    def test_bulk_empty_links(self, client, bulk_request):
+        """Test that an empty roster is rejected."""
+        bulk_request["github_links"] = []
+        
+        response = client.post("/grade/bulk", json=bulk_request)
+        
+        assert response.status_code == 422
+    
+    def test_bulk_service_unavailable(self, client, bulk_request):
+        """Test bulk grading when the grading service is not initialized."""
+        with patch('main.grading_service', None):
+            response = client.post("/grade/bulk", json=bulk_request)
+            
+            assert response.status_code == 503
+
+
+class TestGradeStreamEndpoint:
+    """Tests for the /grade/stream endpoint."""
+    
+    def _parse_sse(self, text):
+        """Split a server-sent event stream into (event, data) pairs."""
+        import json
+        events = []
+        for block in text.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+    
+    def test_stream_events(self, client, valid_grade_request):
+        """Test that grading progress is streamed as server-sent events."""
+        received = {}
+        
+        async def fake_stream(**kwargs):
+            received.update(kwargs)
+            yield "clone_complete", {"total_batches": 1}
+            yield "token", {"batch_number": 1, "content": "{"}
+            yield "batch", {"batch_number": 1, "result": {"rubric_score": "85/100"}}
+            yield "done", {"total_batches": 1}
+        
+        with patch('main.agent_service_stream_async', fake_stream):
+            response = client.post("/grade/stream?stream_tokens=true", json=valid_grade_request)
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = self._parse_sse(response.text)
+        assert [name for name, _ in events] == ["clone_complete", "token", "batch", "done"]
+        assert events[2][1]["result"]["rubric_score"] == "85/100"
+        assert received["stream_tokens"] is True
+    
+    def test_stream_service_unavailable(self, client, valid_grade_request):
+        """Test streaming when the grading service is not initialized."""
+        with patch('main.grading_service', None):
+            response = client.post("/grade/stream", json=valid_grade_request)
+
+            assert response.status_code == 503
+
+
+class TestGradeUploadEndpoint:
+    """Tests for the /grade/upload endpoint."""
+
+    RUBRIC = {"rubric": "Grade based on code quality", "batches": [["main.py"]]}
+
+    def _archive(self, files):
+        import io
+        import zipfile
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+        return buffer.getvalue()
+
+    def _upload(self, client, archive, rubric=None):
+        import json
+        return client.post("/grade/upload", files=[
+            ("rubric", (None, json.dumps(rubric or self.RUBRIC))),
+            ("archive", ("submission.zip", archive, "application/zip"))
+        ])
+
+    def test_upload_grades_archive(self, client):
+        """Test that the listed files are read from the archive and graded."""
+        archive = self._archive({"repo/main.py": "def main():\n    pass\n", "repo/other.py": "x = 1\n"})
+
+        with patch('main.agent_service_function_async', return_value=[{"rubric_score": "5/6"}]) as mock_grade:
+            response = self._upload(client, archive)
+
+        assert response.status_code == 200
+        assert response.json()["analysis"] == [{"rubric_score": "5/6"}]
+        kwargs = mock_grade.call_args.kwargs
+        assert kwargs["rubric_json"] == self.RUBRIC
+        assert kwargs["github_link"] is None
+        assert list(kwargs["archive"].files) == ["repo/main.py"]
+
+    def test_upload_rejects_bad_archive(self, client):
+        """Test that a malformed archive is a client error."""
+        response = self._upload(client, b"not a zip archive")
+
+        assert response.status_code == 400
+        assert "Not a zip archive" in response.json()["detail"]
+
+    def test_upload_rejects_oversized_archive(self, client, monkeypatch):
+        """Test that archives over the upload limits are refused."""
+        monkeypatch.setenv("GRADING_UPLOAD_MAX_MEMBER_BYTES", "100")
+        archive = self._archive({"main.py": "x = 1\n" * 100})
+
+        response = self._upload(client, archive)
+
+        assert response.status_code == 413
+
+
+class TestJobEndpoints:
+    """Tests for the /jobs endpoints."""
+    
+    @pytest.fixture(autouse=True)
+    def job_db(self, tmp_path, monkeypatch):
+        """Point the job queue at a temporary database."""
+        import main
+        monkeypatch.setenv("GRADING_JOB_DB", str(tmp_path / "jobs.db"))
+        monkeypatch.setattr(main, "job_queue", None)
+    
+    def test_submit_and_poll_job(self, client, valid_grade_request):
+        """Test that a job id is returned immediately and can be polled."""
+        response = client.post("/jobs", json=valid_grade_request)
+        
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+        
+        response = client.get(f"/jobs/{job_id}")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "queued"
+        assert data["result"] is None
+    
+    def test_get_unknown_job(self, client):
+        """Test polling a job that does not exist."""
+        response = client.get("/jobs/missing")
+        
+        assert response.status_code == 404
+    
+    def test_submit_service_unavailable(self, client, valid_grade_request):
+        """Test submitting a job when the grading service is not initialized."""
+        with patch('main.grading_service', None):
+            response = client.post("/jobs", json=valid_grade_request)
+            
+            assert response.status_code == 503
+    
+    def test_completed_job_result(self, client, valid_grade_request):
+        """Test that a completed job reports progress and its GradeResponse."""
+        import main
+        
+        def fake_grade(**kwargs):
+            batch_result = {"rubric_score": "85/100"}
+            kwargs["progress_callback"](1, 1, batch_result)
+            return [batch_result]
+        
+        recorded = []
+        with patch('main.agent_service_function', side_effect=fake_grade):
+            result = main._run_grading_job(valid_grade_request, lambda progress: recorded.append(dict(progress)))
+        
+        assert result["success"] is True
+        assert result["analysis"] == [{"rubric_score": "85/100"}]
+        assert recorded[-1]["completed_batches"] == 1
+        assert recorded[-1]["batch_results"][0]["batch_number"] == 1
+        
+        queue = main._get_job_queue()
+        job_id = queue.store.create(valid_grade_request)
+        queue.store.complete(job_id, result)
+        
+        data = client.get(f"/jobs/{job_id}").json()
+        assert data["status"] == "completed"
+        assert data["result"]["analysis"][0]["rubric_score"] == "85/100"
+
+
+class TestCacheStatsEndpoint:
+    """Tests for the /cache/stats endpoint."""
+    
+    def test_cache_stats(self, client):
+        """Test that cache hit and miss counts are reported."""
+        response = client.get("/cache/stats")
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["enabled"] is True
+        assert "hits" in data
+        assert "misses" in data
+        assert "cached_tokens" in data["prompt_cache"]
+    
+    def test_cache_stats_service_unavailable(self, client):
+        """Test cache stats when the grading service is not initialized."""
+        with patch('main.grading_service', None):
+            response = client.get("/cache/stats")
+            
+            assert response.status_code == 503
+
+
+class TestMetricsEndpoint:
+    """Tests for /metrics and the optional timings block."""
+    
+    def test_metrics_prometheus_format(self, client):
+        """Test that pipeline metrics are served as Prometheus text."""
+        from services.metrics import timed
+        with timed("clone"):
+            pass
+        
+        response = client.get("/metrics")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'grading_stage_seconds_count{stage="clone"}' in response.text
+        assert "grading_llm_in_flight" in response.text
+        assert 'grading_regrade_batches_total{outcome="reused"}' in response.text
+    
+    def test_grade_include_timings(self, client, valid_grade_request):
+        """Test that timings are returned only when requested."""
+        with patch('main.agent_service_function_async', return_value=[]):
+            plain = client.post("/grade", json=valid_grade_request).json()
+            timed_response = client.post("/grade", json={**valid_grade_request, "include_timings": True}).json()
+        
+        assert plain["timings"] is None
+        assert "total_seconds" in timed_response["timings"]
+        assert "stages" in timed_response["timings"]
+
+
+class TestLLMDeploymentsEndpoint:
+    """Tests for the /llm/deployments endpoint."""
+    
+    def test_llm_deployments(self, client):
+        """Test that each deployment's routing state is reported."""
+        response = client.get("/llm/deployments")
+        
+        assert response.status_code == 200
+        deployments = response.json()["deployments"]
+        assert len(deployments) >= 1
+        assert {"name", "weight", "in_flight", "cooldown_seconds", "tokens_per_minute"} <= set(deployments[0])
+
+
+class TestServerLauncher:
+    """Tests for the development and production launch modes."""
+    
+    def test_dev_mode_uses_reloader(self, monkeypatch):
+        """Test that the default launch keeps the single-process reloader."""
+        import main
+        monkeypatch.delenv("GRADING_SERVER_MODE", raising=False)
+        
+        with patch('main.uvicorn.run') as mock_run:
+            main.run_server([])
+        
+        assert mock_run.call_args.kwargs["reload"] is True
+        assert "workers" not in mock_run.call_args.kwargs
+    
+    def test_prod_mode_workers_and_shared_state(self, monkeypatch):
+        """Test that production mode runs workers without reload and shares state through SQLite."""
+        import main
+        for name in main.PRODUCTION_ENVIRONMENT:
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv("GRADING_CACHE_BACKEND", "memory")
+        
+        with patch('main.uvicorn.run') as mock_run:
+            main.run_server(["--prod", "--workers", "4", "--port", "9000"])
+        
+        kwargs = mock_run.call_args.kwargs
+        assert kwargs["workers"] == 4
+        assert kwargs["port"] == 9000
+        assert "reload" not in kwargs
+        assert main.os.environ["GRADING_SHARED_STATE_DB"] == "grading_state.db"
+        assert main.os.environ["GRADING_PRELOAD"] == "1"
+        # Explicit settings are kept
+        assert main.os.environ["GRADING_CACHE_BACKEND"] == "memory"
+    
+    def test_prod_mode_from_env(self, monkeypatch):
+        """Test that GRADING_SERVER_MODE and GRADING_SERVER_WORKERS select production mode."""
+        import main
+        for name in main.PRODUCTION_ENVIRONMENT:
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv("GRADING_SERVER_MODE", "production")
+        monkeypatch.setenv("GRADING_SERVER_WORKERS", "3")
+        
+        with patch('main.uvicorn.run') as mock_run:
+            main.run_server([])
+        
+        assert mock_run.call_args.kwargs["workers"] == 3
+    
+    def test_preload_warms_service(self, monkeypatch, tmp_path):
+        """Test that GRADING_PRELOAD warms the service before serving."""
+        import main
+        monkeypatch.setenv("GRADING_PRELOAD", "1")
+        monkeypatch.setenv("GRADING_JOB_DB", str(tmp_path / "jobs.db"))
+        monkeypatch.setattr(main, "job_queue", None)
+        
+        with patch('main.grading_service') as mock_service:
+            mock_service.aclose = AsyncMock()
+            with TestClient(app):
+                mock_service.warm_up.assert_called_once()
+
+
 class TestRequestValidation:
     """Tests for request validation using Pydantic models."""
     
@@ -221,7 +598,7 @@ class TestRequestValidation:
         
         mock_result = [{"batch_number": 1, "rubric_score": "80/100"}]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
@@ -232,7 +609,7 @@ class TestRequestValidation:
         
         mock_result = [{"batch_number": 1, "rubric_score": "80/100"}]
         
-        with patch('main.agent_service_function', return_value=mock_result):
+        with patch('main.agent_service_function_async', return_value=mock_result):
             response = client.post("/grade", json=valid_grade_request)
             
             assert response.status_code == 200
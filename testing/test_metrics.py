@@ -0,0 +1,98 @@
+"""
+Unit tests for metrics.py
+Tests stage timing, per-request timings and Prometheus rendering
+"""
+
+import pytest
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.metrics import Metrics, metrics, record_usage, request_timings, timed
+
+
+class TestMetricsRender:
+    """Tests for Prometheus text rendering."""
+    
+    def test_histogram_and_counter_lines(self):
+        registry = Metrics()
+        registry.observe_stage("llm", 0.3)
+        registry.observe_stage("llm", 7.0)
+        registry.add_tokens({"prompt_tokens": 100, "completion_tokens": 20, "cached_tokens": 64})
+        
+        text = registry.render(["# extra", "extra_metric 1"])
+        
+        assert "# TYPE grading_stage_seconds histogram" in text
+        assert 'grading_stage_seconds_bucket{stage="llm",le="0.5"} 1' in text
+        assert 'grading_stage_seconds_bucket{stage="llm",le="+Inf"} 2' in text
+        assert 'grading_stage_seconds_count{stage="llm"} 2' in text
+        assert 'grading_llm_tokens_total{kind="cached"} 64' in text
+        assert text.endswith("extra_metric 1\n")
+
+
+class TestRequestTimings:
+    """Tests for per-request stage timings."""
+    
+    def test_timed_records_into_request(self):
+        with request_timings("test") as timings:
+            with timed("load"):
+                pass
+            with timed("load"):
+                pass
+            record_usage(1, {"prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0})
+        
+        data = timings.as_dict()
+        assert data["stages"]["load"]["count"] == 2
+        assert data["tokens"] == {"prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0}
+        assert data["batches"] == [{"batch_number": 1, "prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 0}]
+        assert data["total_seconds"] >= 0
+    
+    def test_timed_outside_request(self):
+        """Test that stages outside a request only reach the global metrics."""
+        with timed("outside-request"):
+            pass
+        
+        assert 'grading_stage_seconds_count{stage="outside-request"}' in metrics.render()
+    
+    def test_timings_follow_tasks_and_threads(self):
+        """Test that asyncio tasks and to_thread calls record into the request."""
+        def in_thread():
+            with timed("thread"):
+                pass
+        
+        async def in_task():
+            with timed("task"):
+                await asyncio.to_thread(in_thread)
+        
+        async def run():
+            with request_timings("test") as timings:
+                await asyncio.gather(asyncio.create_task(in_task()), asyncio.create_task(in_task()))
+            return timings
+        
+        data = asyncio.run(run()).as_dict()
+        
+        assert data["stages"]["task"]["count"] == 2
+        assert data["stages"]["thread"]["count"] == 2
+    
+    def test_requests_isolated(self):
+        """Test that concurrent requests keep separate timings."""
+        results = {}
+        
+        def request(name, stages):
+            with request_timings("test") as timings:
+                for _ in range(stages):
+                    with timed("load"):
+                        pass
+            results[name] = timings.as_dict()["stages"]["load"]["count"]
+        
+        threads = [threading.Thread(target=request, args=(name, count)) for name, count in (("a", 2), ("b", 5))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert results == {"a": 2, "b": 5}
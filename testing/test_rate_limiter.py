@@ -0,0 +1,254 @@
+"""
+Unit tests for rate_limiter.py
+Tests the RPM/TPM token buckets, header adaptation and retry policy
+"""
+
+import pytest
+import os
+import sys
+import time
+import httpx
+import asyncio
+import sqlite3
+import threading
+import openai
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.rate_limiter import (
+    RateLimiter,
+    RetryPolicy,
+    SharedRateLimiter,
+    create_rate_limiter,
+    retry_after_seconds
+)
+
+
+class FakeClock:
+    """Manually advanced monotonic clock."""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+def _api_error(error_class, status_code, headers=None):
+    request = httpx.Request("POST", "https://test.openai.azure.com/chat/completions")
+    response = httpx.Response(status_code, headers=headers or {}, request=request)
+    return error_class("error", response=response, body=None)
+
+
+class TestRateLimiter:
+    """Tests for RateLimiter scheduling."""
+    
+    def test_unlimited_by_default(self):
+        """Test that a limiter without limits never waits."""
+        limiter = RateLimiter()
+        
+        assert all(limiter._reserve(100000) == 0 for _ in range(100))
+    
+    def test_requests_per_minute(self):
+        """Test that calls past the RPM burst are spaced at the refill rate."""
+        clock = FakeClock()
+        limiter = RateLimiter(requests_per_minute=60, clock=clock)
+        
+        waits = [limiter._reserve(1) for _ in range(62)]
+        
+        assert waits[:60] == [0.0] * 60
+        assert waits[60] == pytest.approx(1.0)
+        assert waits[61] == pytest.approx(2.0)
+    
+    def test_tokens_per_minute_refill(self):
+        """Test that the token bucket refills over time."""
+        clock = FakeClock()
+        limiter = RateLimiter(tokens_per_minute=6000, clock=clock)
+        
+        assert limiter._reserve(6000) == 0
+        assert limiter._reserve(1000) == pytest.approx(10.0)
+        
+        clock.now += 20
+        assert limiter._reserve(1000) == pytest.approx(0.0)
+    
+    def test_settle_refunds_overestimate(self):
+        """Test that unused reserved tokens are returned to the bucket."""
+        clock = FakeClock()
+        limiter = RateLimiter(tokens_per_minute=6000, clock=clock)
+        
+        limiter._reserve(6000)
+        limiter.settle(6000, 1000)
+        
+        assert limiter._reserve(5000) == 0
+    
+    def test_pause_blocks_all_callers(self):
+        """Test that a pause after throttling delays every reservation."""
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock)
+        
+        limiter.pause(5)
+        
+        assert limiter._reserve(1) == pytest.approx(5.0)
+        assert limiter.stats()["throttled"] == 1
+    
+    def test_learns_limits_from_headers(self):
+        """Test that limit and remaining headers configure the buckets."""
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock)
+        
+        limiter.update_from_headers({
+            "x-ratelimit-limit-requests": "120",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-limit-tokens": "60000",
+            "x-ratelimit-remaining-tokens": "59000"
+        })
+        
+        assert limiter.stats()["requests_per_minute"] == 120
+        assert limiter.stats()["tokens_per_minute"] == 60000
+        assert limiter._reserve(10) == pytest.approx(0.5)
+    
+    def test_capacity_share(self):
+        """Test the free share of the tighter limit used for routing."""
+        clock = FakeClock()
+        limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=1000, clock=clock)
+        
+        assert RateLimiter().capacity_share() == 1.0
+        limiter._reserve(750)
+        assert limiter.capacity_share() == pytest.approx(0.25)
+        limiter.pause(1)
+        assert limiter.capacity_share() == 0.0
+
+
+class TestSharedRateLimiter:
+    """Tests for limiters shared through SQLite."""
+    
+    def test_processes_share_one_quota(self, tmp_path):
+        """Test that two limiters on one file and key draw on the same buckets."""
+        clock = FakeClock()
+        path = str(tmp_path / "state.db")
+        first = SharedRateLimiter(path, "gpt@endpoint", requests_per_minute=60, clock=clock)
+        second = SharedRateLimiter(path, "gpt@endpoint", clock=clock)
+        
+        waits = [first._reserve(1) for _ in range(30)] + [second._reserve(1) for _ in range(31)]
+        
+        assert waits[:60] == [0.0] * 60
+        assert waits[60] == pytest.approx(1.0)
+        assert second.stats()["requests_per_minute"] == 60
+    
+    def test_keys_are_independent(self, tmp_path):
+        """Test that different deployments keep separate buckets in one file."""
+        clock = FakeClock()
+        path = str(tmp_path / "state.db")
+        busy = SharedRateLimiter(path, "a", requests_per_minute=1, clock=clock)
+        idle = SharedRateLimiter(path, "b", requests_per_minute=1, clock=clock)
+        
+        busy._reserve(1)
+        
+        assert busy.capacity_share() == 0.0
+        assert idle.capacity_share() == 1.0
+    
+    def test_pause_and_headers_shared(self, tmp_path):
+        """Test that a 429 pause and learned limits reach every process."""
+        clock = FakeClock()
+        path = str(tmp_path / "state.db")
+        first = SharedRateLimiter(path, "gpt", clock=clock)
+        second = SharedRateLimiter(path, "gpt", clock=clock)
+        
+        first.update_from_headers({"x-ratelimit-limit-tokens": "6000"})
+        first.pause(5)
+        
+        assert second._reserve(100) == pytest.approx(5.0)
+        assert second.stats() == {"requests_per_minute": None, "tokens_per_minute": 6000.0, "throttled": 1}
+    
+    def test_busy_file_falls_back_to_local_state(self, tmp_path):
+        """Test that a write lock held by another process does not stall a reservation."""
+        clock = FakeClock()
+        path = str(tmp_path / "state.db")
+        limiter = SharedRateLimiter(path, "gpt", requests_per_minute=60, clock=clock)
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        
+        try:
+            started = time.monotonic()
+            assert limiter._reserve(1) == 0.0
+            assert time.monotonic() - started < 5
+        finally:
+            other.execute("ROLLBACK")
+            other.close()
+    
+    def test_aacquire_reserves_off_the_event_loop(self, tmp_path):
+        """Test that async callers do not run SQLite transactions on the event loop thread."""
+        limiter = SharedRateLimiter(str(tmp_path / "state.db"), "gpt", requests_per_minute=60)
+        threads = []
+        reserve = limiter._reserve
+        
+        def recording_reserve(tokens):
+            threads.append(threading.current_thread())
+            return reserve(tokens)
+        
+        async def acquire():
+            with patch.object(limiter, "_reserve", side_effect=recording_reserve):
+                await limiter.aacquire(1)
+            return threading.current_thread()
+        
+        loop_thread = asyncio.run(acquire())
+        
+        assert len(threads) == 1
+        assert threads[0] is not loop_thread
+    
+    def test_configured_limit_overrides_stored(self, tmp_path):
+        """Test that a restarted process applies its configured quota."""
+        clock = FakeClock()
+        path = str(tmp_path / "state.db")
+        SharedRateLimiter(path, "gpt", requests_per_minute=60, clock=clock)
+        
+        restarted = SharedRateLimiter(path, "gpt", requests_per_minute=120, clock=clock)
+        
+        assert restarted.stats()["requests_per_minute"] == 120
+    
+    def test_create_rate_limiter(self, tmp_path):
+        """Test that GRADING_SHARED_STATE_DB switches to the shared limiter."""
+        with patch.dict(os.environ, {}, clear=True):
+            assert type(create_rate_limiter("gpt")) is RateLimiter
+        with patch.dict(os.environ, {"GRADING_SHARED_STATE_DB": str(tmp_path / "state.db")}):
+            limiter = create_rate_limiter("gpt", tokens_per_minute=1000)
+        
+        assert isinstance(limiter, SharedRateLimiter)
+        assert limiter.stats()["tokens_per_minute"] == 1000
+
+
+class TestRetryPolicy:
+    """Tests for RetryPolicy."""
+    
+    def test_retryable_errors(self):
+        policy = RetryPolicy()
+        
+        assert policy.is_retryable(_api_error(openai.RateLimitError, 429))
+        assert policy.is_retryable(_api_error(openai.InternalServerError, 503))
+        assert policy.is_retryable(openai.APITimeoutError(request=httpx.Request("POST", "https://x")))
+        assert not policy.is_retryable(_api_error(openai.BadRequestError, 400))
+        assert not policy.is_retryable(ValueError("bad"))
+    
+    def test_delay_honours_retry_after(self):
+        """Test that the delay is never shorter than the server's retry-after."""
+        policy = RetryPolicy(base_delay=0.01, max_delay=0.01)
+        error = _api_error(openai.RateLimitError, 429, {"retry-after-ms": "2500"})
+        
+        assert policy.delay(0, error) == pytest.approx(2.5)
+    
+    def test_delay_jittered_and_capped(self):
+        policy = RetryPolicy(base_delay=1, max_delay=8)
+        
+        delays = [policy.delay(10) for _ in range(50)]
+        
+        assert all(0 <= delay <= 8 for delay in delays)
+        assert len(set(delays)) > 1
+    
+    def test_retry_after_formats(self):
+        assert retry_after_seconds({"retry-after": "3"}) == 3
+        assert retry_after_seconds({"retry-after-ms": "150"}) == pytest.approx(0.15)
+        assert retry_after_seconds({}) is None
+        assert retry_after_seconds(None) is None
@@ -0,0 +1,166 @@
+"""
+Unit tests for regrade_store.py
+Tests batch fingerprints, the SQLite store and incremental regrade sessions
+"""
+
+import pytest
+import os
+import sys
+import time
+import subprocess
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.file_index import RepoFileIndex
+from services.regrade_store import (
+    RegradeSession,
+    RegradeStore,
+    blob_id,
+    create_regrade_store,
+    read_tree_blobs,
+    regrade_scope
+)
+
+
+GRADE = {"rubric_score": "5/6", "hundred_point_score": 83, "review": "Good.", "file_name": ["a.py"]}
+
+
+@pytest.fixture
+def work_tree(tmp_path):
+    """A committed git working tree with two files."""
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / "a.py").write_text("def a():\n    return 1\n")
+    (root / "b.py").write_text("def b():\n    return 2\n")
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.run(["git", "init", "-q"], cwd=root, check=True)
+    subprocess.run(["git", "add", "."], cwd=root, check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "initial"], cwd=root, check=True)
+    return str(root)
+
+
+def _session(store, repo_path, scope="scope"):
+    commit, blobs = read_tree_blobs(repo_path)
+    return RegradeSession(store, scope, repo_path, RepoFileIndex.build(repo_path), commit, blobs)
+
+
+class TestFingerprints:
+    """Tests for blob ids and tree listings."""
+
+    def test_blob_id_matches_git(self, work_tree):
+        expected = subprocess.run(
+            ["git", "hash-object", "a.py"], cwd=work_tree, capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+        assert blob_id(os.path.join(work_tree, "a.py")) == expected
+
+    def test_read_tree_blobs(self, work_tree):
+        commit, blobs = read_tree_blobs(work_tree)
+
+        assert len(commit) == 40
+        assert blobs["a.py"] == blob_id(os.path.join(work_tree, "a.py"))
+        assert set(blobs) == {"a.py", "b.py"}
+
+    def test_read_tree_blobs_outside_git(self, tmp_path):
+        assert read_tree_blobs(str(tmp_path)) == (None, {})
+
+    def test_scope_ignores_git_suffix_and_slash(self):
+        scope = regrade_scope("https://github.com/a/b", "rubric", "template", "deployment")
+
+        assert regrade_scope("https://github.com/a/b.git", "rubric", "template", "deployment") == scope
+        assert regrade_scope("https://github.com/a/b/", "rubric", "template", "deployment") == scope
+        assert regrade_scope("https://github.com/a/b", "other rubric", "template", "deployment") != scope
+
+
+class TestRegradeStore:
+    """Tests for the SQLite store."""
+
+    def test_set_and_get(self, tmp_path):
+        store = RegradeStore(path=str(tmp_path / "regrade.db"))
+        store.set("scope", ["a.py"], "fp", GRADE, "abc123")
+
+        assert store.get("scope", ["a.py"]) == ("fp", GRADE, "abc123")
+        assert store.get("scope", ["b.py"]) is None
+        assert store.get("other", ["a.py"]) is None
+        assert len(store) == 1
+
+    def test_persists_across_instances(self, tmp_path):
+        path = str(tmp_path / "regrade.db")
+        RegradeStore(path=path).set("scope", ["a.py"], "fp", GRADE)
+
+        assert RegradeStore(path=path).get("scope", ["a.py"])[0] == "fp"
+
+    def test_expired_entries_are_dropped(self):
+        store = RegradeStore(ttl_seconds=10)
+        store.set("scope", ["a.py"], "fp", GRADE)
+
+        with patch("services.regrade_store.time.time", return_value=time.time() + 60):
+            assert store.get("scope", ["a.py"]) is None
+        assert len(store) == 0
+
+    def test_create_from_environment(self, tmp_path):
+        with patch.dict(os.environ, {"GRADING_REGRADE_DB": "none"}):
+            assert create_regrade_store() is None
+        with patch.dict(os.environ, {"GRADING_REGRADE_DB": str(tmp_path / "regrade.db")}):
+            assert create_regrade_store().path == str(tmp_path / "regrade.db")
+        with patch.dict(os.environ, {}, clear=True):
+            assert create_regrade_store().path == ":memory:"
+
+
+class TestRegradeSession:
+    """Tests for reusing unchanged batches."""
+
+    def test_unchanged_batch_is_reused(self, work_tree):
+        store = RegradeStore()
+        first = _session(store, work_tree)
+        fingerprint, reused = first.lookup(["a.py"])
+        assert reused is None
+        first.remember(["a.py"], fingerprint, {**GRADE, "usage": {"prompt_tokens": 10}})
+
+        _, reused = _session(store, work_tree).lookup(["a.py"])
+
+        assert reused["hundred_point_score"] == 83
+        assert reused["reused"] is True
+        assert reused["graded_commit"] == first.commit
+        assert "usage" not in reused
+        assert store.stats() == {"reused": 1, "regraded": 1, "size": 1}
+
+    def test_changed_file_is_regraded(self, work_tree):
+        store = RegradeStore()
+        session = _session(store, work_tree)
+        for batch in (["a.py"], ["b.py"]):
+            session.remember(batch, session.lookup(batch)[0], GRADE)
+
+        with open(os.path.join(work_tree, "b.py"), "a") as f:
+            f.write("# changed\n")
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                        "commit", "-qam", "change b"], cwd=work_tree, check=True)
+
+        session = _session(store, work_tree)
+        assert session.lookup(["a.py"])[1] is not None
+        assert session.lookup(["b.py"])[1] is None
+
+    def test_files_outside_git_are_hashed(self, tmp_path):
+        (tmp_path / "a.py").write_text("x = 1\n")
+        store = RegradeStore()
+        session = _session(store, str(tmp_path))
+        session.remember(["a.py"], session.lookup(["a.py"])[0], GRADE)
+
+        assert session.lookup(["a.py"])[1] is not None
+        (tmp_path / "a.py").write_text("x = 2\n")
+        assert session.lookup(["a.py"])[1] is None
+
+    @pytest.mark.parametrize("failed", [
+        {"analysis_result": "Error: boom", "success": False},
+        {"overall_score": "Error parsing score", "review": "raw"},
+        {**GRADE, "chunk_errors": [{"chunk": 2}]}
+    ])
+    def test_failed_results_are_not_remembered(self, work_tree, failed):
+        store = RegradeStore()
+        session = _session(store, work_tree)
+        session.remember(["a.py"], session.lookup(["a.py"])[0], failed)
+
+        assert len(store) == 0
@@ -0,0 +1,252 @@
+"""
+Unit tests for repo_cache.py
+Tests the persistent repository cache against local git repositories
+"""
+
+import pytest
+import os
+import sys
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.repo_cache import RepoCache, create_repo_cache
+
+
+def _git(cwd, *args):
+    """Run a git command in cwd and return its stdout."""
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def _commit_file(repo, name, content):
+    """Write a file into repo and commit it, returning the new commit SHA."""
+    with open(os.path.join(repo, name), "w") as f:
+        f.write(content)
+    _git(repo, "add", name)
+    _git(repo, "commit", "-q", "-m", f"update {name}")
+    return _git(repo, "rev-parse", "HEAD")
+
+
+@pytest.fixture
+def origin_repo(tmp_path):
+    """Create a local origin repository with one commit."""
+    origin = tmp_path / "origin"
+    origin.mkdir()
+    _git(origin, "init", "-q")
+    _commit_file(origin, "test.py", "print('v1')")
+    return str(origin)
+
+
+@pytest.fixture
+def origin_url(origin_repo):
+    return f"file://{origin_repo}"
+
+
+class TestRepoCache:
+    """Tests for RepoCache."""
+    
+    def test_cold_acquire_clones(self, tmp_path, origin_url):
+        """Test that the first acquire produces a working tree."""
+        cache = RepoCache(str(tmp_path / "cache"))
+        path = cache.acquire(origin_url)
+        
+        assert open(os.path.join(path, "test.py")).read() == "print('v1')"
+        assert cache.owns(path)
+        cache.release(path)
+    
+    def test_warm_acquire_fetches_latest(self, tmp_path, origin_repo, origin_url):
+        """Test that a warm repo is updated to the latest commit."""
+        cache = RepoCache(str(tmp_path / "cache"))
+        with cache.checkout(origin_url) as path:
+            first_path = path
+        
+        _commit_file(origin_repo, "test.py", "print('v2')")
+        
+        with cache.checkout(origin_url) as path:
+            assert path == first_path
+            assert open(os.path.join(path, "test.py")).read() == "print('v2')"
+    
+    def test_pinned_commit_without_network(self, tmp_path, origin_repo, origin_url):
+        """Test that a cached pinned commit is served without contacting the remote."""
+        cache = RepoCache(str(tmp_path / "cache"))
+        sha = _git(origin_repo, "rev-parse", "HEAD")
+        with cache.checkout(origin_url):
+            pass
+        
+        # Make the remote unreachable
+        shutil.rmtree(origin_repo)
+        
+        with cache.checkout(origin_url, commit=sha) as path:
+            assert open(os.path.join(path, "test.py")).read() == "print('v1')"
+    
+    def test_invalid_commit(self, tmp_path, origin_url):
+        """Test that a non-SHA commit is rejected."""
+        cache = RepoCache(str(tmp_path / "cache"))
+        with pytest.raises(ValueError, match="commit SHA"):
+            cache.acquire(origin_url, commit="main; rm -rf /")
+    
+    def test_fetch_failure_releases_lease(self, tmp_path):
+        """Test that a failed fetch raises and does not leak a lease."""
+        cache = RepoCache(str(tmp_path / "cache"))
+        with pytest.raises(Exception, match="git fetch failed"):
+            cache.acquire(f"file://{tmp_path}/missing")
+        
+        assert all(repo.leases == 0 for repo in cache._repos.values())
+    
+    def test_failed_acquire_keeps_other_leases(self, tmp_path, origin_url):
+        """Test that a failed acquire does not drop the shared lock of a lease still in use."""
+        root = str(tmp_path / "cache")
+        cache = RepoCache(root)
+        path = cache.acquire(origin_url)
+        repo = next(iter(cache._repos.values()))
+        
+        with patch.object(cache, "_is_current", side_effect=OSError("disk error")):
+            with pytest.raises(OSError, match="disk error"):
+                cache.acquire(origin_url)
+        
+        try:
+            assert repo.leases == 1
+            assert len(repo.lease_locks) == 1 and not repo.lease_locks[0].closed
+            other_process = RepoCache(root)
+            handle = other_process._open_lock(repo)
+            with pytest.raises(BlockingIOError):
+                other_process._flock(handle, exclusive=True, blocking=False)
+            handle.close()
+        finally:
+            cache.release(path)
+        
+        assert repo.leases == 0
+    
+    def test_lru_eviction_by_size(self, tmp_path):
+        """Test that idle trees are evicted oldest first once over budget."""
+        urls = []
+        for name in ("a", "b"):
+            origin = tmp_path / name
+            origin.mkdir()
+            _git(origin, "init", "-q")
+            _commit_file(origin, "data.txt", "x" * 10000)
+            urls.append(f"file://{origin}")
+        
+        cache = RepoCache(str(tmp_path / "cache"))
+        with cache.checkout(urls[0]) as first_path:
+            pass
+        cache.max_bytes = cache.total_bytes() + 1
+        with cache.checkout(urls[1]):
+            pass
+        
+        assert not os.path.exists(first_path)
+        assert len(cache._repos) == 1
+    
+    def test_leased_repos_not_evicted(self, tmp_path, origin_url):
+        """Test that a tree in use survives eviction."""
+        cache = RepoCache(str(tmp_path / "cache"), max_bytes=1)
+        with cache.checkout(origin_url) as path:
+            assert os.path.exists(os.path.join(path, "test.py"))
+    
+    def test_lease_in_other_process_blocks_eviction(self, tmp_path, origin_url):
+        """Test that a tree leased through another cache on the same root is not evicted."""
+        root = str(tmp_path / "cache")
+        other_process = RepoCache(root)
+        cache = RepoCache(root)
+        
+        with cache.checkout(origin_url):
+            pass
+        
+        with other_process.checkout(origin_url) as path:
+            cache.max_bytes = 1
+            cache._evict()
+            assert os.path.exists(os.path.join(path, "test.py"))
+        
+        cache._evict()
+        assert not os.path.exists(path)
+    
+    def test_update_waits_for_leases_in_other_processes(self, tmp_path, origin_repo, origin_url):
+        """Test that a tree is not reset while another process is grading it."""
+        root = str(tmp_path / "cache")
+        other_process = RepoCache(root)
+        cache = RepoCache(root)
+        path = other_process.acquire(origin_url)
+        _commit_file(origin_repo, "test.py", "print('v2')")
+        acquired = threading.Event()
+        
+        def update():
+            cache.acquire(origin_url)
+            acquired.set()
+        
+        thread = threading.Thread(target=update)
+        thread.start()
+        try:
+            assert not acquired.wait(0.5)
+            assert open(os.path.join(path, "test.py")).read() == "print('v1')"
+        finally:
+            other_process.release(path)
+            thread.join()
+        
+        assert acquired.is_set()
+        assert open(os.path.join(path, "test.py")).read() == "print('v2')"
+    
+    def test_concurrent_acquires_share_fetch(self, tmp_path, origin_url):
+        """Test that concurrent requests for one repo trigger a single fetch."""
+        cache = RepoCache(str(tmp_path / "cache"))
+        original_run_git = cache._run_git
+        fetches = []
+        start = threading.Barrier(4)
+        
+        def counting_run_git(args, cwd):
+            if args[0] == "fetch":
+                fetches.append(args)
+            return original_run_git(args, cwd)
+        
+        paths = []
+        
+        def worker():
+            start.wait()
+            paths.append(cache.acquire(origin_url))
+        
+        with patch.object(cache, '_run_git', side_effect=counting_run_git):
+            threads = [threading.Thread(target=worker) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        
+        assert len(paths) == 4
+        assert len(set(paths)) == 1
+        assert len(fetches) == 1
+    
+    def test_reloads_existing_trees(self, tmp_path, origin_url):
+        """Test that trees from a previous process are picked up on start."""
+        root = str(tmp_path / "cache")
+        with RepoCache(root).checkout(origin_url) as path:
+            pass
+        
+        cache = RepoCache(root)
+        assert cache.owns(path)
+        assert cache.total_bytes() > 0
+
+
+class TestCreateRepoCache:
+    """Tests for create_repo_cache."""
+    
+    def test_disabled_by_default(self):
+        """Test that the cache is off unless a directory is configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            assert create_repo_cache() is None
+    
+    def test_enabled_from_env(self, tmp_path):
+        """Test configuring the cache from the environment."""
+        with patch.dict(os.environ, {
+            'GRADING_REPO_CACHE_DIR': str(tmp_path / "cache"),
+            'GRADING_REPO_CACHE_MAX_BYTES': '1000'
+        }):
+            cache = create_repo_cache()
+        
+        assert cache.max_bytes == 1000
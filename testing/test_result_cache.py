@@ -0,0 +1,157 @@
+"""
+Unit tests for result_cache.py
+Tests cache keys and the memory and SQLite backends
+"""
+
+import pytest
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.result_cache import (
+    make_cache_key,
+    create_result_cache,
+    MemoryResultCache,
+    SQLiteResultCache
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache_factory(request, tmp_path):
+    """Build caches for both backends with the given limits."""
+    def factory(max_entries=10, ttl_seconds=60):
+        if request.param == "memory":
+            return MemoryResultCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        return SQLiteResultCache(
+            path=str(tmp_path / "cache.db"),
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds
+        )
+    return factory
+
+
+class TestMakeCacheKey:
+    """Tests for make_cache_key."""
+    
+    def test_same_inputs_same_key(self):
+        """Test that identical inputs hash to the same key."""
+        assert make_cache_key("code", "rubric", "tmpl", "gpt") == make_cache_key("code", "rubric", "tmpl", "gpt")
+    
+    def test_each_input_changes_key(self):
+        """Test that every input participates in the key."""
+        base = make_cache_key("code", "rubric", "tmpl", "gpt")
+        assert make_cache_key("code2", "rubric", "tmpl", "gpt") != base
+        assert make_cache_key("code", "rubric2", "tmpl", "gpt") != base
+        assert make_cache_key("code", "rubric", "tmpl2", "gpt") != base
+        assert make_cache_key("code", "rubric", "tmpl", "gpt2") != base
+    
+    def test_field_boundaries(self):
+        """Test that shifting text between fields changes the key."""
+        assert make_cache_key("ab", "c", "t", "d") != make_cache_key("a", "bc", "t", "d")
+
+
+class TestResultCacheBackends:
+    """Tests shared by the memory and SQLite backends."""
+    
+    def test_get_set_and_stats(self, cache_factory):
+        """Test round-tripping a result and counting hits and misses."""
+        cache = cache_factory()
+        assert cache.get("missing") is None
+        
+        cache.set("key", {"rubric_score": "5/6", "hundred_point_score": 83})
+        assert cache.get("key") == {"rubric_score": "5/6", "hundred_point_score": 83}
+        
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["size"] == 1
+    
+    def test_returns_copies(self, cache_factory):
+        """Test that mutating a returned result does not change the cache."""
+        cache = cache_factory()
+        cache.set("key", {"file_name": ["a.py"]})
+        
+        cache.get("key")["file_name"] = ["b.py"]
+        assert cache.get("key") == {"file_name": ["a.py"]}
+    
+    def test_lru_eviction(self, cache_factory):
+        """Test that the least recently used entry is evicted first."""
+        cache = cache_factory(max_entries=2)
+        cache.set("a", {"v": 1})
+        time.sleep(0.01)
+        cache.set("b", {"v": 2})
+        time.sleep(0.01)
+        cache.get("a")
+        time.sleep(0.01)
+        cache.set("c", {"v": 3})
+        
+        assert cache.get("b") is None
+        assert cache.get("a") == {"v": 1}
+        assert cache.get("c") == {"v": 3}
+        assert len(cache) == 2
+    
+    def test_ttl_expiry(self, cache_factory):
+        """Test that expired entries are treated as misses."""
+        cache = cache_factory(ttl_seconds=0.05)
+        cache.set("key", {"v": 1})
+        time.sleep(0.1)
+        
+        assert cache.get("key") is None
+        assert cache.stats()["misses"] == 1
+    
+    def test_clear(self, cache_factory):
+        """Test that clear removes every entry."""
+        cache = cache_factory()
+        cache.set("key", {"v": 1})
+        cache.clear()
+        
+        assert len(cache) == 0
+
+
+class TestSQLiteResultCache:
+    """Tests specific to the SQLite backend."""
+    
+    def test_persists_across_instances(self, tmp_path):
+        """Test that results survive reopening the database."""
+        path = str(tmp_path / "cache.db")
+        SQLiteResultCache(path=path).set("key", {"v": 1})
+        
+        assert SQLiteResultCache(path=path).get("key") == {"v": 1}
+
+
+class TestCreateResultCache:
+    """Tests for create_result_cache."""
+    
+    def test_default_is_memory(self):
+        """Test that the memory backend is used by default."""
+        with patch.dict(os.environ, {}, clear=True):
+            assert isinstance(create_result_cache(), MemoryResultCache)
+    
+    def test_disabled(self):
+        """Test that caching can be turned off."""
+        with patch.dict(os.environ, {'GRADING_CACHE_BACKEND': 'none'}):
+            assert create_result_cache() is None
+    
+    def test_sqlite_from_env(self, tmp_path):
+        """Test configuring the SQLite backend from the environment."""
+        with patch.dict(os.environ, {
+            'GRADING_CACHE_BACKEND': 'sqlite',
+            'GRADING_CACHE_PATH': str(tmp_path / "cache.db"),
+            'GRADING_CACHE_MAX_ENTRIES': '5'
+        }):
+            cache = create_result_cache()
+        
+        assert isinstance(cache, SQLiteResultCache)
+        assert cache.max_entries == 5
+    
+    def test_unknown_backend(self):
+        """Test that an unknown backend name is rejected."""
+        with patch.dict(os.environ, {'GRADING_CACHE_BACKEND': 'redis'}):
+            with pytest.raises(ValueError, match="Unknown GRADING_CACHE_BACKEND"):
+                create_result_cache()
@@ -0,0 +1,185 @@
+"""
+Unit tests for static_analysis.py
+Tests per-file metrics, prompt summaries and comment stripping
+"""
+
+import pytest
+import os
+import ast
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services import static_analysis
+from services.static_analysis import (
+    StaticAnalyzer,
+    analyze_source,
+    create_static_analyzer,
+    format_summary,
+    strip_source,
+    summary_for
+)
+
+
+SOURCE = '''"""Inventory helpers."""
+
+
+class Inventory:
+    """Items in stock."""
+
+    def __init__(self):
+        self.items = {}
+
+    def addItem(self, name, count):
+        if name in self.items and count > 0:
+            self.items[name] += count
+        elif count < 0:
+            raise ValueError("negative")
+        else:
+            self.items[name] = count
+
+
+def total(inventory):
+    return sum(count for count in inventory.values() if count)
+'''
+
+
+class TestAnalyzeSource:
+    """Tests for the measurements taken from one file."""
+
+    def test_metrics(self):
+        analysis = analyze_source("inventory.py", SOURCE)
+
+        assert analysis["classes"] == 1
+        assert analysis["functions"] == 3
+        assert analysis["missing_docstrings"] == ["Inventory.__init__", "Inventory.addItem", "total"]
+        assert (analysis["documented"], analysis["documentable"]) == (2, 5)
+        # if, and, elif, comprehension and its filter
+        assert analysis["complexity"] == {"Inventory.__init__": 1, "Inventory.addItem": 4, "total": 3}
+        assert analysis["style"] == {"N802": 1}
+        assert analysis["outline"] == ["class Inventory(__init__, addItem)", "def total"]
+
+    def test_style_lines(self):
+        source = "x = 1   \nif x:\n\ty = 2\nz = '" + "a" * 90 + "'\n"
+
+        assert analyze_source("style.py", source)["style"] == {"E501": 1, "W191": 1, "W291": 1}
+
+    def test_syntax_error_and_non_python(self):
+        analysis = analyze_source("broken.py", "def main(:\n    pass\n")
+
+        assert analysis["syntax_error"].startswith("line 1:")
+        assert format_summary(analysis).startswith("2 lines; does not parse")
+        assert analyze_source("notes.md", "# Notes\n") is None
+
+    def test_deeply_nested_source(self):
+        source = "x = (1\n" + "+1\n" * 40000 + ")\n"
+
+        analysis = analyze_source("nested.py", source)
+
+        assert analysis == {"lines": 40002, "syntax_error": "too deeply nested to analyze"}
+        assert StaticAnalyzer(workers=0).analyze({"nested.py": source})[1]["nested.py"].startswith("40002 lines")
+
+
+class TestFormatSummary:
+    """Tests for the text placed in the prompt."""
+
+    def test_summary(self):
+        summary = format_summary(analyze_source("inventory.py", SOURCE))
+
+        assert summary == (
+            "20 lines, 1 classes, 3 functions; "
+            "docstrings 2/5 (missing: Inventory.__init__, Inventory.addItem, total); "
+            "cyclomatic complexity max 4 (Inventory.addItem), mean 2.7; "
+            "PEP 8: 1 issues (N802 x1)\n"
+            "Outline: class Inventory(__init__, addItem), def total"
+        )
+
+    def test_summary_for_split_files(self):
+        summaries = {"big.py": "summary"}
+
+        assert summary_for(summaries, "big.py") == "summary"
+        assert summary_for(summaries, "big.py (part 1/3)") == "summary"
+        assert summary_for(summaries, "big.py (part 2/3)") is None
+        assert summary_for(None, "big.py") is None
+
+
+class TestStripSource:
+    """Tests for removing comments and blank lines."""
+
+    SOURCE = '''# Header comment
+def main():
+    """Docstring # not a comment."""
+
+    text = """
+# kept, inside a string
+
+"""
+    return text  # trailing comment
+'''
+
+    def test_strips_without_changing_the_code(self):
+        stripped = strip_source(self.SOURCE)
+
+        assert stripped == (
+            'def main():\n'
+            '    """Docstring # not a comment."""\n'
+            '    text = """\n'
+            '# kept, inside a string\n'
+            '\n'
+            '"""\n'
+            '    return text\n'
+        )
+        assert ast.dump(ast.parse(stripped)) == ast.dump(ast.parse(self.SOURCE))
+
+    def test_options(self):
+        assert "\n\n    text" in strip_source(self.SOURCE, blank_lines=False)
+        assert "# trailing comment" in strip_source(self.SOURCE, comments=False)
+        assert strip_source(self.SOURCE, comments=False, blank_lines=False) == self.SOURCE
+
+    def test_untokenizable_source_unchanged(self):
+        assert strip_source('x = """unterminated\n# comment\n') == 'x = """unterminated\n# comment\n'
+
+
+class TestStaticAnalyzer:
+    """Tests for analyzing a batch of loaded files."""
+
+    def test_analyze_batch(self):
+        analyzer = StaticAnalyzer(workers=0, strip_comments=True)
+        code_files = {"inventory.py": "# comment\n" + SOURCE, "README.md": "# Title\n", "big.py": "# partial\n"}
+
+        stripped, summaries = analyzer.analyze(code_files, skip=["big.py"])
+
+        assert list(summaries) == ["inventory.py"]
+        assert list(stripped) == list(code_files)
+        assert not stripped["inventory.py"].startswith("#")
+        assert stripped["README.md"] == "# Title\n"
+        assert stripped["big.py"] == "# partial\n"
+
+    def test_large_batch_uses_process_pool(self):
+        analyzer = StaticAnalyzer(workers=1)
+        code_files = {f"module_{index}.py": SOURCE * 100 for index in range(4)}
+
+        try:
+            _, summaries = analyzer.analyze(code_files)
+        finally:
+            static_analysis._reset_pool()
+
+        assert summaries == {name: format_summary(analyze_source(name, SOURCE * 100)) for name in code_files}
+
+    def test_create_from_env(self):
+        with patch.dict(os.environ, {"GRADING_STATIC_ANALYSIS": "0"}):
+            assert create_static_analyzer() is None
+
+        with patch.dict(os.environ, {"GRADING_ANALYSIS_WORKERS": "0", "GRADING_STRIP_COMMENTS": "true"}):
+            analyzer = create_static_analyzer()
+
+        assert analyzer.workers == 0
+        assert analyzer.strip_comments is True
+        assert analyzer.strip_blank_lines is False
+
+        with patch.dict(os.environ, {"GRADING_ANALYSIS_WORKERS": "-1"}):
+            with pytest.raises(ValueError):
+                create_static_analyzer()
@@ -0,0 +1,232 @@
+"""
+Unit tests for test_runner.py
+Tests sandboxed test runs, their summaries and prompt test results
+"""
+
+import pytest
+import os
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.test_runner import (
+    MAX_TEST_RESULTS_CHARS,
+    TestRunner,
+    create_test_runner,
+    format_test_results,
+    format_test_summary,
+    sandbox_available,
+    parse_junit_report
+)
+
+
+def _write(repo, files):
+    for name, content in files.items():
+        path = repo / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return str(repo)
+
+
+@pytest.fixture
+def runner():
+    runner = TestRunner(workers=2, timeout_seconds=30, isolate=False)
+    yield runner
+    runner.close()
+
+
+class TestFormatTestResults:
+    """Tests for test results supplied with a request."""
+
+    def test_empty(self):
+        assert format_test_results(None) == ""
+        assert format_test_results("  \n") == ""
+
+    def test_labelled_and_clipped_to_the_end(self):
+        text = "x" * (2 * MAX_TEST_RESULTS_CHARS) + "\n5 passed, 1 failed"
+
+        formatted = format_test_results(text)
+
+        assert formatted.startswith("\n\nTest Results (supplied with the submission")
+        assert formatted.rstrip().endswith("5 passed, 1 failed")
+        assert "[earlier output omitted]" in formatted
+        assert len(formatted) < MAX_TEST_RESULTS_CHARS + 200
+
+
+class TestParseJunitReport:
+    """Tests for reading pytest's JUnit XML report."""
+
+    def test_counts_and_failures(self, tmp_path):
+        report = tmp_path / "report.xml"
+        report.write_text(
+            '<testsuites><testsuite tests="4" failures="1" errors="1" skipped="1">'
+            '<testcase classname="test_app" name="test_ok"/>'
+            '<testcase classname="test_app" name="test_bad"><failure message="boom"/></testcase>'
+            '<testcase classname="test_app" name="test_broken"><error message="oops"/></testcase>'
+            '<testcase classname="test_app" name="test_skip"><skipped/></testcase>'
+            '</testsuite></testsuites>'
+        )
+
+        assert parse_junit_report(str(report)) == {
+            "passed": 1, "failed": 1, "errors": 1, "skipped": 1,
+            "failures": ["test_app::test_bad", "test_app::test_broken"]
+        }
+
+    def test_missing_or_malformed(self, tmp_path):
+        (tmp_path / "bad.xml").write_text("<testsuite")
+
+        assert parse_junit_report(str(tmp_path / "missing.xml")) is None
+        assert parse_junit_report(str(tmp_path / "bad.xml")) is None
+
+
+class TestTestRunner:
+    """Tests for running a repository's tests in a subprocess."""
+
+    def test_passing_and_failing_tests(self, runner, tmp_path):
+        repo = _write(tmp_path / "repo", {
+            "calc.py": "def add(a, b):\n    return a + b\n",
+            "tests/test_calc.py": (
+                "from calc import add\n\n"
+                "def test_add():\n    assert add(1, 2) == 3\n\n"
+                "def test_wrong():\n    assert add(1, 1) == 3\n"
+            )
+        })
+
+        summary = runner.run(repo)
+
+        assert summary["status"] == "failed"
+        assert (summary["passed"], summary["failed"], summary["exit_code"]) == (1, 1, 1)
+        # Failing test ids and output come from student code, so they are only logged
+        assert set(summary) == {"status", "exit_code", "passed", "failed", "errors", "skipped", "duration_seconds"}
+        assert "1 passed, 1 failed" in format_test_summary(summary)
+        # Tests ran on a copy, so nothing was written into the checkout
+        assert sorted(os.listdir(repo)) == ["calc.py", "tests"]
+
+    def test_no_tests(self, runner, tmp_path):
+        summary = runner.run(_write(tmp_path / "repo", {"calc.py": "x = 1\n"}))
+
+        assert summary["status"] == "no_tests"
+
+    def test_timeout(self, tmp_path):
+        runner = TestRunner(workers=1, timeout_seconds=1, isolate=False)
+        repo = _write(tmp_path / "repo", {"test_slow.py": "import time\n\ndef test_slow():\n    time.sleep(30)\n"})
+
+        try:
+            summary = runner.run(repo)
+        finally:
+            runner.close()
+
+        assert summary["status"] == "timeout"
+        assert summary["duration_seconds"] < 15
+        assert "detail" not in summary
+
+    def test_secrets_not_passed_to_tests(self, runner, tmp_path):
+        repo = _write(tmp_path / "repo", {
+            "test_env.py": "import os\n\ndef test_env():\n    assert 'AZURE_OPENAI_API_KEY' not in os.environ\n"
+        })
+
+        with patch.dict(os.environ, {"AZURE_OPENAI_API_KEY": "secret"}):
+            assert runner.run(repo)["status"] == "passed"
+
+    def test_memory_limit(self, tmp_path):
+        runner = TestRunner(workers=1, memory_bytes=512 * 1024 * 1024, isolate=False)
+        repo = _write(tmp_path / "repo", {
+            "test_memory.py": "def test_memory():\n    data = bytearray(2 * 1024 ** 3)\n"
+        })
+
+        try:
+            summary = runner.run(repo)
+        finally:
+            runner.close()
+
+        assert summary["status"] == "failed"
+        assert summary["failed"] == 1
+
+    def test_output_not_in_summary(self, runner, tmp_path):
+        repo = _write(tmp_path / "repo", {"conftest.py": "print('leaked-secret')\nraise SystemExit(3)\n"})
+
+        summary = runner.run(repo)
+
+        assert summary["status"] == "error"
+        assert summary["exit_code"] == 3
+        assert "leaked-secret" not in str(summary)
+
+    @pytest.mark.skipif(not sandbox_available(), reason="unshare is not available")
+    def test_host_files_hidden(self, tmp_path):
+        runner = TestRunner(workers=1, isolate=True)
+        secret = tmp_path / "server.env"
+        secret.write_text("AZURE_OPENAI_API_KEY=secret\n")
+        repo = _write(tmp_path / "repo", {
+            "test_files.py": (
+                "import os\n\n"
+                f"def test_host_hidden():\n    assert not os.path.exists({str(secret)!r})\n"
+                f"    assert not os.path.exists({str(Path(__file__).resolve())!r})\n\n"
+                "def test_tree_writable():\n    open('out.txt', 'w').write('x')\n\n"
+                "def test_interpreter_read_only():\n"
+                "    try:\n"
+                "        open('/usr/sandbox-test', 'w')\n"
+                "    except OSError:\n"
+                "        return\n"
+                "    raise AssertionError('/usr is writable')\n"
+            )
+        })
+
+        try:
+            summary = runner.run(repo)
+        finally:
+            runner.close()
+
+        assert (summary["status"], summary["passed"]) == ("passed", 3)
+
+    @pytest.mark.skipif(not sandbox_available(), reason="unshare is not available")
+    def test_network_isolated(self, tmp_path):
+        runner = TestRunner(workers=1, isolate=True)
+        repo = _write(tmp_path / "repo", {
+            "test_net.py": (
+                "import socket\n\n"
+                "def test_no_route():\n"
+                "    try:\n"
+                "        socket.create_connection(('1.1.1.1', 53), timeout=2)\n"
+                "    except OSError:\n"
+                "        return\n"
+                "    raise AssertionError('network reachable')\n"
+            )
+        })
+
+        try:
+            assert runner.run(repo)["status"] == "passed"
+        finally:
+            runner.close()
+
+
+class TestCreateTestRunner:
+    """Tests for configuring test runs from the environment."""
+
+    def test_disabled_by_default(self):
+        with patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("GRADING_RUN_TESTS", None)
+            assert create_test_runner() is None
+
+    def test_from_env(self):
+        with patch.dict(os.environ, {
+            "GRADING_RUN_TESTS": "1",
+            "GRADING_TEST_SANDBOX": "none",
+            "GRADING_TEST_TIMEOUT_SECONDS": "5",
+            "GRADING_TEST_MEMORY_BYTES": "1000000"
+        }):
+            runner = create_test_runner()
+
+        try:
+            assert runner.isolate is False
+            assert runner.timeout_seconds == 5
+            assert runner.memory_bytes == 1000000
+        finally:
+            runner.close()
+
+    def test_unknown_sandbox(self):
+        with patch.dict(os.environ, {"GRADING_RUN_TESTS": "1", "GRADING_TEST_SANDBOX": "docker"}):
+            with pytest.raises(ValueError, match="GRADING_TEST_SANDBOX"):
+                create_test_runner()
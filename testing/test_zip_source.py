@@ -0,0 +1,187 @@
+"""
+Unit tests for zip_source.py
+Tests streaming archive reading, zip bomb limits and multipart uploads
+"""
+
+import pytest
+import io
+import sys
+import json
+import asyncio
+import zipfile
+from pathlib import Path
+
+# Add parent directory to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from services.zip_source import (
+    ArchiveError,
+    ArchiveTooLarge,
+    ZipLimits,
+    ZipStreamReader,
+    read_grading_upload,
+    read_zip
+)
+
+
+class _Unseekable(io.RawIOBase):
+    """Write-only stream, so zipfile writes sizes in data descriptors."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def _zip(files, compression=zipfile.ZIP_DEFLATED, streamed=False):
+    buffer = _Unseekable() if streamed else io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as archive:
+        for name, content in files.items():
+            if streamed:
+                with archive.open(name, "w") as f:
+                    f.write(content.encode())
+            else:
+                archive.writestr(name, content)
+    return bytes(buffer.data) if streamed else buffer.getvalue()
+
+
+FILES = {
+    "repo-main/": "",
+    "repo-main/main.py": "def main():\n    pass\n",
+    "repo-main/src/helper.py": "def helper():\n    return 1\n",
+    "repo-main/data/big.csv": "a,b\n" * 5000
+}
+
+
+class TestZipStreamReader:
+    """Tests for reading only the batch-listed members."""
+
+    @pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+    @pytest.mark.parametrize("chunk_size", [1, 13, 64 * 1024])
+    def test_reads_only_wanted_members(self, compression, chunk_size):
+        source = read_zip(_zip(FILES, compression), ["main.py", "src/helper.py"], chunk_size=chunk_size)
+
+        assert sorted(source.files) == ["repo-main/main.py", "repo-main/src/helper.py"]
+        assert source.read("repo-main/main.py") == FILES["repo-main/main.py"]
+        assert source.read("repo-main/data/big.csv") is None
+        assert len(source) == 3
+        assert source.file_index.resolve("helper.py") == ("repo-main/src/helper.py", None)
+
+    def test_data_descriptor_members(self):
+        data = _zip(FILES, streamed=True)
+
+        source = read_zip(data, ["main.py", "big.csv"], chunk_size=7)
+
+        assert source.read("repo-main/data/big.csv") == FILES["repo-main/data/big.csv"]
+        assert source.read("repo-main/main.py") == FILES["repo-main/main.py"]
+
+    def test_rejects_non_zip_and_truncated(self):
+        with pytest.raises(ArchiveError, match="Not a zip archive"):
+            read_zip(b"definitely not a zip", ["main.py"])
+        with pytest.raises(ArchiveError, match="truncated"):
+            read_zip(_zip(FILES)[:60], ["main.py"])
+        with pytest.raises(ArchiveError, match="empty"):
+            ZipStreamReader(["main.py"]).close()
+
+    def test_rejects_corrupt_member(self):
+        data = bytearray(_zip({"main.py": "print('hello')\n"}, zipfile.ZIP_STORED))
+        data[data.index(b"hello")] = ord("j")
+
+        with pytest.raises(ArchiveError, match="CRC"):
+            read_zip(bytes(data), ["main.py"])
+
+
+class TestZipLimits:
+    """Tests for the zip bomb limits."""
+
+    def test_member_count(self):
+        data = _zip({f"f{index}.py": "x = 1\n" for index in range(20)})
+
+        with pytest.raises(ArchiveTooLarge, match="more than 10 entries"):
+            read_zip(data, ["f1.py"], ZipLimits(max_members=10))
+
+    def test_archive_size(self):
+        with pytest.raises(ArchiveTooLarge, match="Archive is larger"):
+            read_zip(_zip(FILES), ["main.py"], ZipLimits(max_bytes=100))
+
+    def test_member_size(self):
+        with pytest.raises(ArchiveTooLarge, match="big.csv"):
+            read_zip(_zip(FILES), ["big.csv"], ZipLimits(max_member_bytes=1000))
+
+    def test_compression_ratio(self):
+        bomb = _zip({"bomb.py": "0" * (4 * 2 ** 20)}, streamed=True)
+
+        with pytest.raises(ArchiveTooLarge, match="compression ratio"):
+            read_zip(bomb, ["main.py"], ZipLimits(max_ratio=50))
+
+    def test_skipped_members_are_not_inflated(self):
+        # Sizes are in the headers, so unwanted members are skipped, not expanded
+        bomb = _zip({"bomb.py": "0" * (4 * 2 ** 20), "main.py": "x = 1\n"})
+
+        source = read_zip(bomb, ["main.py"], ZipLimits(max_ratio=50, max_total_bytes=1000))
+
+        assert list(source.files) == ["main.py"]
+
+
+def _multipart(parts, boundary="grading-boundary"):
+    body = b""
+    for name, value, filename in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{boundary}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + value + b"\r\n"
+    body += f"--{boundary}--\r\n".encode()
+    return f"multipart/form-data; boundary={boundary}", body
+
+
+async def _chunks(body, size=17):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+class TestReadGradingUpload:
+    """Tests for parsing the multipart upload as it streams."""
+
+    RUBRIC = {"rubric": "Grade it", "batches": [["main.py"], ["helper.py"]]}
+
+    def test_reads_rubric_and_archive(self):
+        content_type, body = _multipart([
+            ("rubric", json.dumps(self.RUBRIC).encode(), None),
+            ("archive", _zip(FILES), "submission.zip")
+        ])
+
+        rubric_json, source = asyncio.run(read_grading_upload(content_type, _chunks(body)))
+
+        assert rubric_json == self.RUBRIC
+        assert sorted(source.files) == ["repo-main/main.py", "repo-main/src/helper.py"]
+
+    def test_rubric_must_come_first(self):
+        content_type, body = _multipart([
+            ("archive", _zip(FILES), "submission.zip"),
+            ("rubric", json.dumps(self.RUBRIC).encode(), None)
+        ])
+
+        with pytest.raises(ArchiveError, match="rubric field must come before"):
+            asyncio.run(read_grading_upload(content_type, _chunks(body)))
+
+    @pytest.mark.parametrize("rubric, message", [
+        (b"{not json", "not valid JSON"),
+        (b'{"rubric": "x"}', '"rubric" and "batches"'),
+        (b'{"rubric": "x", "batches": "main.py"}', "list of lists")
+    ])
+    def test_invalid_rubric(self, rubric, message):
+        content_type, body = _multipart([("rubric", rubric, None), ("archive", _zip(FILES), "a.zip")])
+
+        with pytest.raises(ArchiveError, match=message):
+            asyncio.run(read_grading_upload(content_type, _chunks(body)))
+
+    def test_requires_multipart_and_archive(self):
+        with pytest.raises(ArchiveError, match="multipart/form-data"):
+            asyncio.run(read_grading_upload("application/json", _chunks(b"{}")))
+
+        content_type, body = _multipart([("rubric", json.dumps(self.RUBRIC).encode(), None)])
+        with pytest.raises(ArchiveError, match="no archive"):
+            asyncio.run(read_grading_upload(content_type, _chunks(body)))